@@ -2,16 +2,21 @@ from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr
 from typing import Optional
-import mysql.connector
 import jwt
 import datetime
 from datetime import timedelta
 from base import app
+from cache import MISS, TTLCache
+from db import DatabasePool
+from metrics import Gauge
+from stats import register_stats
 from jose import JWTError
-import bcrypt
-from mysql.connector import Error
+from passwords import PasswordHasher
 import os
 from dotenv import load_dotenv
+from logs import get_logger
+
+logger = get_logger(__name__)
 
 # 加载环境变量
 load_dotenv()
@@ -24,6 +29,11 @@ JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "1234567890")
 JWT_ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "1440"))  # 默认24小时
 
+# 用户记录缓存配置
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # 秒
+USER_CACHE_NEGATIVE_TTL = float(os.getenv("USER_CACHE_NEGATIVE_TTL", "10"))  # 不存在的用户缓存时间
+
 # 根据环境选择数据库配置
 if ENV == "production":
     db_config = {
@@ -81,27 +91,79 @@ class TokenData(BaseModel):
     username: Optional[str] = None
 
 
+# 数据库连接池
+db_pool = DatabasePool(db_config)
+register_stats("db_pool", db_pool.stats)
+Gauge("db_pool_connections", "Database pool connections by state", ("state",), collect=lambda: [
+    ({"state": "in_use"}, db_pool.stats()["in_use"]),
+    ({"state": "idle"}, db_pool.stats()["idle"]),
+    ({"state": "waiting"}, db_pool.stats()["waiting"]),
+])
+
+# 按用户名查询用户，认证相关接口的热点查询，使用预处理语句
+USER_BY_USERNAME_SQL = "SELECT * FROM users WHERE username = %s"
+
+
+@app.on_event("startup")
+async def open_db_pool():
+    await db_pool.start()
+
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    await db_pool.close()
+
+
 # 数据库连接函数
 def get_db_connection():
-    try:
-        connection = mysql.connector.connect(**db_config)
-        return connection
-    except Error as e:
-        print(f"Error connecting to MySQL Database: {e}")
-        raise HTTPException(status_code=500, detail="Database connection failed")
+    """从连接池借出一条连接，用法: async with get_db_connection() as conn"""
+    return db_pool.connection()
+
+
+# 用户记录缓存，按用户名索引
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+register_stats("user_cache", user_cache.stats)
+
+
+def _cache_user(username: str, user: Optional[dict]):
+    user_cache.set(username, user, ttl=USER_CACHE_NEGATIVE_TTL if user is None else None)
+
+
+async def get_user_by_username(username: str) -> Optional[dict]:
+    """读穿缓存查询用户，未命中时查库并回填（包括不存在的用户）"""
+    user = user_cache.get(username)
+    if user is MISS:
+        async with get_db_connection() as conn:
+            user = await conn.fetchone(USER_BY_USERNAME_SQL, (username,), dictionary=True, prepared=True)
+        _cache_user(username, user)
+    # 返回副本，避免调用方修改缓存中的记录
+    return dict(user) if user is not None else None
+
+
+def invalidate_user(username: str):
+    """用户记录有写入（注册、资料修改等）后调用，使缓存失效"""
+    user_cache.invalidate(username)
+
+
+# 密码哈希在专用线程池中执行，不占用事件循环
+password_hasher = PasswordHasher()
+register_stats("bcrypt", password_hasher.stats)
+Gauge("bcrypt_pending", "bcrypt jobs queued or running", collect=lambda: [({}, password_hasher.stats()["pending"])])
+
+
+@app.on_event("shutdown")
+async def close_password_hasher():
+    password_hasher.close()
 
 
 # 密码验证函数
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(
-        plain_password.encode('utf-8'),
-        hashed_password.encode('utf-8')
-    )
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.verify(plain_password, hashed_password)
 
 
 # 获取密码哈希
-def get_password_hash(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+async def get_password_hash(password: str) -> str:
+    return await password_hasher.hash(password)
 
 
 # 创建访问令牌
@@ -125,31 +187,28 @@ async def get_current_user(token: str = Depends(security)):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+    user = await authenticate_token(token)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
+
+
+async def authenticate_token(token: str) -> Optional[dict]:
+    """校验JWT并返回用户记录，无效时返回 None；HTTP 依赖和 WebSocket 连接共用"""
     try:
         payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
-            raise credentials_exception
+            return None
         token_data = TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    try:
-        cursor.execute("SELECT * FROM users WHERE username = %s", (token_data.username,))
-        user = cursor.fetchone()
-        if user is None:
-            raise credentials_exception
-        return user
-    finally:
-        cursor.close()
-        conn.close()
+    except (JWTError, jwt.PyJWTError):
+        # 令牌由 PyJWT 解码，签名错误或过期时抛出的是 PyJWTError
+        return None
+    return await get_user_by_username(token_data.username)
 
 
 # 注册路由
@@ -163,60 +222,53 @@ async def register(user: UserCreate):
             detail="Password must be at least 8 characters long and contain uppercase, lowercase, and numbers"
         )
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
+    async with get_db_connection() as conn:
         # 检查用户名是否已存在
-        cursor.execute("SELECT id FROM users WHERE username = %s", (user.username,))
-        if cursor.fetchone():
+        if await conn.fetchone("SELECT id FROM users WHERE username = %s", (user.username,)):
             raise HTTPException(status_code=400, detail="Username already exists")
 
         # 检查邮箱是否已存在
-        cursor.execute("SELECT id FROM users WHERE email = %s", (user.email,))
-        if cursor.fetchone():
+        if await conn.fetchone("SELECT id FROM users WHERE email = %s", (user.email,)):
             raise HTTPException(status_code=400, detail="Email already exists")
 
         # 密码加密
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await get_password_hash(user.password)
 
         # 插入新用户
-        cursor.execute(
+        await conn.execute(
             "INSERT INTO users (username, email, password) VALUES (%s, %s, %s)",
             (user.username, user.email, hashed_password)
         )
-        conn.commit()
+        await conn.commit()
+        # 清除该用户名可能存在的负缓存
+        invalidate_user(user.username)
 
         return {"message": "User registered successfully"}
-    finally:
-        cursor.close()
-        conn.close()
 
 
 # 登录路由
 @app.post("/api/v1/auth/login", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
     try:
-        # 打印接收到的数据，用于调试
-        print(f"Received login request for username: {form_data.username}")
+        logger.debug("login request", extra={"username": form_data.username})
 
-        cursor.execute("SELECT * FROM users WHERE username = %s", (form_data.username,))
-        user = cursor.fetchone()
+        # 登录始终读库，顺便刷新缓存；校验密码前先归还连接
+        async with get_db_connection() as conn:
+            user = await conn.fetchone(USER_BY_USERNAME_SQL, (form_data.username,), dictionary=True, prepared=True)
+        _cache_user(form_data.username, user)
 
         if not user:
-            print(f"User not found: {form_data.username}")
+            logger.info("login failed: user not found", extra={"username": form_data.username})
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password",
                 headers={"WWW-Authenticate": "Bearer"},
             )
 
-        # 打印密码验证结果，用于调试
-        is_valid = verify_password(form_data.password, user["password"]) # type: ignore
-        print(f"Password validation result: {is_valid}")
+        is_valid = await verify_password(form_data.password, user["password"]) # type: ignore
 
         if not is_valid:
+            logger.info("login failed: wrong password", extra={"username": form_data.username})
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password",
@@ -234,11 +286,9 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
             "username": user["username"] # type: ignore
         }
     except Exception as e:
-        print(f"Login error: {str(e)}")
+        if not isinstance(e, HTTPException):
+            logger.error(f"Login error: {e}")
         raise
-    finally:
-        cursor.close()
-        conn.close()
 
 
 if __name__ == "__main__":
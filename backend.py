@@ -1,17 +1,32 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 import asyncio
 import httpx
 import json
-import queue
-from openai import AzureOpenAI  # Add this import at the top with other imports
+from openai import APIConnectionError, APIStatusError, APITimeoutError, AsyncAzureOpenAI
 import os
 
 from base import app
+from streaming import (
+    DONE_FRAME, STREAM_RELAY_RAW, ChannelClosed, StreamChannel, relay_sse_events, stream_from_channel
+)
+from upstream import register_upstream
+from response_cache import RecordingChannel, ResponseCache, response_cache
+from hedging import hedger
+from cassette import cassette
+from lifecycle import accepting_chats
+from logs import get_logger
+from supervisor import upstream_supervisor
+from resumable import resumable_streams
+from router import Endpoint, load_routes_from_env, model_router
+from singleflight import single_flight
+from context import SYSTEM_MESSAGE, context_builder
+from scheduler import client_key, request_priority, upstream_scheduler
+
+logger = get_logger(__name__)
 
 """
 https://ds.yovole.com/api/chat/completions
@@ -29,49 +44,56 @@ azure_endpoint="https://euinstance.openai.azure.com/"
 model_name: gpt-4o-mini
 """
 
-# API configuration
-DEEPSEEK_API_URL = "https://ds.yovole.com/api/chat/completions"
-DEEPSEEK_API_KEY = "sk-833480880d9d417fbcc7ce125ca7d78b"
-
-AZURE_API_KEY = "4d6f722a1a6f47ac822c0f3c9dbcc844"
-AZURE_API_VERSION = "2024-08-01-preview"
-AZURE_ENDPOINT = "https://euinstance.openai.azure.com/"
-
-# 获取当前文件所在目录
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-
-# 配置静态文件服务
-app.mount("/static", StaticFiles(directory=BASE_DIR), name="static")
-
-
-# 添加根路由，返回index.html
-@app.get("/")
-async def read_root():
-    index_path = os.path.join(BASE_DIR, "index.html")
-    if os.path.exists(index_path):
-        return FileResponse(index_path)
-    else:
-        raise HTTPException(status_code=404, detail=f"index.html not found at {index_path}")
-
-
-# 添加/index路由，也返回index.html
-@app.get("/index")
-async def read_index():
-    index_path = os.path.join(BASE_DIR, "index.html")
-    if os.path.exists(index_path):
-        return FileResponse(index_path)
-    else:
-        raise HTTPException(status_code=404, detail=f"index.html not found at {index_path}")
-
-
-# 添加/index.html路由，也返回index.html
-@app.get("/index.html")
-async def read_index_html():
-    index_path = os.path.join(BASE_DIR, "index.html")
-    if os.path.exists(index_path):
-        return FileResponse(index_path)
-    else:
-        raise HTTPException(status_code=404, detail=f"index.html not found at {index_path}")
+# API configuration，可用同名环境变量覆盖（例如压测时指向本地模拟上游）
+DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://ds.yovole.com/api/chat/completions")
+DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY", "sk-833480880d9d417fbcc7ce125ca7d78b")
+
+AZURE_API_KEY = os.getenv("AZURE_API_KEY", "4d6f722a1a6f47ac822c0f3c9dbcc844")
+AZURE_API_VERSION = os.getenv("AZURE_API_VERSION", "2024-08-01-preview")
+AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT", "https://euinstance.openai.azure.com/")
+
+# 进程级共享的DeepSeek连接池，避免每个请求重新握手
+deepseek_upstream = register_upstream("deepseek", DEEPSEEK_API_URL, env_prefix="DEEPSEEK")
+azure_upstream = register_upstream("azure", AZURE_ENDPOINT, env_prefix="AZURE")
+
+# 默认部署，可通过 MODEL_ROUTES / MODEL_ROUTES_FILE 为同一模型追加更多部署
+default_deepseek_endpoint = model_router.register_endpoint(Endpoint(
+    name="deepseek",
+    provider="deepseek",
+    base_url=DEEPSEEK_API_URL,
+    api_key=DEEPSEEK_API_KEY,
+    models={"DeepSeek-V3": "DeepSeek-V3", "DeepSeek-R1": "DeepSeek-R1"},
+    upstream=deepseek_upstream
+))
+default_azure_endpoint = model_router.register_endpoint(Endpoint(
+    name="azure",
+    provider="azure",
+    base_url=AZURE_ENDPOINT,
+    api_key=AZURE_API_KEY,
+    models={"gpt-4o-mini": "gpt-4o-mini", "gpt-4o": "gpt-4o"},
+    api_version=AZURE_API_VERSION,
+    upstream=azure_upstream
+))
+
+# 部署名 -> (httpx客户端, 异步Azure客户端)
+_azure_clients: Dict[str, tuple] = {}
+
+
+def get_azure_client(endpoint: Optional[Endpoint] = None) -> AsyncAzureOpenAI:
+    """返回部署对应的共享异步Azure客户端，底层复用该部署的连接池"""
+    endpoint = endpoint or default_azure_endpoint
+    http_client = endpoint.upstream.get_client()
+    cached = _azure_clients.get(endpoint.name)
+    if cached is None or cached[0] is not http_client:
+        client = AsyncAzureOpenAI(
+            api_key=endpoint.api_key,
+            api_version=endpoint.api_version or AZURE_API_VERSION,
+            azure_endpoint=endpoint.base_url,
+            http_client=http_client
+        )
+        cached = (http_client, client)
+        _azure_clients[endpoint.name] = cached
+    return cached[1]
 
 
 class ChatRequest(BaseModel):
@@ -80,12 +102,14 @@ class ChatRequest(BaseModel):
     max_tokens: int = 4096 # Maximum tokens to generate
     temperature: float = 0.7  # Temperature for generation
     stream: bool = True  # Stream the response
+    feature: str = "chat"  # 调用来源，chat 为交互式对话，其余按工具请求调度
+    resumable: bool = False  # 事件带id，断线后可携带 Last-Event-ID 重连续传
 
 
 class ModelListResponse(BaseModel):
     code: int = 200
     msg: str = "success"
-    models: List[str] = ["DeepSeek-V3", "DeepSeek-R1", "gpt-4o-mini"]
+    models: List[str] = []
 
 
 @app.get("/v1/models", response_model=ModelListResponse)
@@ -94,98 +118,120 @@ async def list_models():
     return ModelListResponse(
         code=200,
         msg="success",
-        models=["DeepSeek-V3", "DeepSeek-R1", "gpt-4o-mini"]
+        models=model_router.models()
     )
 
 
+def build_messages(system_message: str, prompt: str, history: Optional[List[dict]] = None) -> List[dict]:
+    """系统提示 + 会话历史 + 本轮提问"""
+    messages = [{"role": "system", "content": system_message}]
+    if history:
+        messages.extend({"role": m["role"], "content": m["content"]} for m in history)
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
 async def fetch_deepseek_response(
     model: str,
     prompt: str,
     max_tokens: int,
     temperature: float,
-    response_queue: queue.Queue,
-    request: Request
+    response_channel: StreamChannel,
+    request: Optional[Request] = None,
+    endpoint: Optional[Endpoint] = None,
+    history: Optional[List[dict]] = None
 ):
-    """Fetch response from DeepSeek API and put into queue"""
+    """Fetch response from DeepSeek API and send into channel
+
+    history 为会话中之前的消息（role/content），放在系统提示和本轮提问之间
+    """
+    endpoint = endpoint or default_deepseek_endpoint
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
+        "Authorization": f"Bearer {endpoint.api_key}"
     }
     
-    # 简化系统提示，不再要求特定的Markdown格式
-    system_message = "你是一个AI助手，请根据用户的问题给出回答。"
-    
     payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": prompt}
-        ],
-        "max_tokens": max(max_tokens, 4096),
+        "model": endpoint.upstream_model(model),
+        "messages": build_messages(SYSTEM_MESSAGE, prompt, history),
+        "max_tokens": max_tokens,
         "temperature": temperature,
         "stream": True
     }
     
     try:
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", DEEPSEEK_API_URL, json=payload, headers=headers, timeout=None) as response:
-                if response.status_code != 200:
-                    error_detail = await response.aread()
-                    print(f"DeepSeek API 错误: {error_detail.decode('utf-8')}")
-                    response_queue.put({"error": f"DeepSeek API 错误: {error_detail.decode('utf-8')}", "status_code": response.status_code})
-                    response_queue.put(None)  # Signal end of stream
-                    return
-                
+        client = endpoint.upstream.get_client()
+        async with client.stream("POST", endpoint.base_url, json=payload, headers=headers) as response:
+            if response.status_code != 200:
+                error_detail = await response.aread()
+                logger.warning(f"DeepSeek API 错误: {error_detail.decode('utf-8')}",
+                               extra={"status": response.status_code, "endpoint": endpoint.name})
+                response_channel.fail(f"DeepSeek API 错误: {error_detail.decode('utf-8')}", response.status_code)
+                return
+            
+            if STREAM_RELAY_RAW:
+                # 原样透传上游字节；客户端断开时通道关闭，send 抛出 ChannelClosed
+                async for events in relay_sse_events(response.aiter_bytes()):
+                    await response_channel.send(events)
+            else:
                 async for line in response.aiter_lines():
-                    # 检查客户端是否已断开连接
-                    if await request.is_disconnected():
-                        print("客户端已断开连接")
-                        break
-                        
-                    if not line.strip():
+                    if not line.startswith("data: "):
                         continue
+                    try:
+                        json_str = line[6:].strip()
                         
-                    if line.startswith("data: "):
-                        try:
-                            json_str = line[6:].strip()
-                            
-                            if not json_str or json_str == "[DONE]":
-                                continue
-                            
-                            if not (json_str.startswith('{') or json_str.startswith('[')):
-                                print(f"跳过无效的JSON行: {json_str}")
-                                continue
-                            
-                            data = json.loads(json_str)
-                            
-                            if "choices" in data and len(data["choices"]) > 0:
-                                delta = data["choices"][0].get("delta", {})
-                                content = delta.get("content", "")
-                                
-                                if content:
-                                    response_queue.put(line)
+                        if not json_str or json_str == "[DONE]":
+                            continue
                         
-                        except json.JSONDecodeError as e:
-                            print(f"JSON解析错误: {e}")
-                        except Exception as e:
-                            print(f"处理SSE时出错: {e}")
-                
-                # 标记流结束
-                response_queue.put("data: [DONE]\n\n")
-                response_queue.put(None)  # Signal end of stream
+                        if not (json_str.startswith('{') or json_str.startswith('[')):
+                            logger.debug(f"跳过无效的JSON行: {json_str}")
+                            continue
+                        
+                        data = json.loads(json_str)
+                        
+                        if "choices" in data and len(data["choices"]) > 0:
+                            delta = data["choices"][0].get("delta", {})
+                            content = delta.get("content", "")
+                            
+                            if content:
+                                # 通道写满时在此挂起，不再继续读取上游
+                                await response_channel.send(line)
+                    
+                    except ChannelClosed:
+                        raise
+                    except json.JSONDecodeError as e:
+                        logger.warning(f"JSON解析错误: {e}")
+                    except Exception as e:
+                        logger.warning(f"处理SSE时出错: {e}")
+            
+            # 标记流结束
+            await response_channel.send(DONE_FRAME)
+            response_channel.close()
+    except ChannelClosed:
+        # 消费者已离开，停止读取上游
+        return
     except httpx.RequestError as e:
         if str(e).startswith("Client disconnect"):
-            print("客户端主动断开连接")
+            logger.info("客户端主动断开连接")
             return
         error_msg = f"获取DeepSeek响应时出错: {str(e)}"
-        print(error_msg)
-        response_queue.put({"error": error_msg, "status_code": 500})
-        response_queue.put(None)
+        logger.warning(error_msg, extra={"endpoint": endpoint.name})
+        # 区分超时和连接失败，便于按类型统计上游错误
+        if isinstance(e, httpx.TimeoutException):
+            response_channel.fail(error_msg, 504)
+        elif isinstance(e, httpx.ConnectError):
+            response_channel.fail(error_msg, 502)
+        else:
+            response_channel.fail(error_msg, 500)
     except Exception as e:
         error_msg = f"获取DeepSeek响应时出错: {str(e)}"
-        print(error_msg)
-        response_queue.put({"error": error_msg, "status_code": 500})
-        response_queue.put(None)
+        logger.exception(error_msg)
+        response_channel.fail(error_msg, 500)
+
+
+# Azure 帧格式与 DeepSeek 保持一致：data: {"choices": [{"delta": {"content": ...}}]}
+AZURE_FRAME_PREFIX = b'data: {"choices": [{"delta": {"content": '
+AZURE_FRAME_SUFFIX = b'}}]}\n\n'
 
 
 async def fetch_azure_response(
@@ -193,129 +239,201 @@ async def fetch_azure_response(
     prompt: str, 
     max_tokens: int, 
     temperature: float,
-    response_queue: queue.Queue,
-    request: Request
+    response_channel: StreamChannel,
+    request: Optional[Request] = None,
+    endpoint: Optional[Endpoint] = None,
+    history: Optional[List[dict]] = None
 ):
-    """Fetch response from Azure OpenAI API using the official client"""
+    """Fetch response from Azure OpenAI API using the shared async client"""
+    endpoint = endpoint or default_azure_endpoint
     try:
-        client = AzureOpenAI(
-            api_key=AZURE_API_KEY,
-            api_version=AZURE_API_VERSION,
-            azure_endpoint=AZURE_ENDPOINT
-        )
+        client = get_azure_client(endpoint)
         
-        system_message = "你是一个AI助手，请根据用户的问题给出回答。"
-        
-        stream_resp = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=max(max_tokens, 4096),
+        stream_resp = await client.chat.completions.create(
+            model=endpoint.upstream_model(model),
+            messages=build_messages(SYSTEM_MESSAGE, prompt, history),
+            max_tokens=max_tokens,
             temperature=temperature,
             stream=True
         )
         
-        for chunk in stream_resp:
-            # 检查客户端是否已断开连接
-            if await request.is_disconnected():
-                print("客户端已断开连接")
-                break
-                
-            if chunk.choices and chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                response_data = {
-                    "choices": [{
-                        "delta": {
-                            "content": content
-                        }
-                    }]
-                }
-                sse_message = f"data: {json.dumps(response_data)}\n\n"
-                response_queue.put(sse_message)
-                print(sse_message)
+        async with stream_resp:
+            async for chunk in stream_resp:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    # 只序列化内容字符串，外层结构使用预先编码的字节
+                    content = json.dumps(chunk.choices[0].delta.content).encode("utf-8")
+                    await response_channel.send(AZURE_FRAME_PREFIX + content + AZURE_FRAME_SUFFIX)
                 
         # 发送结束标记
-        response_queue.put("data: [DONE]\n\n")
-        response_queue.put(None)
+        await response_channel.send(DONE_FRAME)
+        response_channel.close()
+    except ChannelClosed:
+        # 消费者已离开，停止读取上游
+        return
+    except APIStatusError as e:
+        # 上游的状态码原样上报：400/401/404/内容过滤等是请求本身的问题，不应计入部署故障
+        logger.warning(f"Error fetching Azure response: {e}",
+                       extra={"status": e.status_code, "endpoint": endpoint.name})
+        response_channel.fail(f"Error fetching Azure response: {str(e)}", e.status_code)
+    except APIConnectionError as e:
+        error_msg = f"Error fetching Azure response: {str(e)}"
+        logger.warning(error_msg, extra={"endpoint": endpoint.name})
+        # 与 DeepSeek 一致，区分超时和连接失败（APITimeoutError 是 APIConnectionError 的子类）
+        response_channel.fail(error_msg, 504 if isinstance(e, APITimeoutError) else 502)
     except Exception as e:
         if str(e).startswith("Client disconnect"):
-            print("客户端主动断开连接")
+            logger.info("客户端主动断开连接")
             return
-        response_queue.put({"error": f"Error fetching Azure response: {str(e)}", "status_code": 500})
-        response_queue.put(None)
-
-
-async def stream_from_queue(response_queue: queue.Queue):
-    """Stream responses from the queue"""
-    while True:
-        try:
-            item = response_queue.get_nowait()
-            
-            if item is None:  # End of stream
-                break
-            
-            if isinstance(item, dict) and "error" in item:  # Error occurred
-                raise HTTPException(status_code=item.get("status_code", 500), detail=item["error"])
-            
-            # 直接发送item，不额外添加data:前缀（如果是DeepSeek原始响应，已经包含data:前缀）
-            if isinstance(item, str) and item.startswith("data: "):
-                yield item + "\n\n"
-            else:
-                yield f"data: {item}\n\n"
-            
-            response_queue.task_done()
-        except queue.Empty:  # Add specific exception handling for empty queue
-            await asyncio.sleep(0.01)
-        except Exception as e:
-            print(f"stream_from_queue中出错: {e}")
-            break
-
+        logger.exception(f"Error fetching Azure response: {e}", extra={"endpoint": endpoint.name})
+        response_channel.fail(f"Error fetching Azure response: {str(e)}", 500)
+
+
+# CASSETTE_MODE=record/replay 时录制或回放上游流，关闭时原样注册
+model_router.register_provider("deepseek", cassette.wrap("deepseek", fetch_deepseek_response))
+model_router.register_provider("azure", cassette.wrap("azure", fetch_azure_response))
+load_routes_from_env(model_router)
+
+
+async def open_chat_stream(
+    chat_request: ChatRequest,
+    client: str,
+    priority: str,
+    bypass_cache: bool = False,
+    request: Optional[Request] = None
+) -> Tuple[Optional[List[Any]], Any, Dict[str, str]]:
+    """校验模型、查缓存、准入调度并启动（或加入）上游生成，SSE 与 WebSocket 共用
+
+    返回 (缓存命中的帧, 通道, 响应头)，前两者只有一个不为 None；通道的消费端可交给 stream_from_channel。
+    排队超时等错误以 HTTPException 抛出。
+    """
+    if not model_router.has_model(chat_request.model):
+        raise HTTPException(status_code=400, detail=f"Unsupported model: {chat_request.model}")
+    # 开启对冲时，首token超时后会向备选部署/模型再发一次
+    fetch_response = hedger.stream if hedger.enabled else model_router.stream
+    # 按模型上下文窗口收紧max_tokens，避免超长请求被上游拒绝
+    _, max_tokens = context_builder.build(chat_request.model, chat_request.prompt, max_tokens=chat_request.max_tokens)
+    
+    # 与上游实际使用的max_tokens保持一致
+    request_key = ResponseCache.make_key(
+        chat_request.model,
+        chat_request.prompt,
+        chat_request.temperature,
+        max_tokens
+    )
+    
+    headers = {}
+    on_done = None
+    if response_cache.is_cacheable(chat_request.model):
+        if bypass_cache:
+            response_cache.note_bypass()
+            headers["X-Cache"] = "BYPASS"
+        else:
+            frames = await response_cache.get(request_key)
+            if frames is not None:
+                return frames, None, {"X-Cache": "HIT"}
+            headers["X-Cache"] = "MISS"
+        on_done = response_cache.store_callback(request_key, chat_request.model)
+    
+    # 准入控制：按模型限制并发，排队按优先级和用户公平调度，排队超时返回429
+    # 合并到进行中生成的请求不占用上游并发，无需排队
+    slot = None
+    if not (single_flight.enabled and single_flight.is_inflight(request_key)):
+        slot = await upstream_scheduler.acquire(chat_request.model, client, priority)
+    started = False
+    
+    def start_upstream(channel, client_request=None):
+        nonlocal started
+        started = True
+        upstream = fetch_response(
+            chat_request.model, 
+            chat_request.prompt, 
+            max_tokens, 
+            chat_request.temperature, 
+            channel,
+            client_request
+        )
+        return slot.hold(upstream) if slot is not None else upstream
+    
+    if single_flight.enabled:
+        # 相同的并发请求共享同一个上游生成；上游生命周期由订阅者数量决定，不绑定单个客户端
+        response_channel = single_flight.join(request_key, start_upstream, on_done=on_done)
+        if slot is not None and not started:
+            # 排队期间已有相同请求开始生成，直接加入，归还槽位
+            slot.release()
+    else:
+        if on_done is not None:
+            response_channel = RecordingChannel(on_done)
+        else:
+            response_channel = StreamChannel()
+        # 客户端离开、超时或空闲过久时取消上游任务
+        upstream_supervisor.spawn(
+            response_channel,
+            lambda channel: start_upstream(channel, request),
+            label=chat_request.model
+        )
+    return None, response_channel, headers
+
+
+@app.post("/api/v1/tools/chat", dependencies=[Depends(accepting_chats)])
+async def chat(request: Request, chat_request: ChatRequest, last_event_id: Optional[str] = Header(None)):
+    """Chat endpoint that streams responses from the selected model API
+
+    resumable 为 true 时每个事件带 id；连接中断后带上最后收到的 Last-Event-ID 重新请求，
+    补发错过的帧后接上仍在进行的生成，而不是重新生成一遍。
+    """
+    if last_event_id:
+        cursor = resumable_streams.resume(last_event_id)
+        if cursor is None:
+            # 流已结束并过期、需要的帧已被丢弃，或重连落到了另一个工作进程
+            raise HTTPException(status_code=410, detail="Stream can no longer be resumed, please resend")
+        logger.info("续传聊天流", extra={"stream_id": cursor.stream_id, "last_event_id": last_event_id})
+        return StreamingResponse(
+            stream_from_channel(cursor),
+            media_type="text/event-stream",
+            headers={"X-Stream-ID": cursor.stream_id}
+        )
 
-@app.post("/api/v1/tools/chat")
-async def chat(request: Request, chat_request: ChatRequest):
-    """Chat endpoint that streams responses from the selected model API"""
     try:
-        response_queue = queue.Queue()
-        
-        if chat_request.model in ["DeepSeek-V3", "DeepSeek-R1"]:
-            t_openai = asyncio.create_task(fetch_deepseek_response(
-                chat_request.model, 
-                chat_request.prompt, 
-                chat_request.max_tokens, 
-                chat_request.temperature, 
-                response_queue,
-                request
-            ))
-            
-            return StreamingResponse(
-                stream_from_queue(response_queue),
-                media_type="text/event-stream"
-            )
-        elif chat_request.model in ["gpt-4o-mini", "gpt-4o"]:
-            t_deepseek = asyncio.create_task(fetch_azure_response(
-                chat_request.model, 
-                chat_request.prompt, 
-                chat_request.max_tokens, 
-                chat_request.temperature, 
-                response_queue,
-                request
-            ))
-            
+        frames, response_channel, headers = await open_chat_stream(
+            chat_request,
+            client_key(request),
+            request_priority(request, chat_request.feature),
+            bypass_cache=response_cache.is_bypass(request),
+            request=request
+        )
+        if frames is not None:
             return StreamingResponse(
-                stream_from_queue(response_queue),
-                media_type="text/event-stream"
+                response_cache.replay(frames),
+                media_type="text/event-stream",
+                headers=headers
             )
-        else:
-            raise HTTPException(status_code=400, detail=f"Unsupported model: {chat_request.model}")
+        
+        if chat_request.resumable:
+            # 生成与连接解耦：断线后在宽限期内继续，重连时从环形缓冲补发
+            stream = resumable_streams.create(response_channel)
+            headers["X-Stream-ID"] = stream.id
+            response_channel = stream.attach()
+        
+        return StreamingResponse(
+            stream_from_channel(response_channel),
+            media_type="text/event-stream",
+            headers=headers
+        )
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"Error during chat: {e}")
+        logger.exception(f"Error during chat: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+@app.delete("/api/v1/tools/chat/{stream_id}")
+async def cancel_chat_stream(stream_id: str):
+    """停止可续传的生成；否则断开连接后生成还会在宽限期内继续"""
+    if not resumable_streams.cancel(stream_id):
+        raise HTTPException(status_code=404, detail="Stream not found")
+    return {"code": 200, "msg": "success"}
+
+
 async def main():
     # response = await chat(ChatRequest(model="gpt-4o-mini", prompt="你好"))
     response = await chat(ChatRequest(model="DeepSeek-R1", prompt="你好"))
@@ -0,0 +1,285 @@
+"""/api/v1/tools/chat 压测：启动本地模拟上游和 main:app，并发打开SSE流并统计
+
+    python benchmark.py --concurrency 100 --requests 500 --model DeepSeek-V3
+    python benchmark.py --concurrency 100 --save-baseline bench_baseline.json
+    python benchmark.py --concurrency 100 --baseline bench_baseline.json
+    python benchmark.py --server-env CASSETTE_MODE=replay --server-env CASSETTE_MATCH=model \
+        --server-env CASSETTE_FILE=upstream.cassette.jsonl.gz
+
+最后一种用录制好的真实上游流（见 cassette.py）代替模拟上游的生成节奏。
+
+报告包括吞吐、首token延迟和token间隔的分位数、每个流的CPU时间和内存占用，
+指定 --baseline 时与保存的基线逐项对比。CPU/内存读取 /proc，仅支持Linux。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# 与基线对比时，越小越好的指标（其余指标越大越好）
+LOWER_IS_BETTER = ("ttft", "itl", "latency", "elapsed", "cpu", "rss", "error")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def _cpu_seconds(pid: int) -> float:
+    """进程累计的用户态+内核态CPU时间"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def _rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+async def _wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url, timeout=1)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"服务未就绪: {url}")
+
+
+class StreamResult:
+    __slots__ = ("ok", "status", "ttft", "gaps", "tokens", "latency", "error")
+
+    def __init__(self):
+        self.ok = False
+        self.status = 0
+        self.ttft: Optional[float] = None
+        self.gaps: List[float] = []
+        self.tokens = 0
+        self.latency = 0.0
+        self.error = ""
+
+
+async def run_stream(client: httpx.AsyncClient, url: str, payload: dict, read_delay: float) -> StreamResult:
+    """打开一个SSE流，记录首token时间和每个内容事件之间的间隔"""
+    result = StreamResult()
+    started = time.monotonic()
+    last = None
+    try:
+        async with client.stream("POST", url, json=payload) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                result.error = f"http_{response.status_code}"
+                await response.aread()
+                return result
+            buffer = b""
+            async for data in response.aiter_bytes():
+                now = time.monotonic()
+                buffer += data
+                *events, buffer = buffer.split(b"\n\n")
+                for event in events:
+                    if not event.startswith(b"data: ") or event == b"data: [DONE]":
+                        continue
+                    if b'"content"' not in event:
+                        continue
+                    result.tokens += 1
+                    if last is None:
+                        result.ttft = now - started
+                    else:
+                        result.gaps.append(now - last)
+                    last = now
+                if read_delay:
+                    # 模拟慢客户端
+                    await asyncio.sleep(read_delay)
+        result.ok = result.tokens > 0
+        if not result.ok:
+            result.error = "empty"
+    except httpx.HTTPError as e:
+        result.error = type(e).__name__
+    finally:
+        result.latency = time.monotonic() - started
+    return result
+
+
+async def load(args, app_url: str, server_pid: Optional[int]) -> dict:
+    url = f"{app_url}/api/v1/tools/chat"
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results: List[StreamResult] = []
+    counter = iter(range(args.requests))
+    peak_rss = 0
+    idle_rss = _rss_bytes(server_pid) if server_pid else 0
+    cpu_before = _cpu_seconds(server_pid) if server_pid else 0.0
+
+    async def worker(slow: bool):
+        for index in counter:
+            prompt = args.prompt if args.same_prompt else f"{args.prompt} #{index} {random.random()}"
+            payload = {"model": args.model, "prompt": prompt, "max_tokens": args.max_tokens}
+            results.append(await run_stream(client, url, payload, args.slow_delay if slow else 0))
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, _rss_bytes(server_pid))
+            await asyncio.sleep(0.1)
+
+    slow_count = int(args.concurrency * args.slow_clients)
+    sampler = asyncio.create_task(sample_rss()) if server_pid else None
+    started = time.monotonic()
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(args.timeout)) as client:
+        await asyncio.gather(*[worker(i < slow_count) for i in range(args.concurrency)])
+    elapsed = time.monotonic() - started
+    if sampler is not None:
+        sampler.cancel()
+    cpu_used = _cpu_seconds(server_pid) - cpu_before if server_pid else 0.0
+
+    ok = [r for r in results if r.ok]
+    ttfts = [r.ttft for r in ok if r.ttft is not None]
+    gaps = [g for r in ok for g in r.gaps]
+    latencies = [r.latency for r in ok]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r.ok:
+            errors[r.error] = errors.get(r.error, 0) + 1
+
+    report = {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "streams_per_s": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "tokens_per_s": round(sum(r.tokens for r in ok) / elapsed, 1) if elapsed else 0.0,
+    }
+    for name, values in (("ttft", ttfts), ("itl", gaps), ("latency", latencies)):
+        for p in (50, 90, 99):
+            report[f"{name}_p{p}_ms"] = round(_percentile(values, p) * 1000, 2)
+    if server_pid:
+        report["cpu_ms_per_stream"] = round(cpu_used / len(results) * 1000, 3) if results else 0.0
+        report["rss_idle_mb"] = round(idle_rss / 1024 / 1024, 1)
+        report["rss_peak_mb"] = round(peak_rss / 1024 / 1024, 1)
+        report["rss_kb_per_stream"] = round((peak_rss - idle_rss) / 1024 / args.concurrency, 1)
+    return report
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> List[str]:
+    """逐项对比，变差超过 threshold 的指标标记为回退"""
+    lines = []
+    for key, value in report.items():
+        old = baseline.get(key)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+            continue
+        change = (value - old) / old if old else 0.0
+        worse = change > threshold if any(k in key for k in LOWER_IS_BETTER) else change < -threshold
+        flag = "  <-- 回退" if worse else ""
+        lines.append(f"{key:24s} {old:>12} -> {value:>12} ({change:+.1%}){flag}")
+    return lines
+
+
+def _start_process(args_list: List[str], env: dict) -> subprocess.Popen:
+    return subprocess.Popen(args_list, cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def main(args):
+    processes = []
+    try:
+        app_url = args.url
+        server_pid = None
+        if not app_url:
+            mock_port = _free_port()
+            app_port = _free_port()
+            env = dict(os.environ)
+            processes.append(_start_process([
+                sys.executable, "mock_upstream.py", "--port", str(mock_port),
+                "--ttft", str(args.ttft), "--tps", str(args.tps), "--tokens", str(args.tokens),
+                "--error-rate", str(args.error_rate), "--disconnect-rate", str(args.disconnect_rate),
+            ], env))
+            mock_url = f"http://127.0.0.1:{mock_port}"
+            env.update({
+                "DEEPSEEK_API_URL": f"{mock_url}/api/chat/completions",
+                "AZURE_ENDPOINT": f"{mock_url}/",
+                "DB_POOL_MIN_SIZE": "0",
+                "SCHEDULER_DEFAULT_LIMIT": str(args.concurrency),
+                "SCHEDULER_MAX_QUEUE": str(args.requests),
+            })
+            for item in args.server_env:
+                key, value = item.split("=", 1)
+                env[key] = value
+            processes.append(_start_process([
+                sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port),
+                "--log-level", "warning", "--no-access-log",
+            ], env))
+            app_url = f"http://127.0.0.1:{app_port}"
+            await _wait_ready(f"{mock_url}/")
+            await _wait_ready(f"{app_url}/v1/models")
+            server_pid = processes[-1].pid
+
+        report = await load(args, app_url, server_pid)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存到 {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        lines = compare(report, baseline, args.threshold)
+        print("\n与基线对比:")
+        print("\n".join(lines))
+        if any("回退" in line for line in lines):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/api/v1/tools/chat 压测")
+    parser.add_argument("--url", help="压测已在运行的服务，不启动本地模拟上游和应用")
+    parser.add_argument("--concurrency", type=int, default=50, help="并发SSE客户端数")
+    parser.add_argument("--requests", type=int, default=200, help="总请求数")
+    parser.add_argument("--model", default="DeepSeek-V3")
+    parser.add_argument("--prompt", default="你好")
+    parser.add_argument("--same-prompt", action="store_true", help="所有请求使用相同的提示（测试请求合并/缓存）")
+    parser.add_argument("--max-tokens", type=int, default=512)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--slow-clients", type=float, default=0, help="慢客户端比例")
+    parser.add_argument("--slow-delay", type=float, default=0.05, help="慢客户端每次读取后的停顿（秒）")
+    parser.add_argument("--ttft", type=float, default=0.3, help="模拟上游首token延迟（秒）")
+    parser.add_argument("--tps", type=float, default=50, help="模拟上游每秒token数")
+    parser.add_argument("--tokens", type=int, default=200, help="模拟上游每次回复的token数")
+    parser.add_argument("--error-rate", type=float, default=0, help="模拟上游直接报错的比例")
+    parser.add_argument("--disconnect-rate", type=float, default=0, help="模拟上游中途断开的比例")
+    parser.add_argument("--server-env", action="append", default=[], help="传给被测服务的环境变量 KEY=VALUE")
+    parser.add_argument("--save-baseline", help="把本次结果保存为基线")
+    parser.add_argument("--baseline", help="与已保存的基线对比，有回退时以非零状态退出")
+    parser.add_argument("--threshold", type=float, default=0.1, help="判定回退的变化比例")
+    asyncio.run(main(parser.parse_args()))
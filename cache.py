@@ -0,0 +1,88 @@
+import collections
+import time
+from typing import Any, Hashable, Optional
+
+# 未命中时 get() 的返回值，用来和缓存的 None（负缓存）区分
+MISS = object()
+
+
+class TTLCache:
+    """进程内带过期时间的LRU缓存
+
+    - 超过 maxsize 条或 max_bytes 字节时淘汰最久未使用的条目
+    - 每个条目可以单独指定TTL，None 值可用于负缓存
+    """
+
+    def __init__(self, maxsize: int, ttl: float, max_bytes: Optional[int] = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> (过期时间, 值, 字节数)
+        self._data: "collections.OrderedDict[Hashable, tuple]" = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISS
+        expires_at, value, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return MISS
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, size: int = 0):
+        """写入条目；size 为该条目占用的字节数，仅在设置了 max_bytes 时参与淘汰"""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._remove(key)
+        self._data[key] = (time.monotonic() + ttl, value, size)
+        self._bytes += size
+        while len(self._data) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+            _, (_, _, evicted_size) = self._data.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _remove(self, key: Hashable) -> bool:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[2]
+        return True
+
+    def invalidate(self, key: Hashable):
+        if self._remove(key):
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self._data)
+        self._data.clear()
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
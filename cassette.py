@@ -0,0 +1,209 @@
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from fastapi import Request
+
+from logs import get_logger
+from stats import register_stats
+from streaming import ChannelClosed, encode_frame
+
+logger = get_logger(__name__)
+
+# 上游流量录制/回放：record 录制真实上游，replay 从录制文件回放而不访问网络，为空时关闭
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "").lower()
+# 录制文件，追加写入，每行一条完整的流；以 .gz 结尾时每条记录追加为一个gzip成员
+CASSETTE_FILE = os.getenv("CASSETTE_FILE", "upstream.cassette.jsonl.gz")
+# 回放速度倍数：1 为原始节奏，10 为压缩到十分之一，0 为不等待
+CASSETTE_SPEED = float(os.getenv("CASSETTE_SPEED", "1"))
+# 回放时的匹配方式：key 按请求精确匹配，model 按模型轮流取，any 不区分模型轮流取（适合压测）
+CASSETTE_MATCH = os.getenv("CASSETTE_MATCH", "key").lower()
+
+
+def cassette_key(model: str, prompt: str, max_tokens: int, temperature: float,
+                 history: Optional[List[dict]] = None) -> str:
+    raw = json.dumps(
+        [model, history or [], prompt, int(max_tokens), round(float(temperature), 2)],
+        ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class _TapChannel:
+    """转发给下游通道的同时记录每一帧及其相对时间（毫秒）"""
+
+    def __init__(self, target):
+        self._target = target
+        self._started = time.monotonic()
+        self.chunks: List[list] = []
+        self.error: Optional[list] = None
+        self.finished = False
+
+    @property
+    def closed(self) -> bool:
+        return self._target.closed
+
+    async def send(self, item):
+        offset = int((time.monotonic() - self._started) * 1000)
+        self.chunks.append([offset, encode_frame(item).decode("utf-8", "replace")])
+        await self._target.send(item)
+
+    def close(self):
+        self.finished = True
+        self._target.close()
+
+    def fail(self, detail: str, status_code: int = 500):
+        self.finished = True
+        self.error = [status_code, detail]
+        self._target.fail(detail, status_code)
+
+
+class Cassette:
+    """按提供方包装流式函数，实现录制和回放"""
+
+    def __init__(self):
+        self.mode = CASSETTE_MODE
+        self.path = CASSETTE_FILE
+        self.speed = CASSETTE_SPEED
+        self.match = CASSETTE_MATCH
+        self._write_lock = threading.Lock()
+        self._index: Optional[Dict[str, List[dict]]] = None
+        self._cycles: Dict[str, "itertools.cycle"] = {}
+        self._stats = {
+            "recorded": 0,
+            "replayed": 0,
+            "misses": 0,
+            "write_errors": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("record", "replay")
+
+    def wrap(self, provider_name: str, provider):
+        """返回与 provider 签名相同的流式函数"""
+        if self.mode == "record":
+            async def recording(model, prompt, max_tokens, temperature, response_channel,
+                                request: Optional[Request] = None, endpoint=None, history=None):
+                tap = _TapChannel(response_channel)
+                try:
+                    await provider(model, prompt, max_tokens, temperature, tap, request,
+                                   endpoint=endpoint, history=history)
+                finally:
+                    # 消费者中途离开的不完整流不录制
+                    if tap.finished:
+                        await self._append({
+                            "key": cassette_key(model, prompt, max_tokens, temperature, history),
+                            "model": model,
+                            "provider": provider_name,
+                            "endpoint": endpoint.name if endpoint is not None else provider_name,
+                            "recorded_at": int(time.time()),
+                            "chunks": tap.chunks,
+                            "error": tap.error,
+                        })
+            return recording
+
+        if self.mode == "replay":
+            async def replaying(model, prompt, max_tokens, temperature, response_channel,
+                                request: Optional[Request] = None, endpoint=None, history=None):
+                await self.replay(cassette_key(model, prompt, max_tokens, temperature, history),
+                                  model, response_channel)
+            return replaying
+
+        return provider
+
+    def _write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._write_lock, _open(self.path, "a") as f:
+            f.write(line)
+
+    async def _append(self, record: dict):
+        try:
+            await asyncio.to_thread(self._write, record)
+            self._stats["recorded"] += 1
+        except OSError as e:
+            self._stats["write_errors"] += 1
+            logger.error(f"写入录制文件失败: {e}")
+
+    def _load(self) -> Dict[str, List[dict]]:
+        """读取录制文件，按请求键、模型和全部记录建立索引"""
+        index: Dict[str, List[dict]] = {}
+        if os.path.exists(self.path):
+            with _open(self.path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 进程被杀时可能留下半行，跳过
+                        continue
+                    index.setdefault(f"key:{record['key']}", []).append(record)
+                    index.setdefault(f"model:{record['model']}", []).append(record)
+                    index.setdefault("any", []).append(record)
+        logger.info(f"从 {self.path} 加载了 {len(index.get('any', []))} 条录制")
+        return index
+
+    def _pick(self, key: str, model: str) -> Optional[dict]:
+        if self._index is None:
+            self._index = self._load()
+        lookup = {"key": f"key:{key}", "model": f"model:{model}", "any": "any"}.get(self.match, f"key:{key}")
+        records = self._index.get(lookup)
+        if not records:
+            return None
+        cycle = self._cycles.get(lookup)
+        if cycle is None:
+            cycle = self._cycles[lookup] = itertools.cycle(records)
+        return next(cycle)
+
+    async def replay(self, key: str, model: str, response_channel):
+        record = self._pick(key, model)
+        if record is None:
+            self._stats["misses"] += 1
+            response_channel.fail(f"No cassette recording for model {model}", 404)
+            return
+        self._stats["replayed"] += 1
+        started = time.monotonic()
+        try:
+            for offset, frame in record["chunks"]:
+                if self.speed > 0:
+                    delay = started + offset / 1000 / self.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await response_channel.send(frame.encode("utf-8"))
+        except ChannelClosed:
+            return
+        if record.get("error"):
+            status_code, detail = record["error"]
+            response_channel.fail(detail, status_code)
+        else:
+            response_channel.close()
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode or "off",
+            "file": self.path if self.enabled else None,
+            "speed": self.speed,
+            "match": self.match,
+            **self._stats,
+        }
+
+
+cassette = Cassette()
+register_stats("cassette", cassette.stats)
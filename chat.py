@@ -1,12 +1,18 @@
 from typing import List
 import asyncio
-import queue
+from fastapi import Depends, HTTPException
 from fastapi.responses import StreamingResponse
-from openai import AzureOpenAI
 from pydantic import BaseModel, Field
 
-from backend import AZURE_API_KEY, AZURE_API_VERSION, AZURE_ENDPOINT
+from backend import build_messages, get_azure_client
 from base import app
+from context import SYSTEM_MESSAGE, context_builder
+from lifecycle import accepting_chats
+from logs import get_logger
+from supervisor import upstream_supervisor
+from streaming import ChannelClosed, StreamChannel, stream_from_channel
+
+logger = get_logger(__name__)
 
 
 class ChatRequest(BaseModel):
@@ -30,41 +36,41 @@ class ResponseModel(BaseModel):
     data: str = Field("", description="response data")
 
 
-@app.post("/api/v1/chat")
+@app.post("/api/v1/chat", dependencies=[Depends(accepting_chats)])
 async def chat(request: ChatRequest):
     try:
-        client = AzureOpenAI(
-            api_key=AZURE_API_KEY,
-            api_version=AZURE_API_VERSION,
-            azure_endpoint=AZURE_ENDPOINT
-        )
+        client = get_azure_client()
         if not request.messages or not "role" in request.messages[0] or not "content" in request.messages[0]:
             return ResponseModel(data="", code=400, msg="Invalid request")
 
-        history = "\n".join([f"{m.get('role', '')}: {m.get('content', '')}" for m in request.messages])
-        p_sys = f"You are a helpful assistant, you need to response to the user based on the chat history {history}"
+        # 历史按原有角色传给模型，超出预算的较早轮次压缩为摘要，max_tokens按剩余窗口收紧
+        messages = [{"role": m.get("role", "user"), "content": m.get("content", "")} for m in request.messages]
+        # 最后一条必须是本轮的用户消息，否则会拼出空的用户轮次
+        if messages[-1]["role"] != "user":
+            return ResponseModel(data="", code=400, msg="Last message must be from the user")
+        prompt = messages.pop()["content"]
+        history, max_tokens = context_builder.build(request.model_name, prompt, messages, max_tokens=request.max_tokens)
 
-        resp = client.chat.completions.create(
+        resp = await client.chat.completions.create(
             model=request.model_name,
-            messages=[{"role": "assistant", "content": p_sys}],
-            max_tokens=max(request.max_tokens, 4096)
+            messages=build_messages(SYSTEM_MESSAGE, prompt, history),
+            max_tokens=max_tokens
         )
         return ResponseModel(data=resp.choices[0].message.content, code=200, msg="success") # type: ignore
+    except HTTPException as e:
+        # 提示过长等请求错误原样返回，不当作生成失败
+        return ResponseModel(data="", code=e.status_code, msg=str(e.detail))
     except Exception as e:
-        print(f"Error during chat: {e}")
+        logger.exception(f"Error during chat: {e}")
         return ResponseModel(data="", code=500, msg="llm generated failed")
 
 
-async def fetch_azure_stream(prompt: str, response_queue: queue.Queue):
+async def fetch_azure_stream(prompt: str, response_channel: StreamChannel):
     """获取Azure OpenAI流式响应"""
     try:
-        client = AzureOpenAI(
-            api_key=AZURE_API_KEY,
-            api_version=AZURE_API_VERSION,
-            azure_endpoint=AZURE_ENDPOINT
-        )
+        client = get_azure_client()
         
-        stream_resp = client.chat.completions.create(
+        stream_resp = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=4096,
@@ -72,56 +78,44 @@ async def fetch_azure_stream(prompt: str, response_queue: queue.Queue):
             stream=True
         )
         
-        for chunk in stream_resp:
-            if chunk.choices and chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                response_queue.put(content)
+        async with stream_resp:
+            async for chunk in stream_resp:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content = chunk.choices[0].delta.content
+                    await response_channel.send(content)
         
         # 信号流结束
-        response_queue.put(None)
+        response_channel.close()
+    except ChannelClosed:
+        # 消费者已离开，停止读取上游
+        return
     except Exception as e:
-        print(f"Error fetching Azure stream: {e}")
-        response_queue.put(None)
-
-
-async def stream_from_queue(response_queue: queue.Queue):
-    """从队列中流式传输响应"""
-    while True:
-        try:
-            item = response_queue.get_nowait()
-            
-            if item is None:  # 流结束
-                break
-            
-            # 确保返回的是字符串类型，并格式化为SSE格式
-            yield f"data: {item}\n\n"
-            
-            response_queue.task_done()
-        except queue.Empty:
-            await asyncio.sleep(0.01)
-        except Exception as e:
-            print(f"Error in stream_from_queue: {e}")
-            break
-
-
-@app.post("/api/v1/tools/chat")
+        logger.warning(f"Error fetching Azure stream: {e}")
+        response_channel.close()
+
+
+@app.post("/api/v1/tools/chat", dependencies=[Depends(accepting_chats)])
 async def tools_chat(request: ToolsChatRequest):
     """提供流式聊天响应的API端点"""
     try:
-        print(f"收到聊天请求: {request}")
-        # 创建响应队列
-        response_queue = queue.Queue()
+        logger.debug("收到聊天请求", extra={"model": request.model, "prompt_chars": len(request.prompt)})
+        # 创建响应通道
+        response_channel = StreamChannel()
         
         # 启动后台任务获取流式响应
-        asyncio.create_task(fetch_azure_stream(request.prompt, response_queue))
+        upstream_supervisor.spawn(
+            response_channel,
+            lambda channel: fetch_azure_stream(request.prompt, channel),
+            label="gpt-4o-mini"
+        )
         
         # 返回流式响应
         return StreamingResponse(
-            stream_from_queue(response_queue),
+            stream_from_channel(response_channel),
             media_type="text/event-stream"
         )
     except Exception as e:
-        print(f"Error in tools_chat: {e}")
+        logger.exception(f"Error in tools_chat: {e}")
         return ResponseModel(code=500, msg=f"Error: {str(e)}")
 
 
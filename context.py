@@ -0,0 +1,376 @@
+import asyncio
+import hashlib
+import math
+import os
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from base import app
+from cache import MISS, TTLCache
+from logs import get_logger
+from router import model_router
+from scheduler import upstream_scheduler
+from stats import register_stats
+from streaming import StreamChannel, frames_text
+
+try:
+    import tiktoken
+except ImportError:  # requirements.txt 中已包含；未安装时按字符数估算
+    tiktoken = None
+
+logger = get_logger(__name__)
+
+SYSTEM_MESSAGE = "你是一个AI助手，请根据用户的问题给出回答。"
+
+# 各模型的上下文窗口（输入+输出token数），可用 CONTEXT_WINDOWS="DeepSeek-R1=65536,gpt-4o=128000" 覆盖
+DEFAULT_CONTEXT_WINDOWS = {
+    "DeepSeek-V3": 65536,
+    "DeepSeek-R1": 65536,
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+}
+CONTEXT_WINDOWS = os.getenv("CONTEXT_WINDOWS", "")
+CONTEXT_DEFAULT_WINDOW = int(os.getenv("CONTEXT_DEFAULT_WINDOW", "32768"))
+# 历史最多占用的输入token数，0 表示只受窗口限制；限制历史长度可以降低长会话的延迟和费用
+CONTEXT_HISTORY_BUDGET = int(os.getenv("CONTEXT_HISTORY_BUDGET", "8000"))
+# 为输出预留的token数上限（请求的 max_tokens 更小时按请求值预留），以及最少保留的输出token数
+CONTEXT_OUTPUT_RESERVE = int(os.getenv("CONTEXT_OUTPUT_RESERVE", "4096"))
+CONTEXT_MIN_OUTPUT_TOKENS = int(os.getenv("CONTEXT_MIN_OUTPUT_TOKENS", "256"))
+# token计数误差的安全余量
+CONTEXT_SAFETY_MARGIN = int(os.getenv("CONTEXT_SAFETY_MARGIN", "64"))
+# 没有分词器、按字符数估算时，余量按输入token数的比例放大（英文和代码通常被低估）
+CONTEXT_ESTIMATE_MARGIN = float(os.getenv("CONTEXT_ESTIMATE_MARGIN", "0.1"))
+# 始终原样保留的最近消息数（放得下时）
+CONTEXT_KEEP_RECENT = int(os.getenv("CONTEXT_KEEP_RECENT", "6"))
+# 较早对话的摘要长度上限，以及生成摘要使用的模型（为空时用当前模型）
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "512"))
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "")
+CONTEXT_SUMMARY_MIN_PENDING = int(os.getenv("CONTEXT_SUMMARY_MIN_PENDING", "4"))
+CONTEXT_SUMMARY_CACHE_SIZE = int(os.getenv("CONTEXT_SUMMARY_CACHE_SIZE", "10000"))
+CONTEXT_SUMMARY_TTL = float(os.getenv("CONTEXT_SUMMARY_TTL", "86400"))
+# token计数缓存占用的内存上限（字节）
+CONTEXT_TOKEN_CACHE_BYTES = int(os.getenv("CONTEXT_TOKEN_CACHE_BYTES", str(16 * 1024 * 1024)))
+
+# 每条消息在对话格式中的额外开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+# 摘要未生成前，每条较早消息在临时摘要中保留的字符数
+EXCERPT_CHARS = 100
+
+SUMMARY_PROMPT = (
+    "请把下面的对话压缩成一段简洁的摘要，保留用户的目标、已确认的事实、关键结论和未解决的问题，"
+    "不要添加对话中没有的内容。\n\n"
+)
+
+_CJK = re.compile("[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+def _parse_windows(value: str) -> Dict[str, int]:
+    windows = dict(DEFAULT_CONTEXT_WINDOWS)
+    for item in value.split(","):
+        if "=" in item:
+            model, window = item.split("=", 1)
+            windows[model.strip()] = int(window)
+    return windows
+
+
+def _estimate_tokens(text: str) -> int:
+    """没有分词器时的估算：中日韩字符按1个token，其余按4个字符1个token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+# 模型 -> text -> token数 的计数函数；分词器在线程中加载，加载完成前用估算
+_tokenizers: Dict[str, Callable[[str], int]] = {}
+_loading: Dict[str, asyncio.Task] = {}
+
+
+def _load_tokenizer(model: str) -> Callable[[str], int]:
+    """初始化分词器（首次会下载BPE文件，不要在事件循环中调用）；任何失败都退回估算"""
+    if tiktoken is None or not model.startswith("gpt"):
+        return _estimate_tokens
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"加载 {model} 的分词器失败，按字符数估算: {e!r}")
+        return _estimate_tokens
+    # 特殊标记按普通文本计数，不报错
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+async def _load_in_thread(model: str):
+    try:
+        _tokenizers[model] = await asyncio.to_thread(_load_tokenizer, model)
+    finally:
+        _loading.pop(model, None)
+
+
+def get_tokenizer(model: str) -> Callable[[str], int]:
+    """返回模型的计数函数；尚未加载的模型先用估算，并在后台加载"""
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is not None:
+        return tokenizer
+    if tiktoken is None or not model.startswith("gpt"):
+        _tokenizers[model] = _estimate_tokens
+        return _estimate_tokens
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # 不在事件循环中（脚本调用）时直接加载
+        _tokenizers[model] = _load_tokenizer(model)
+        return _tokenizers[model]
+    if model not in _loading:
+        _loading[model] = asyncio.create_task(_load_in_thread(model))
+    return _estimate_tokens
+
+
+# 按文本摘要缓存token数：键只有固定长度的摘要，不持有原文，内存按字节数限制
+_TOKEN_CACHE_ENTRY_BYTES = 200
+_token_counts = TTLCache(
+    maxsize=CONTEXT_TOKEN_CACHE_BYTES // _TOKEN_CACHE_ENTRY_BYTES,
+    ttl=CONTEXT_SUMMARY_TTL,
+    max_bytes=CONTEXT_TOKEN_CACHE_BYTES
+)
+
+
+def count_tokens(model: str, text: str) -> int:
+    tokenizer = get_tokenizer(model)
+    # 估算结果不和分词器结果混用，分词器加载完成后重新计数
+    key = (model, tokenizer is _estimate_tokens, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+    count = _token_counts.get(key)
+    if count is MISS:
+        count = tokenizer(text)
+        _token_counts.set(key, count, size=_TOKEN_CACHE_ENTRY_BYTES)
+    return count
+
+
+def _with_margin(tokens: int, estimated: bool) -> int:
+    """输入token数加上安全余量；估算的计数误差随长度增长，余量按比例计算"""
+    margin = CONTEXT_SAFETY_MARGIN
+    if estimated:
+        margin = max(margin, math.ceil(tokens * CONTEXT_ESTIMATE_MARGIN))
+    return tokens + margin
+
+
+def count_message_tokens(model: str, message: dict) -> int:
+    return count_tokens(model, message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _fingerprint(message: dict) -> str:
+    raw = f"{message['role']}\x00{message['content']}".encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+def _summary_message(text: str) -> dict:
+    return {"role": "system", "content": f"以下是之前对话的摘要：\n{text}"}
+
+
+def _transcript(messages: List[dict]) -> str:
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+
+class ContextBuilder:
+    """按token预算组装上下文
+
+    最近的消息原样保留；放不下的较早消息用滚动摘要代替。摘要在后台用上游模型生成并缓存，
+    每次只把新滑出窗口的消息并入已有摘要；摘要生成前先用截断的节选顶替。
+    """
+
+    def __init__(self):
+        self.windows = _parse_windows(CONTEXT_WINDOWS)
+        # key -> (摘要覆盖的最后一条消息的指纹, 摘要文本)
+        self.summaries = TTLCache(maxsize=CONTEXT_SUMMARY_CACHE_SIZE, ttl=CONTEXT_SUMMARY_TTL)
+        self._summarizing: Dict[str, asyncio.Task] = {}
+        self._stats = {
+            "builds": 0,
+            "compacted": 0,
+            "clamped": 0,
+            "summary_hits": 0,
+            "summaries_generated": 0,
+            "summary_errors": 0,
+            "input_tokens": 0,
+            "tokens_saved": 0,
+        }
+
+    def window_for(self, model: str) -> int:
+        return self.windows.get(model, CONTEXT_DEFAULT_WINDOW)
+
+    def build(
+        self,
+        model: str,
+        prompt: str,
+        history: Optional[List[dict]] = None,
+        max_tokens: int = CONTEXT_OUTPUT_RESERVE,
+        key: Optional[str] = None,
+        system_message: str = SYSTEM_MESSAGE,
+    ) -> Tuple[List[dict], int]:
+        """返回 (压缩后的历史, 收紧后的 max_tokens)
+
+        key 标识一段会话，用于复用滚动摘要；为空时以第一条消息作为标识。
+        """
+        self._stats["builds"] += 1
+        history = history or []
+        window = self.window_for(model)
+        estimated = get_tokenizer(model) is _estimate_tokens
+        fixed = count_tokens(model, system_message) + count_tokens(model, prompt) + 2 * MESSAGE_OVERHEAD_TOKENS
+        if _with_margin(fixed, estimated) + CONTEXT_MIN_OUTPUT_TOKENS > window:
+            raise HTTPException(status_code=400, detail=f"Prompt is too long for model {model}")
+
+        reserve = max(CONTEXT_MIN_OUTPUT_TOKENS, min(max_tokens, CONTEXT_OUTPUT_RESERVE))
+        budget = window - reserve - CONTEXT_SAFETY_MARGIN - fixed
+        if estimated:
+            # 历史加入后余量随之按比例增大
+            budget = min(budget, int((window - reserve) / (1 + CONTEXT_ESTIMATE_MARGIN)) - fixed)
+        budget = max(0, budget)
+        if CONTEXT_HISTORY_BUDGET > 0:
+            budget = min(budget, CONTEXT_HISTORY_BUDGET)
+
+        costs = [count_message_tokens(model, m) for m in history]
+        total = sum(costs)
+        if total <= budget:
+            kept = list(history)
+            used = total
+        else:
+            kept, used = self._compact(model, history, costs, budget, key)
+            self._stats["compacted"] += 1
+            self._stats["tokens_saved"] += total - used
+
+        input_tokens = _with_margin(fixed + used, estimated)
+        allowed = max(1, window - input_tokens)
+        if max_tokens > allowed:
+            self._stats["clamped"] += 1
+        self._stats["input_tokens"] += input_tokens
+        return kept, max(1, min(max_tokens, allowed))
+
+    def _compact(
+        self, model: str, history: List[dict], costs: List[int], budget: int, key: Optional[str]
+    ) -> Tuple[List[dict], int]:
+        recent_budget = budget - min(CONTEXT_SUMMARY_TOKENS, budget // 2)
+
+        # 从最新的消息往前取，直到放不下；不足 CONTEXT_KEEP_RECENT 条时可以占用摘要的预算
+        split = len(history)
+        used = 0
+        while split > 0:
+            cost = costs[split - 1]
+            limit = budget if len(history) - split < CONTEXT_KEEP_RECENT else recent_budget
+            if used + cost > limit:
+                break
+            split -= 1
+            used += cost
+        summary_budget = min(CONTEXT_SUMMARY_TOKENS, budget - used - MESSAGE_OVERHEAD_TOKENS)
+        older, recent = history[:split], history[split:]
+        if not older:
+            return recent, used
+
+        key = key or _fingerprint(history[0])
+        summary, pending = self._cached_summary(key, older)
+        # 已有摘要时攒够几条新滑出的消息再滚动更新，避免每轮都调用一次上游
+        if pending and (summary is None or len(pending) >= CONTEXT_SUMMARY_MIN_PENDING):
+            self._schedule_summary(key, model, summary, pending, _fingerprint(older[-1]))
+        text = self._fit_summary(model, summary, pending, summary_budget)
+        if not text:
+            return recent, used
+        message = _summary_message(text)
+        return [message] + recent, used + count_message_tokens(model, message)
+
+    def _cached_summary(self, key: str, older: List[dict]) -> Tuple[Optional[str], List[dict]]:
+        """返回 (已有摘要, 摘要尚未覆盖的较早消息)"""
+        entry = self.summaries.get(key)
+        if entry is MISS:
+            return None, older
+        covered, summary = entry
+        for index in range(len(older) - 1, -1, -1):
+            if _fingerprint(older[index]) == covered:
+                if index == len(older) - 1:
+                    self._stats["summary_hits"] += 1
+                return summary, older[index + 1:]
+        return None, older
+
+    def _fit_summary(self, model: str, summary: Optional[str], pending: List[dict], budget: int) -> str:
+        """已有摘要加上新滑出消息的节选，从新到旧填满预算"""
+        parts: List[str] = []
+        used = count_tokens(model, summary) if summary else 0
+        if used > budget:
+            return ""
+        for message in reversed(pending):
+            content = message["content"]
+            excerpt = f"{message['role']}: {content[:EXCERPT_CHARS]}{'…' if len(content) > EXCERPT_CHARS else ''}"
+            cost = count_tokens(model, excerpt) + 1
+            if used + cost > budget:
+                break
+            parts.append(excerpt)
+            used += cost
+        parts.reverse()
+        if summary:
+            parts.insert(0, summary)
+        return "\n".join(parts)
+
+    def _schedule_summary(
+        self, key: str, model: str, summary: Optional[str], pending: List[dict], covered: str
+    ):
+        if key in self._summarizing:
+            return
+        task = asyncio.create_task(self._summarize(key, CONTEXT_SUMMARY_MODEL or model, summary, pending, covered))
+        self._summarizing[key] = task
+        task.add_done_callback(lambda _: self._summarizing.pop(key, None))
+
+    async def _summarize(self, key: str, model: str, summary: Optional[str], pending: List[dict], covered: str):
+        """滚动摘要：把新滑出窗口的消息并入已有摘要，以批量优先级排队，不挤占交互请求"""
+        prompt = SUMMARY_PROMPT
+        if summary:
+            prompt += f"已有摘要：\n{summary}\n\n新增对话：\n"
+        prompt += _transcript(pending)
+        try:
+            slot = await upstream_scheduler.acquire(model, "context-summary", "batch")
+        except HTTPException:
+            self._stats["summary_errors"] += 1
+            return
+        channel = StreamChannel()
+        frames: List[str] = []
+
+        async def collect():
+            async for frame in channel:
+                frames.append(frame)
+
+        collector = asyncio.create_task(collect())
+        try:
+            await slot.hold(model_router.stream(model, prompt, CONTEXT_SUMMARY_TOKENS, 0.3, channel))
+            channel.close()
+            await collector
+        except Exception as e:
+            self._stats["summary_errors"] += 1
+            logger.warning(f"生成对话摘要失败: {e}")
+            return
+        finally:
+            collector.cancel()
+        text = frames_text(frames).strip()
+        if not text:
+            self._stats["summary_errors"] += 1
+            return
+        self.summaries.set(key, (covered, text))
+        self._stats["summaries_generated"] += 1
+
+    def stats(self) -> dict:
+        return {
+            "tokenizer": "tiktoken" if tiktoken is not None else "estimate",
+            "tokenizers_loaded": sorted(m for m, t in _tokenizers.items() if t is not _estimate_tokens),
+            "token_cache": _token_counts.stats(),
+            "summaries": len(self.summaries),
+            "summarizing": len(self._summarizing),
+            **self._stats,
+        }
+
+
+context_builder = ContextBuilder()
+register_stats("context", context_builder.stats)
+
+
+@app.on_event("startup")
+async def preload_tokenizers():
+    # 后台加载，不阻塞启动；下载失败时这些模型一直按估算计数
+    for model in context_builder.windows:
+        get_tokenizer(model)
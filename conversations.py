@@ -0,0 +1,418 @@
+import asyncio
+import base64
+import datetime
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from auth import db_pool, get_current_user, get_db_connection
+from base import app
+from cache import MISS, TTLCache
+from context import context_builder
+from hedging import hedger
+from lifecycle import accepting_chats
+from logs import get_logger
+from response_cache import RecordingChannel
+from router import model_router
+from scheduler import request_priority, upstream_scheduler
+from stats import register_stats
+from supervisor import upstream_supervisor
+from streaming import frames_text, stream_from_channel
+
+logger = get_logger(__name__)
+
+# 内存中保留的活跃会话数，以及每个会话保留的最近消息数（再按token预算压缩后发给上游）
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "5000"))
+CONVERSATION_CACHE_TTL = float(os.getenv("CONVERSATION_CACHE_TTL", "1800"))
+CONVERSATION_CONTEXT_MESSAGES = int(os.getenv("CONVERSATION_CONTEXT_MESSAGES", "50"))
+# 延迟写入：每隔 FLUSH_INTERVAL 秒或积攒 FLUSH_BATCH 条消息批量写库
+CONVERSATION_FLUSH_INTERVAL = float(os.getenv("CONVERSATION_FLUSH_INTERVAL", "1.0"))
+CONVERSATION_FLUSH_BATCH = int(os.getenv("CONVERSATION_FLUSH_BATCH", "200"))
+# 分页大小上限
+CONVERSATION_PAGE_LIMIT = int(os.getenv("CONVERSATION_PAGE_LIMIT", "100"))
+CONVERSATION_TITLE_LENGTH = 50
+
+UPSERT_CONVERSATION_SQL = (
+    "INSERT INTO conversations (id, user_id, title, message_count, created_at, updated_at) "
+    "VALUES (%s, %s, %s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE title = VALUES(title), message_count = VALUES(message_count), "
+    "updated_at = VALUES(updated_at)"
+)
+# (conversation_id, seq) 唯一，写库失败重试时不会重复插入
+INSERT_MESSAGE_SQL = (
+    "INSERT IGNORE INTO conversation_messages (conversation_id, seq, role, content, created_at) "
+    "VALUES (%s, %s, %s, %s, %s)"
+)
+CONVERSATION_BY_ID_SQL = (
+    "SELECT id, user_id, title, message_count, created_at, updated_at FROM conversations WHERE id = %s"
+)
+RECENT_MESSAGES_SQL = (
+    "SELECT seq, role, content FROM conversation_messages "
+    "WHERE conversation_id = %s ORDER BY seq DESC LIMIT %s"
+)
+# 键集分页：按 (updated_at, id) 倒序，游标为上一页最后一条的 (updated_at, id)，走 idx_user_updated
+LIST_CONVERSATIONS_SQL = (
+    "SELECT id, title, message_count, created_at, updated_at FROM conversations "
+    "WHERE user_id = %s ORDER BY updated_at DESC, id DESC LIMIT %s"
+)
+LIST_CONVERSATIONS_AFTER_SQL = (
+    "SELECT id, title, message_count, created_at, updated_at FROM conversations "
+    "WHERE user_id = %s AND (updated_at < %s OR (updated_at = %s AND id < %s)) "
+    "ORDER BY updated_at DESC, id DESC LIMIT %s"
+)
+LIST_MESSAGES_SQL = (
+    "SELECT seq, role, content, created_at FROM conversation_messages "
+    "WHERE conversation_id = %s AND seq < %s ORDER BY seq DESC LIMIT %s"
+)
+
+
+class ConversationChatRequest(BaseModel):
+    conversation_id: Optional[str] = None  # 为空时创建新会话
+    message: str  # 本轮用户消息
+    model: str
+    max_tokens: int = 4096
+    temperature: float = 0.7
+    feature: str = "chat"
+
+
+class _Conversation:
+    """内存中的会话：元数据加最近的消息"""
+
+    __slots__ = ("id", "user_id", "title", "message_count", "created_at", "updated_at", "messages")
+
+    def __init__(self, id: str, user_id: int, title: str, message_count: int,
+                 created_at: datetime.datetime, updated_at: datetime.datetime):
+        self.id = id
+        self.user_id = user_id
+        self.title = title
+        self.message_count = message_count
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.messages: List[dict] = []
+
+    def row(self) -> tuple:
+        return (self.id, self.user_id, self.title, self.message_count, self.created_at, self.updated_at)
+
+
+def _now() -> datetime.datetime:
+    # 毫秒精度，与 DATETIME(3) 一致，避免游标比较时精度不一致
+    now = datetime.datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def _encode_cursor(updated_at: datetime.datetime, id: str) -> str:
+    raw = f"{updated_at.isoformat()}|{id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime.datetime, str]:
+    try:
+        updated_at, id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+        return datetime.datetime.fromisoformat(updated_at), id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+class ConversationStore:
+    """服务端会话存储
+
+    活跃会话及其最近消息保存在内存中，读取优先走内存；新消息先进入待写队列，
+    由后台任务按时间间隔或批量大小合并写入MySQL（write-behind）。
+    """
+
+    def __init__(self):
+        self.cache = TTLCache(maxsize=CONVERSATION_CACHE_SIZE, ttl=CONVERSATION_CACHE_TTL)
+        self._pending_messages: List[tuple] = []
+        self._dirty: Dict[str, _Conversation] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {
+            "created": 0,
+            "loaded": 0,
+            "messages": 0,
+            "flushes": 0,
+            "flushed_messages": 0,
+            "flush_errors": 0,
+        }
+
+    def lock(self, conversation_id: str) -> asyncio.Lock:
+        """同一会话的多轮请求串行执行，保证消息序号连续"""
+        lock = self._locks.get(conversation_id)
+        if lock is None:
+            lock = self._locks[conversation_id] = asyncio.Lock()
+        return lock
+
+    def create(self, user_id: int, title: str) -> _Conversation:
+        now = _now()
+        conversation = _Conversation(uuid.uuid4().hex, user_id, title[:CONVERSATION_TITLE_LENGTH], 0, now, now)
+        self.cache.set(conversation.id, conversation)
+        self._dirty[conversation.id] = conversation
+        self._stats["created"] += 1
+        return conversation
+
+    async def get(self, conversation_id: str, user_id: int) -> _Conversation:
+        conversation = self.cache.get(conversation_id)
+        if conversation is MISS:
+            conversation = self._dirty.get(conversation_id) or await self._load(conversation_id)
+        if conversation is None or conversation.user_id != user_id:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        return conversation
+
+    async def _load(self, conversation_id: str) -> Optional[_Conversation]:
+        async with get_db_connection() as conn:
+            row = await conn.fetchone(CONVERSATION_BY_ID_SQL, (conversation_id,), dictionary=True, prepared=True)
+            if row is None:
+                return None
+            rows = await conn.fetchall(
+                RECENT_MESSAGES_SQL, (conversation_id, CONVERSATION_CONTEXT_MESSAGES), dictionary=True, prepared=True
+            )
+        conversation = _Conversation(
+            row["id"], row["user_id"], row["title"], row["message_count"], row["created_at"], row["updated_at"]
+        )
+        conversation.messages = [{"role": r["role"], "content": r["content"]} for r in reversed(rows)]
+        # 还在待写队列里的消息也要补上
+        loaded = rows[0]["seq"] + 1 if rows else 0
+        for message in self._pending_messages:
+            if message[0] == conversation_id and message[1] >= loaded:
+                conversation.messages.append({"role": message[2], "content": message[3]})
+                conversation.message_count = max(conversation.message_count, message[1] + 1)
+        del conversation.messages[:-CONVERSATION_CONTEXT_MESSAGES]
+        self.cache.set(conversation_id, conversation)
+        self._stats["loaded"] += 1
+        return conversation
+
+    def append(self, conversation: _Conversation, role: str, content: str):
+        now = _now()
+        self._pending_messages.append((conversation.id, conversation.message_count, role, content, now))
+        conversation.message_count += 1
+        conversation.updated_at = now
+        conversation.messages.append({"role": role, "content": content})
+        del conversation.messages[:-CONVERSATION_CONTEXT_MESSAGES]
+        self.cache.set(conversation.id, conversation)
+        self._dirty[conversation.id] = conversation
+        self._stats["messages"] += 1
+        if len(self._pending_messages) >= CONVERSATION_FLUSH_BATCH and self._wakeup is not None:
+            self._wakeup.set()
+
+    def has_pending(self, user_id: Optional[int] = None, conversation_id: Optional[str] = None) -> bool:
+        if conversation_id is not None:
+            return conversation_id in self._dirty
+        return any(c.user_id == user_id for c in self._dirty.values())
+
+    async def flush(self):
+        """把待写的会话和消息批量写入数据库，失败时放回队列下次重试"""
+        async with self._flush_lock:
+            if not self._dirty and not self._pending_messages:
+                return
+            dirty, self._dirty = self._dirty, {}
+            messages, self._pending_messages = self._pending_messages, []
+            try:
+                async with get_db_connection() as conn:
+                    # 先写会话再写消息，会话行的 updated_at 取最新状态
+                    if dirty:
+                        await conn.executemany(UPSERT_CONVERSATION_SQL, [c.row() for c in dirty.values()])
+                    if messages:
+                        await conn.executemany(INSERT_MESSAGE_SQL, messages)
+            except Exception as e:
+                self._stats["flush_errors"] += 1
+                logger.warning(f"会话写入数据库失败，稍后重试: {e}")
+                for conversation_id, conversation in dirty.items():
+                    self._dirty.setdefault(conversation_id, conversation)
+                self._pending_messages[:0] = messages
+                return
+            self._stats["flushes"] += 1
+            self._stats["flushed_messages"] += len(messages)
+            # 已写完且没有在用的会话锁可以释放
+            for conversation_id in dirty:
+                lock = self._locks.get(conversation_id)
+                if lock is not None and not lock.locked() and conversation_id not in self._dirty:
+                    del self._locks[conversation_id]
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), CONVERSATION_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # 退出前把剩余的写入落库
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self.cache),
+            "dirty": len(self._dirty),
+            "pending_messages": len(self._pending_messages),
+            **self._stats,
+        }
+
+
+conversation_store = ConversationStore()
+register_stats("conversations", conversation_store.stats)
+# 在连接池关闭之前完成最后一次写入
+db_pool.add_close_hook(conversation_store.stop)
+
+
+@app.on_event("startup")
+async def start_conversation_store():
+    conversation_store.start()
+
+
+@app.post("/api/v1/conversations/chat", dependencies=[Depends(accepting_chats)])
+async def conversation_chat(
+    request: Request,
+    chat_request: ConversationChatRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """会话聊天：客户端只发送会话id和本轮消息，历史由服务端补齐
+
+    新会话的id通过响应头 X-Conversation-Id 返回。
+    """
+    if not model_router.has_model(chat_request.model):
+        raise HTTPException(status_code=400, detail=f"Unsupported model: {chat_request.model}")
+    # 单条消息就超出上下文窗口时直接返回400
+    context_builder.build(chat_request.model, chat_request.message, max_tokens=chat_request.max_tokens)
+    user_id = current_user["id"]
+    conversation = None
+    if chat_request.conversation_id:
+        conversation = await conversation_store.get(chat_request.conversation_id, user_id)
+        # 先等同一会话的上一轮结束再申请槽位，排队等锁期间不占用上游并发
+        lock = conversation_store.lock(conversation.id)
+        await lock.acquire()
+
+    try:
+        slot = await upstream_scheduler.acquire(
+            chat_request.model,
+            f"user:{user_id}",
+            request_priority(request, chat_request.feature)
+        )
+    except BaseException:
+        if conversation is not None:
+            lock.release()
+        raise
+    if conversation is None:
+        # 获得槽位后才创建，被拒绝（429）的请求不会留下空会话
+        conversation = conversation_store.create(user_id, chat_request.message)
+        lock = conversation_store.lock(conversation.id)
+        await lock.acquire()
+    fetch_response = hedger.stream if hedger.enabled else model_router.stream
+
+    async def save_reply(frames: List[str]):
+        conversation_store.append(conversation, "assistant", frames_text(frames))
+
+    async def run(channel):
+        # 会话锁已在上面获得，这一轮结束（包括取消）时释放
+        try:
+            # 较早的轮次按token预算压缩为滚动摘要
+            history, max_tokens = context_builder.build(
+                chat_request.model,
+                chat_request.message,
+                conversation.messages,
+                max_tokens=chat_request.max_tokens,
+                key=conversation.id
+            )
+            conversation_store.append(conversation, "user", chat_request.message)
+            await fetch_response(
+                chat_request.model,
+                chat_request.message,
+                max_tokens,
+                chat_request.temperature,
+                channel,
+                request,
+                history=history
+            )
+        finally:
+            lock.release()
+
+    response_channel = RecordingChannel(save_reply)
+    upstream_supervisor.spawn(response_channel, lambda channel: slot.hold(run(channel)), label=chat_request.model)
+    return StreamingResponse(
+        stream_from_channel(response_channel),
+        media_type="text/event-stream",
+        headers={"X-Conversation-Id": conversation.id}
+    )
+
+
+def _conversation_item(row) -> dict:
+    return {
+        "id": row["id"],
+        "title": row["title"],
+        "message_count": row["message_count"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+@app.get("/api/v1/conversations")
+async def list_conversations(
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user)
+):
+    """按最近更新时间倒序列出会话，next_cursor 为空表示没有更多"""
+    user_id = current_user["id"]
+    limit = max(1, min(limit, CONVERSATION_PAGE_LIMIT))
+    if conversation_store.has_pending(user_id=user_id):
+        await conversation_store.flush()
+
+    async with get_db_connection() as conn:
+        if cursor:
+            updated_at, last_id = _decode_cursor(cursor)
+            rows = await conn.fetchall(
+                LIST_CONVERSATIONS_AFTER_SQL,
+                (user_id, updated_at, updated_at, last_id, limit + 1),
+                dictionary=True, prepared=True
+            )
+        else:
+            rows = await conn.fetchall(LIST_CONVERSATIONS_SQL, (user_id, limit + 1), dictionary=True, prepared=True)
+
+    items = [_conversation_item(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = _encode_cursor(last["updated_at"], last["id"])
+    return {"code": 200, "msg": "success", "data": items, "next_cursor": next_cursor}
+
+
+@app.get("/api/v1/conversations/{conversation_id}/messages")
+async def list_conversation_messages(
+    conversation_id: str,
+    before: Optional[int] = None,
+    limit: int = 50,
+    current_user: dict = Depends(get_current_user)
+):
+    """从新到旧分页读取会话消息，before 为上一页返回的 next_before，结果按时间正序"""
+    conversation = await conversation_store.get(conversation_id, current_user["id"])
+    limit = max(1, min(limit, CONVERSATION_PAGE_LIMIT))
+    if conversation_store.has_pending(conversation_id=conversation_id):
+        await conversation_store.flush()
+
+    before = conversation.message_count if before is None else before
+    async with get_db_connection() as conn:
+        rows = await conn.fetchall(
+            LIST_MESSAGES_SQL, (conversation_id, before, limit), dictionary=True, prepared=True
+        )
+    rows.reverse()
+    next_before = rows[0]["seq"] if rows and rows[0]["seq"] > 0 else None
+    return {"code": 200, "msg": "success", "data": rows, "next_before": next_before}
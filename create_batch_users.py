@@ -1,9 +1,12 @@
 import mysql.connector
+import argparse
 import bcrypt
 import random
 import string
 import csv
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -18,6 +21,12 @@ db_config = {
     "port": int(os.getenv("DEV_DB_PORT", "100"))
 }
 
+# 与auth.py保持一致的bcrypt成本因子
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+INSERT_USER_SQL = "INSERT INTO users (username, email, password) VALUES (%s, %s, %s)"
+CSV_FIELDNAMES = ["用户名", "邮箱", "密码"]
+
 # 生成随机密码
 def generate_random_password(length=10):
     """生成一个包含大小写字母和数字的随机密码"""
@@ -33,7 +42,11 @@ def generate_random_password(length=10):
 
 # 获取密码哈希
 def get_password_hash(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
+
+
+def make_username(user_num):
+    return f"tianhuiai{user_num:05d}"  # 格式化为5位数字，例如: tianhuiai00001
 
 def create_batch_users(start_num=1, count=100):
     """批量创建用户账号"""
@@ -52,17 +65,14 @@ def create_batch_users(start_num=1, count=100):
     try:
         for i in range(count):
             user_num = start_num + i
-            username = f"tianhuiai{user_num:05d}"  # 格式化为5位数字，例如: tianhuiai00001
+            username = make_username(user_num)
             email = f"{username}@example.com"
             password = generate_random_password()
             hashed_password = get_password_hash(password)
             
             # 将用户信息保存到数据库
             try:
-                cursor.execute(
-                    "INSERT INTO users (username, email, password) VALUES (%s, %s, %s)",
-                    (username, email, hashed_password)
-                )
+                cursor.execute(INSERT_USER_SQL, (username, email, hashed_password))
                 # 将原始密码（未哈希）和用户名保存到列表中
                 user_data.append({
                     "用户名": username,
@@ -81,8 +91,7 @@ def create_batch_users(start_num=1, count=100):
         csv_file = "批量用户账号.csv"
         try:
             with open(csv_file, 'w', newline='', encoding='utf-8') as f:
-                fieldnames = ["用户名", "邮箱", "密码"]
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES)
                 writer.writeheader()
                 writer.writerows(user_data)
             print(f"用户数据已导出到 {csv_file}")
@@ -97,6 +106,177 @@ def create_batch_users(start_num=1, count=100):
         conn.close()
         print("数据库连接已关闭")
 
+def _prepare_users(user_nums):
+    """在子进程中生成密码并计算哈希"""
+    rows = []
+    for user_num in user_nums:
+        username = make_username(user_num)
+        password = generate_random_password()
+        rows.append((username, f"{username}@example.com", password, get_password_hash(password)))
+    return rows
+
+
+def _load_checkpoint(checkpoint_file, start_num, count, batch_size):
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("start_num") != start_num or checkpoint.get("count") != count:
+        raise ValueError(f"检查点 {checkpoint_file} 属于另一次任务，请删除后重试")
+    # 恢复时按 batch_size 推算未确认批次的范围，批大小不同会算错
+    if checkpoint.get("batch_size") != batch_size:
+        raise ValueError(f"检查点 {checkpoint_file} 的批大小为 {checkpoint.get('batch_size')}，"
+                         f"请使用相同的 --batch-size 继续，或删除检查点后重试")
+    return checkpoint
+
+
+def _save_checkpoint(checkpoint_file, checkpoint):
+    # 先写临时文件再替换，保证检查点不会写坏
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, checkpoint_file)
+
+
+def _recover_pending_rows(cursor, csv_file, csv_offset):
+    """检查上次中断时已写入CSV但未记入检查点的批次是否已提交
+
+    返回 True 表示该批次已提交，保留CSV中的记录；否则截断CSV重新执行该批次。
+    """
+    if not os.path.exists(csv_file) or os.path.getsize(csv_file) <= csv_offset:
+        return False
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        f.seek(csv_offset)
+        usernames = [row[0] for row in csv.reader(f) if row]
+    if usernames:
+        placeholders = ", ".join(["%s"] * len(usernames))
+        cursor.execute(f"SELECT COUNT(*) FROM users WHERE username IN ({placeholders})", usernames)
+        if cursor.fetchone()[0] == len(usernames):
+            return True
+    with open(csv_file, 'r+b') as f:
+        f.truncate(csv_offset)
+    return False
+
+
+def _insert_batch(conn, cursor, rows):
+    """批量插入一批用户，失败时回退为逐条插入以跳过冲突的账号，返回成功插入的行"""
+    params = [(username, email, hashed) for username, email, _, hashed in rows]
+    try:
+        cursor.executemany(INSERT_USER_SQL, params)
+        return rows
+    except mysql.connector.Error as err:
+        print(f"批量插入失败，改为逐条插入: {err}")
+        conn.rollback()
+
+    inserted = []
+    for row in rows:
+        try:
+            cursor.execute(INSERT_USER_SQL, (row[0], row[1], row[3]))
+            inserted.append(row)
+        except mysql.connector.Error as err:
+            print(f"创建用户 {row[0]} 失败: {err}")
+    return inserted
+
+
+def create_batch_users_bulk(start_num=1, count=100, workers=None, batch_size=1000,
+                            csv_file="批量用户账号.csv", checkpoint_file=None):
+    """高吞吐批量创建用户账号
+
+    - 多进程并行计算bcrypt哈希
+    - 每 batch_size 个用户一次 executemany 并提交
+    - CSV边生成边写出，不在内存中保留全部账号
+    - 每批提交后写检查点，中断后用相同参数重新运行即可从断点继续
+    """
+    checkpoint_file = checkpoint_file or f"{csv_file}.checkpoint.json"
+    workers = workers or os.cpu_count() or 1
+    end_num = start_num + count
+
+    try:
+        conn = mysql.connector.connect(**db_config)
+        cursor = conn.cursor()
+        print(f"成功连接到数据库: {db_config['database']}")
+    except mysql.connector.Error as err:
+        print(f"数据库连接失败: {err}")
+        return
+
+    try:
+        checkpoint = _load_checkpoint(checkpoint_file, start_num, count, batch_size)
+        if checkpoint is None:
+            checkpoint = {"start_num": start_num, "count": count, "batch_size": batch_size,
+                          "next_num": start_num, "created": 0, "csv_offset": 0}
+            with open(csv_file, 'w', newline='', encoding='utf-8') as f:
+                csv.writer(f).writerow(CSV_FIELDNAMES)
+                checkpoint["csv_offset"] = f.tell()
+            _save_checkpoint(checkpoint_file, checkpoint)
+        else:
+            print(f"从检查点继续: 下一个账号编号 {checkpoint['next_num']}，已创建 {checkpoint['created']} 个")
+            if _recover_pending_rows(cursor, csv_file, checkpoint["csv_offset"]):
+                # 中断发生在提交之后、写检查点之前，直接把该批次记为完成
+                with open(csv_file, newline='', encoding='utf-8') as f:
+                    f.seek(checkpoint["csv_offset"])
+                    pending = sum(1 for row in csv.reader(f) if row)
+                checkpoint["next_num"] = min(checkpoint["next_num"] + batch_size, end_num)
+                checkpoint["created"] += pending
+                checkpoint["csv_offset"] = os.path.getsize(csv_file)
+                _save_checkpoint(checkpoint_file, checkpoint)
+
+        # 每个子任务的大小：保证所有进程都有活干，同时不超过一个批次
+        chunk_size = max(1, min(batch_size, batch_size // workers or 1))
+        batch_starts = range(checkpoint["next_num"], end_num, batch_size)
+
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                open(csv_file, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            for batch_start in batch_starts:
+                batch_end = min(batch_start + batch_size, end_num)
+                chunks = [range(n, min(n + chunk_size, batch_end)) for n in range(batch_start, batch_end, chunk_size)]
+                rows = [row for chunk_rows in executor.map(_prepare_users, chunks) for row in chunk_rows]
+
+                inserted = _insert_batch(conn, cursor, rows)
+
+                # 先把明文密码落盘再提交，保证已提交的账号一定能在CSV中找到
+                writer.writerows([(username, email, password) for username, email, password, _ in inserted])
+                f.flush()
+                os.fsync(f.fileno())
+                conn.commit()
+
+                checkpoint["next_num"] = batch_end
+                checkpoint["created"] += len(inserted)
+                checkpoint["csv_offset"] = f.tell()
+                _save_checkpoint(checkpoint_file, checkpoint)
+                print(f"已创建 {checkpoint['created']} 个用户（进度 {batch_end - start_num}/{count}）")
+
+        os.remove(checkpoint_file)
+        print(f"成功创建 {checkpoint['created']} 个用户，用户数据已导出到 {csv_file}")
+    except Exception as e:
+        print(f"出现错误: {e}，可用相同参数重新运行以从检查点继续")
+        conn.rollback()
+    finally:
+        cursor.close()
+        conn.close()
+        print("数据库连接已关闭")
+
+
 if __name__ == "__main__":
-    # 创建100个用户，账号从tianhuiai20001开始
-    create_batch_users(start_num=20001, count=100) 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="批量创建用户账号")
+    parser.add_argument("--start", type=int, default=20001, help="起始账号编号")
+    parser.add_argument("--count", type=int, default=100, help="创建数量")
+    parser.add_argument("--bulk", action="store_true", help="使用多进程、批量插入、可断点续跑的高吞吐模式")
+    parser.add_argument("--workers", type=int, default=None, help="计算哈希的进程数，默认为CPU核数")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每批插入并提交的用户数")
+    parser.add_argument("--csv", default="批量用户账号.csv", help="导出的CSV文件")
+    args = parser.parse_args()
+
+    if args.bulk:
+        create_batch_users_bulk(
+            start_num=args.start,
+            count=args.count,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            csv_file=args.csv
+        )
+    else:
+        # 默认创建100个用户，账号从tianhuiai20001开始
+        create_batch_users(start_num=args.start, count=args.count)
@@ -0,0 +1,281 @@
+import asyncio
+import collections
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import mysql.connector
+from fastapi import HTTPException
+from mysql.connector import Error
+
+from logs import get_logger
+from metrics import db_acquire_seconds, db_connect_seconds
+
+logger = get_logger(__name__)
+
+
+class PooledConnection:
+    """连接池中的一条MySQL连接
+
+    驱动调用都是同步的，这里统一放到连接池的线程里执行，不阻塞事件循环。
+    """
+
+    def __init__(self, pool: "DatabasePool", raw):
+        self._pool = pool
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        # (sql, dictionary) -> 预处理游标，同一连接上重复执行时复用服务端预处理语句
+        self._prepared: Dict[Tuple[str, bool], Any] = {}
+
+    def _query(self, sql: str, params: Sequence, one: bool, dictionary: bool, prepared: bool):
+        if prepared:
+            key = (sql, dictionary)
+            cursor = self._prepared.get(key)
+            if cursor is None:
+                cursor = self.raw.cursor(prepared=True, dictionary=dictionary)
+                self._prepared[key] = cursor
+            cursor.execute(sql, tuple(params))
+            rows = cursor.fetchall()
+            if one:
+                return rows[0] if rows else None
+            return rows
+
+        cursor = self.raw.cursor(dictionary=dictionary)
+        try:
+            cursor.execute(sql, tuple(params))
+            return cursor.fetchone() if one else cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _execute(self, sql: str, params: Sequence, many: bool) -> int:
+        cursor = self.raw.cursor()
+        try:
+            if many:
+                cursor.executemany(sql, params)
+            else:
+                cursor.execute(sql, tuple(params))
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
+    async def fetchone(self, sql: str, params: Sequence = (), dictionary: bool = False, prepared: bool = False):
+        return await self._pool.run(self._query, sql, params, True, dictionary, prepared)
+
+    async def fetchall(self, sql: str, params: Sequence = (), dictionary: bool = False, prepared: bool = False):
+        return await self._pool.run(self._query, sql, params, False, dictionary, prepared)
+
+    async def execute(self, sql: str, params: Sequence = ()) -> int:
+        return await self._pool.run(self._execute, sql, params, False)
+
+    async def executemany(self, sql: str, seq_params: Sequence[Sequence]) -> int:
+        return await self._pool.run(self._execute, sql, seq_params, True)
+
+    async def commit(self):
+        await self._pool.run(self.raw.commit)
+
+    async def rollback(self):
+        await self._pool.run(self.raw.rollback)
+
+    def close_sync(self):
+        for cursor in self._prepared.values():
+            try:
+                cursor.close()
+            except Error:
+                pass
+        self._prepared.clear()
+        try:
+            self.raw.close()
+        except Error:
+            pass
+
+
+class DatabasePool:
+    """异步友好的MySQL连接池
+
+    - 连接数在 min_size ~ max_size 之间，空闲连接按后进先出复用
+    - 空闲超过 health_check_interval 的连接借出前先 ping，失效则重建
+    - 存活超过 max_lifetime 的连接直接回收
+    - 等待超过 acquire_timeout 仍借不到连接时返回 503
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        acquire_timeout: Optional[float] = None,
+        health_check_interval: Optional[float] = None,
+        max_lifetime: Optional[float] = None,
+    ):
+        # 连接池内统一开启autocommit，避免归还的连接带着旧的一致性快照
+        self.config = {**config, "autocommit": True}
+        self.max_size = max_size or int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+        self.min_size = min(min_size if min_size is not None else int(os.getenv("DB_POOL_MIN_SIZE", "2")), self.max_size)
+        self.acquire_timeout = acquire_timeout or float(os.getenv("DB_POOL_TIMEOUT", "5"))
+        self.health_check_interval = health_check_interval or float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))
+        self.max_lifetime = max_lifetime or float(os.getenv("DB_MAX_LIFETIME", "3600"))
+
+        self._idle: Deque[PooledConnection] = collections.deque()
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._semaphore = asyncio.Semaphore(self.max_size)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._close_hooks: List[Callable[[], Awaitable]] = []
+        self._stats = {
+            "acquired": 0,
+            "created": 0,
+            "discarded": 0,
+            "stale": 0,
+            "timeouts": 0,
+            "connect_errors": 0,
+        }
+        self._wait_total = 0.0
+
+    async def run(self, fn, *args):
+        """在连接池专用线程中执行同步驱动调用"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix="db")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def start(self):
+        """应用启动时预先建立 min_size 条连接"""
+        self._closed = False
+        self._semaphore = asyncio.Semaphore(self.max_size)
+        results = await asyncio.gather(
+            *[self._connect() for _ in range(self.min_size - self._size)],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, PooledConnection):
+                self._idle.append(result)
+
+    def add_close_hook(self, hook: Callable[[], Awaitable]):
+        """注册关闭连接池之前执行的协程，例如把延迟写入的数据落库"""
+        self._close_hooks.append(hook)
+
+    async def close(self):
+        for hook in self._close_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                logger.exception(f"Error in database pool close hook: {e}")
+        self._closed = True
+        while self._idle:
+            await self._discard(self._idle.pop())
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _connect(self) -> PooledConnection:
+        started = time.monotonic()
+        try:
+            raw = await self.run(functools.partial(mysql.connector.connect, **self.config))
+            db_connect_seconds.observe(time.monotonic() - started)
+        except Error as e:
+            self._stats["connect_errors"] += 1
+            logger.error(f"Error connecting to MySQL Database: {e}")
+            raise HTTPException(status_code=500, detail="Database connection failed")
+        self._size += 1
+        self._stats["created"] += 1
+        return PooledConnection(self, raw)
+
+    async def _discard(self, conn: PooledConnection):
+        self._size -= 1
+        self._stats["discarded"] += 1
+        try:
+            await self.run(conn.close_sync)
+        except Exception:
+            pass
+
+    async def _checkout(self) -> PooledConnection:
+        while self._idle:
+            conn = self._idle.pop()
+            now = time.monotonic()
+            if now - conn.created_at > self.max_lifetime:
+                await self._discard(conn)
+                continue
+            if now - conn.last_used > self.health_check_interval:
+                # is_connected() 会向服务端发送 ping
+                alive = await self.run(conn.raw.is_connected)
+                if not alive:
+                    self._stats["stale"] += 1
+                    await self._discard(conn)
+                    continue
+            return conn
+        return await self._connect()
+
+    async def acquire(self) -> PooledConnection:
+        started = time.monotonic()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Database is busy, please retry later",
+                headers={"Retry-After": "1"},
+            )
+        finally:
+            self._waiting -= 1
+
+        try:
+            conn = await self._checkout()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        waited = time.monotonic() - started
+        self._stats["acquired"] += 1
+        self._wait_total += waited
+        db_acquire_seconds.observe(waited)
+        return conn
+
+    async def release(self, conn: PooledConnection, discard: bool = False):
+        try:
+            if not discard and not self._closed and conn.raw.in_transaction:
+                # 有未结束的显式事务时回滚，避免脏状态带给下一个使用者
+                try:
+                    await conn.rollback()
+                except Error:
+                    discard = True
+            if discard or self._closed:
+                await self._discard(conn)
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+        finally:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        """借出一条连接，退出时归还；驱动报错或调用中途被取消的连接直接丢弃"""
+        conn = await self.acquire()
+        broken = False
+        try:
+            yield conn
+        except (Error, asyncio.CancelledError):
+            # 取消时执行器线程可能仍在这条连接上执行查询，不能再借给别人
+            broken = True
+            raise
+        finally:
+            await self.release(conn, discard=broken)
+
+    def stats(self) -> dict:
+        acquired = self._stats["acquired"]
+        return {
+            "size": self._size,
+            "idle": len(self._idle),
+            "in_use": self._size - len(self._idle),
+            "waiting": self._waiting,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "avg_wait_ms": round(self._wait_total / acquired * 1000, 3) if acquired else 0.0,
+            **self._stats,
+        }
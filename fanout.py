@@ -0,0 +1,177 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional
+
+from fastapi import Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from backend import ChatRequest, open_chat_stream
+from base import app
+from lifecycle import accepting_chats
+from logs import get_logger
+from response_cache import response_cache
+from scheduler import client_key, request_priority
+from stats import register_stats
+from streaming import DONE_FRAME, StreamChannel, StreamError, frames_text, stream_from_channel
+from supervisor import upstream_supervisor
+
+logger = get_logger(__name__)
+
+# 一次对比最多同时请求的模型数
+FANOUT_MAX_MODELS = int(os.getenv("FANOUT_MAX_MODELS", "4"))
+
+
+class CompareRequest(BaseModel):
+    models: List[str]  # 要对比的模型，同时开始生成
+    prompt: str  # User message
+    max_tokens: int = 4096  # Maximum tokens to generate
+    temperature: float = 0.7  # Temperature for generation
+    mode: Literal["all", "first"] = "all"  # all 等全部结束；first 第一个完成的模型胜出，其余立即取消
+    feature: str = "chat"  # 调用来源，与 /api/v1/tools/chat 相同
+
+
+def _event(payload: dict) -> bytes:
+    return b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+async def _items(frames: Optional[List[Any]], channel) -> AsyncIterator[Any]:
+    # 缓存命中时是完整的帧列表，否则逐帧读取通道
+    if frames is not None:
+        for item in frames:
+            yield item
+        return
+    async for item in channel:
+        yield item
+
+
+class FanOut:
+    """把同一个提问同时发给多个模型，各模型的增量按到达顺序合并到一个SSE响应中
+
+    每个模型通过 open_chat_stream 启动，与单模型请求共用缓存、调度、请求合并和上游托管；
+    合并通道有界，客户端读得慢时各模型的读取一起暂停。
+    """
+
+    def __init__(self):
+        self._stats = {
+            "requests": 0,
+            "mode_all": 0,
+            "mode_first": 0,
+            "models_started": 0,
+            "models_failed": 0,
+            "losers_cancelled": 0,
+        }
+        self._winners: Dict[str, int] = {}
+
+    async def _pump(self, model: str, compare: CompareRequest, client: str, priority: str,
+                    bypass_cache: bool, merged) -> bool:
+        """把一个模型的流写入合并通道，返回是否完整结束"""
+        started = time.monotonic()
+        chat_request = ChatRequest(
+            model=model,
+            prompt=compare.prompt,
+            max_tokens=compare.max_tokens,
+            temperature=compare.temperature,
+            feature=compare.feature
+        )
+        channel = None
+        chars = 0
+        try:
+            frames, channel, headers = await open_chat_stream(chat_request, client, priority, bypass_cache)
+            self._stats["models_started"] += 1
+            async for item in _items(frames, channel):
+                content = frames_text([item])
+                if content:
+                    chars += len(content)
+                    await merged.send(_event({"type": "delta", "model": model, "content": content}))
+        except (HTTPException, StreamError) as e:
+            self._stats["models_failed"] += 1
+            await merged.send(_event({"type": "error", "model": model, "status": e.status_code, "detail": e.detail}))
+            return False
+        finally:
+            if channel is not None:
+                # 结束、被取消或客户端离开时关闭通道，托管方随即取消该模型仍在进行的上游
+                channel.close()
+        await merged.send(_event({
+            "type": "done",
+            "model": model,
+            "elapsed_ms": round((time.monotonic() - started) * 1000),
+            "chars": chars,
+            "cache": headers.get("X-Cache"),
+        }))
+        return True
+
+    async def run(self, compare: CompareRequest, client: str, priority: str, bypass_cache: bool, merged):
+        """同时启动所有模型；first 模式下第一个完整结束的模型胜出，其余取消"""
+        tasks = {
+            asyncio.create_task(self._pump(model, compare, client, priority, bypass_cache, merged)): model
+            for model in compare.models
+        }
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [tasks[task] for task in done if task.result()]
+                if compare.mode == "first" and winners:
+                    for task in pending:
+                        task.cancel()
+                    if pending:
+                        await asyncio.wait(pending)
+                    self._stats["losers_cancelled"] += len(pending)
+                    self._winners[winners[0]] = self._winners.get(winners[0], 0) + 1
+                    await merged.send(_event({"type": "winner", "model": winners[0]}))
+                    for task in pending:
+                        await merged.send(_event({"type": "cancelled", "model": tasks[task]}))
+                    break
+            await merged.send(DONE_FRAME)
+            merged.close()
+        finally:
+            # 客户端离开时本任务被托管方取消，剩余模型随之取消
+            for task in pending:
+                task.cancel()
+
+    def start(self, compare: CompareRequest, client: str, priority: str, bypass_cache: bool) -> StreamChannel:
+        self._stats["requests"] += 1
+        self._stats[f"mode_{compare.mode}"] += 1
+        merged = StreamChannel()
+        upstream_supervisor.spawn(
+            merged,
+            lambda channel: self.run(compare, client, priority, bypass_cache, channel),
+            label=f"fan_out:{','.join(compare.models)}"
+        )
+        return merged
+
+    def stats(self) -> dict:
+        return {
+            "max_models": FANOUT_MAX_MODELS,
+            "winners": dict(self._winners),
+            **self._stats,
+        }
+
+
+fan_out = FanOut()
+register_stats("fan_out", fan_out.stats)
+
+
+@app.post("/api/v1/tools/compare", dependencies=[Depends(accepting_chats)])
+async def compare_models(request: Request, compare: CompareRequest):
+    """同一个提问并发请求多个模型，增量交错返回
+
+    每个事件是 data: {"type": ..., "model": ...}：delta 带 content；done 带耗时和字数；
+    error 带 status 和 detail；first 模式下还有 winner 和被取消模型的 cancelled；最后是 data: [DONE]。
+    """
+    # 去重并保持顺序
+    compare.models = list(dict.fromkeys(compare.models))
+    if not compare.models:
+        raise HTTPException(status_code=400, detail="At least one model is required")
+    if len(compare.models) > FANOUT_MAX_MODELS:
+        raise HTTPException(status_code=400, detail=f"At most {FANOUT_MAX_MODELS} models can be compared at once")
+    merged = fan_out.start(
+        compare,
+        client_key(request),
+        request_priority(request, compare.feature),
+        response_cache.is_bypass(request)
+    )
+    return StreamingResponse(stream_from_channel(merged), media_type="text/event-stream")
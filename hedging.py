@@ -0,0 +1,212 @@
+import asyncio
+import collections
+import os
+import time
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from fastapi import Request
+
+from router import model_router
+from stats import register_stats
+from streaming import ChannelClosed, StreamError
+
+# 对冲请求默认关闭，设置 HEDGE_ENABLED=true 开启
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes", "on")
+# 固定的对冲等待时间（秒），不设置时使用该模型最近首token延迟的分位数
+HEDGE_DELAY = os.getenv("HEDGE_DELAY", "")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+# 样本不足时使用的等待时间，以及等待时间的下限（秒）
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "3.0"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.2"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_SAMPLE_SIZE = int(os.getenv("HEDGE_SAMPLE_SIZE", "200"))
+# 对冲预算：每个请求积累 HEDGE_BUDGET 个令牌，每次对冲消耗 1 个，最多积累 HEDGE_BURST 个
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+HEDGE_BURST = float(os.getenv("HEDGE_BURST", "5"))
+# 同模型没有其他部署时可以对冲到的备选模型，例如 "DeepSeek-R1=DeepSeek-V3"
+HEDGE_FALLBACK_MODELS = os.getenv("HEDGE_FALLBACK_MODELS", "")
+
+
+def _parse_fallbacks(value: str) -> Dict[str, str]:
+    fallbacks = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, fallback = item.split("=", 1)
+            fallbacks[model.strip()] = fallback.strip()
+    return fallbacks
+
+
+class _HedgeAttempt:
+    """一次尝试看到的通道：第一个发出帧的尝试胜出，其余尝试的 send 抛出 ChannelClosed"""
+
+    def __init__(self, race: "_HedgeRace", name: str):
+        self._race = race
+        self.name = name
+        self.task: Optional[asyncio.Task] = None
+        self.started_at = time.monotonic()
+        self.first_frame_at: Optional[float] = None
+        self.error: Optional[StreamError] = None
+
+    @property
+    def closed(self) -> bool:
+        race = self._race
+        return race.target.closed or (race.winner is not None and race.winner is not self)
+
+    async def send(self, item):
+        race = self._race
+        if race.winner is None:
+            race.winner = self
+            self.first_frame_at = time.monotonic()
+            race.cancel_others(self)
+        elif race.winner is not self:
+            raise ChannelClosed()
+        await race.target.send(item)
+
+    def close(self):
+        if self._race.winner is self:
+            self._race.target.close()
+
+    def fail(self, detail: str, status_code: int = 500):
+        self.error = StreamError(detail, status_code)
+        if self._race.winner is self:
+            self._race.target.fail(detail, status_code)
+
+
+class _HedgeRace:
+    def __init__(self, target):
+        self.target = target
+        self.winner: Optional[_HedgeAttempt] = None
+        self.attempts: List[_HedgeAttempt] = []
+
+    def launch(self, name: str, start: Callable[[_HedgeAttempt], "asyncio.Future"]) -> _HedgeAttempt:
+        attempt = _HedgeAttempt(self, name)
+        attempt.task = asyncio.create_task(start(attempt))
+        self.attempts.append(attempt)
+        return attempt
+
+    def cancel_others(self, winner: _HedgeAttempt):
+        for attempt in self.attempts:
+            if attempt is not winner and attempt.task is not None and not attempt.task.done():
+                attempt.task.cancel()
+
+    def finish_without_winner(self):
+        """所有尝试都没有发出帧：上报最后一个错误，否则正常结束"""
+        errors = [a.error for a in self.attempts if a.error is not None]
+        if errors:
+            self.target.fail(errors[-1].detail, errors[-1].status_code)
+        else:
+            self.target.close()
+
+
+class Hedger:
+    """对冲请求：首token迟迟不到时向备选部署/模型再发一次，先出首token者胜出"""
+
+    def __init__(self):
+        self.enabled = HEDGE_ENABLED
+        self.fixed_delay = float(HEDGE_DELAY) if HEDGE_DELAY else None
+        self.fallbacks = _parse_fallbacks(HEDGE_FALLBACK_MODELS)
+        self._samples: Dict[str, Deque[float]] = {}
+        self._tokens = HEDGE_BURST
+        self._stats = {
+            "requests": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "budget_denied": 0,
+            "no_alternate": 0,
+        }
+
+    def delay_for(self, model: str) -> float:
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        samples = self._samples.get(model)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))
+        return max(HEDGE_MIN_DELAY, ordered[index])
+
+    def _record_ttft(self, model: str, ttft: float):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = collections.deque(maxlen=HEDGE_SAMPLE_SIZE)
+        samples.append(ttft)
+
+    def _take_budget(self) -> bool:
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        self._stats["budget_denied"] += 1
+        return False
+
+    def _alternate(self, model: str, tried: Set[str]) -> Optional[Tuple[str, Set[str]]]:
+        """优先同模型的其他部署，其次配置的备选模型"""
+        for endpoint in model_router.endpoints(model):
+            if endpoint.name not in tried and endpoint.breaker.allow():
+                return model, set(tried)
+        fallback = self.fallbacks.get(model)
+        if fallback and model_router.has_model(fallback):
+            return fallback, set()
+        return None
+
+    async def stream(
+        self,
+        model: str,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        response_channel,
+        request: Optional[Request] = None,
+        history: Optional[List[dict]] = None
+    ):
+        """与 fetch_*_response 相同的流式接口"""
+        self._stats["requests"] += 1
+        self._tokens = min(HEDGE_BURST, self._tokens + HEDGE_BUDGET)
+
+        race = _HedgeRace(response_channel)
+        primary_tried: Set[str] = set()
+        primary = race.launch("primary", lambda channel: model_router.stream(
+            model, prompt, max_tokens, temperature, channel, request,
+            on_attempt=lambda endpoint: primary_tried.add(endpoint.name), history=history
+        ))
+        try:
+            await asyncio.wait({primary.task}, timeout=self.delay_for(model))
+            if race.winner is None and not primary.task.done() and not response_channel.closed:
+                alternate = self._alternate(model, primary_tried)
+                if alternate is None:
+                    self._stats["no_alternate"] += 1
+                elif self._take_budget():
+                    hedge_model, exclude = alternate
+                    self._stats["hedged"] += 1
+                    race.launch("hedge", lambda channel: model_router.stream(
+                        hedge_model, prompt, max_tokens, temperature, channel, request,
+                        exclude=exclude, history=history
+                    ))
+            await asyncio.gather(*[a.task for a in race.attempts], return_exceptions=True)
+        except asyncio.CancelledError:
+            for attempt in race.attempts:
+                attempt.task.cancel()
+            raise
+
+        winner = race.winner
+        if winner is None:
+            race.finish_without_winner()
+            return
+        # 记录客户端实际感受到的首token延迟（从主请求开始计时）
+        self._record_ttft(model, winner.first_frame_at - primary.started_at)
+        if len(race.attempts) > 1:
+            self._stats["hedge_wins" if winner.name == "hedge" else "primary_wins"] += 1
+
+    def stats(self) -> dict:
+        requests = self._stats["requests"]
+        return {
+            "enabled": self.enabled,
+            "hedge_rate": round(self._stats["hedged"] / requests, 4) if requests else 0.0,
+            "budget_tokens": round(self._tokens, 2),
+            "delay_ms": {model: round(self.delay_for(model) * 1000, 1) for model in self._samples},
+            **self._stats,
+        }
+
+
+hedger = Hedger()
+register_stats("hedging", hedger.stats)
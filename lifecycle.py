@@ -0,0 +1,108 @@
+import asyncio
+import os
+import signal
+import time
+from typing import Optional
+
+from fastapi import HTTPException
+
+from base import app
+from logs import get_logger
+from metrics import active_streams
+from stats import register_stats
+
+logger = get_logger(__name__)
+
+# 收到 SIGTERM 后等待进行中的流式响应结束的最长时间（秒），超时后由uvicorn取消剩余任务
+SERVER_DRAIN_TIMEOUT = float(os.getenv("SERVER_DRAIN_TIMEOUT", "60"))
+# 排空期间拒绝新请求时建议客户端重试的间隔（秒）
+SERVER_DRAIN_RETRY_AFTER = int(os.getenv("SERVER_DRAIN_RETRY_AFTER", "2"))
+
+
+class Lifecycle:
+    """进程生命周期状态：收到退出信号后进入排空，不再接收新的聊天请求"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.draining = False
+        self._drain_started: Optional[float] = None
+        self._streams_at_drain = 0
+        self._stats = {
+            "rejected": 0,
+        }
+
+    def begin_drain(self):
+        if self._drain_started is not None:
+            return
+        self.draining = True
+        self._drain_started = time.monotonic()
+        self._streams_at_drain = int(active_streams.value())
+        logger.info(f"进程 {os.getpid()} 开始排空，等待 {self._streams_at_drain} 个流式响应结束"
+                    f"（最长 {SERVER_DRAIN_TIMEOUT:g} 秒）")
+
+    def check_accepting(self):
+        """排空期间新的聊天请求直接返回503，由负载均衡或客户端重试到其它进程"""
+        if self.draining:
+            self._stats["rejected"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Server is restarting, please retry",
+                headers={"Retry-After": str(SERVER_DRAIN_RETRY_AFTER), "Connection": "close"},
+            )
+
+    def install_signal_handlers(self):
+        """在uvicorn已安装的信号处理函数之前先进入排空状态
+
+        uvicorn收到信号后会关闭监听、等待现有连接在 timeout_graceful_shutdown 内结束，
+        再触发shutdown钩子，这里只负责标记状态。
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            previous = signal.getsignal(sig)
+            if not callable(previous):
+                continue
+
+            def handler(signum, frame, previous=previous):
+                # 信号处理函数中不直接写日志（日志队列的锁不可重入），交给事件循环执行
+                self.draining = True
+                loop.call_soon_threadsafe(self.begin_drain)
+                previous(signum, frame)
+
+            try:
+                signal.signal(sig, handler)
+            except ValueError:
+                # 不在主线程（如测试客户端）时无法安装信号处理
+                return
+
+    def stats(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "draining": self.draining,
+            "drain_elapsed_s": round(time.monotonic() - self._drain_started, 1) if self._drain_started else None,
+            "streams_at_drain": self._streams_at_drain,
+            "drain_timeout_s": SERVER_DRAIN_TIMEOUT,
+            **self._stats,
+        }
+
+
+lifecycle = Lifecycle()
+register_stats("lifecycle", lifecycle.stats)
+
+
+def accepting_chats():
+    """聊天端点的依赖项：排空期间拒绝新的流"""
+    lifecycle.check_accepting()
+
+
+@app.on_event("startup")
+async def install_drain_handlers():
+    lifecycle.install_signal_handlers()
+
+
+@app.get("/healthz")
+async def healthz():
+    """负载均衡健康检查，排空期间返回503以便摘除该实例"""
+    if lifecycle.draining:
+        raise HTTPException(status_code=503, detail="draining")
+    return {"status": "ok", "pid": os.getpid()}
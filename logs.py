@@ -0,0 +1,230 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+from typing import Dict, Optional
+
+from base import app
+from metrics import Counter, Gauge
+from stats import register_stats
+
+# 默认日志级别，以及按模块覆盖的级别，如 "router=DEBUG,streaming=WARNING"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# 第三方库默认只记录警告，httpx/openai 会为每个上游请求写一条 INFO；可在 LOG_LEVELS 中覆盖
+DEFAULT_LOG_LEVELS = {"httpx": "WARNING", "httpcore": "WARNING", "openai": "WARNING"}
+# 高频事件的采样率（只作用于 INFO 及以下），如 "backend.frames=0.01"，按模块名前缀匹配
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+# json 或 text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# 为空时写到标准输出；多进程部署时可以用 {pid} 让每个进程写自己的文件，避免轮转时互相覆盖
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# 待写出的日志条数上限，写满时丢弃新日志而不是阻塞调用方
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# 当前请求的id，随 contextvars 传递到请求中创建的后台任务
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# LogRecord 自带的属性，其余属性视为调用方通过 extra 传入的字段
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+logs_dropped_total = Counter("logs_dropped_total", "Log records dropped because the writer queue was full")
+
+
+def _parse_mapping(value: str) -> Dict[str, str]:
+    result = {}
+    for item in value.split(","):
+        name, sep, setting = item.partition("=")
+        if sep and name.strip():
+            result[name.strip()] = setting.strip()
+    return result
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行JSON，extra 传入的字段原样输出"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] %(request_id)s%(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        request_id = getattr(record, "request_id", None)
+        record.request_id = f"{request_id} " if request_id else ""
+        text = super().format(record)
+        record.request_id = request_id
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """按模块名前缀对 INFO 及以下的日志采样，警告和错误总是保留"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        # 长前缀优先匹配
+        self.rates = sorted(rates.items(), key=lambda item: -len(item[0]))
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.rates or record.levelno >= logging.WARNING:
+            return True
+        name = record.name
+        for prefix, rate in self.rates:
+            if name == prefix or name.startswith(prefix + "."):
+                if rate >= 1 or random.random() < rate:
+                    return True
+                self.sampled_out += 1
+                return False
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """在调用方线程里只做消息拼接和入队，格式化和写出在后台线程完成"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 不调用父类的 prepare：它会在这里把整条日志格式化成文本；根日志器只有这一个处理器，原地修改即可
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            logs_dropped_total.inc()
+
+
+def _file_handler() -> logging.Handler:
+    if not LOG_FILE:
+        return logging.StreamHandler(sys.stdout)
+    path = LOG_FILE.replace("{pid}", str(os.getpid()))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return logging.handlers.RotatingFileHandler(
+        path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+
+
+class LogPipeline:
+    """根日志器 -> 有界队列 -> 后台线程写出（标准输出或按大小轮转的文件）"""
+
+    def __init__(self):
+        self.queue: queue.Queue = queue.Queue(maxsize=max(1, LOG_QUEUE_SIZE))
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.sampler = SamplingFilter({k: float(v) for k, v in _parse_mapping(LOG_SAMPLE).items()})
+        self.handler.addFilter(self.sampler)
+        output = _file_handler()
+        output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, output, respect_handler_level=False)
+        self._started = False
+
+    def start(self):
+        if self._started:
+            return
+        root = logging.getLogger()
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(self.handler)
+        for name, level in {**DEFAULT_LOG_LEVELS, **_parse_mapping(LOG_LEVELS)}.items():
+            logging.getLogger(name).setLevel(level.upper())
+        self.listener.start()
+        self._started = True
+        atexit.register(self.stop)
+
+    def stop(self):
+        """写完队列中剩余的日志后停止后台线程"""
+        if not self._started:
+            return
+        self._started = False
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+
+    def stats(self) -> dict:
+        return {
+            "level": LOG_LEVEL,
+            "format": LOG_FORMAT,
+            "file": LOG_FILE or "stdout",
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "dropped": self.handler.dropped,
+            "sampled_out": self.sampler.sampled_out,
+        }
+
+
+log_pipeline = LogPipeline()
+log_pipeline.start()
+register_stats("logging", log_pipeline.stats)
+Gauge("logs_queued", "Log records waiting for the writer thread", collect=lambda: [({}, log_pipeline.queue.qsize())])
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+class RequestIdMiddleware:
+    """为每个请求分配id（沿用客户端或nginx传入的 X-Request-ID），写入日志并在响应头中返回"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        if not request_id:
+            request_id = uuid.uuid4().hex[:16]
+        token = request_id_var.set(request_id)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(token)
+
+
+app.add_middleware(RequestIdMiddleware)
@@ -2,33 +2,62 @@ import backend
 import chat
 import auth
 import me
+import conversations
+import lifecycle
+import ws_chat
+import fanout
+# 前端静态文件的兜底路由，需要在所有接口之后注册
+import static_assets
 from base import app
+import importlib.util
 import os
 
 if __name__ == '__main__':
     import uvicorn
-    
+
     # 检测是否为开发环境
     is_dev = os.environ.get("ENVIRONMENT", "development") == "development"
-    
+
     # 配置参数
     uvicorn_config = {
-        "app": "main:app",  # 使用字符串形式引用app以支持热重载
-        "host": "0.0.0.0",
-        "port": 8000,
-        "timeout_keep_alive": 0,
+        "app": "main:app",  # 使用字符串形式引用app以支持热重载和多进程
+        "host": os.environ.get("SERVER_HOST", "0.0.0.0"),
+        "port": int(os.environ.get("SERVER_PORT", "8000")),
         "limit_concurrency": None,
         "limit_max_requests": None
     }
-    
+
     # 在开发环境添加热重载
     if is_dev:
         uvicorn_config.update({
+            "timeout_keep_alive": 0,
             "reload": True,  # 启用热重载
             "reload_dirs": ["./"],  # 监视的目录
             "workers": 1  # 开发环境使用单个工作进程
         })
         print("开发模式已启用，热重载功能已开启")
-    
+    else:
+        # 生产模式：每个CPU核一个工作进程，共享同一个监听端口
+        # 注意缓存、请求合并和调度器并发上限都是进程内的，SCHEDULER_* 上限按单个进程计算
+        # /metrics 同样是进程内的，样本带 pid 标签；设置 METRICS_DIR 后任一进程返回所有进程的指标
+        workers = int(os.environ.get("SERVER_WORKERS", str(os.cpu_count() or 1)))
+        uvicorn_config.update({
+            "workers": max(1, workers),
+            # 有安装时使用 uvloop 和 httptools，否则退回 asyncio 和 h11
+            "loop": "uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+            "http": "httptools" if importlib.util.find_spec("httptools") else "h11",
+            # 比nginx的keepalive_timeout(65s)长，避免nginx复用一条刚被后端关闭的连接
+            "timeout_keep_alive": int(os.environ.get("SERVER_KEEP_ALIVE", "75")),
+            # SIGTERM后停止监听，等待进行中的SSE流结束，超时后取消剩余任务再执行shutdown钩子
+            "timeout_graceful_shutdown": int(lifecycle.SERVER_DRAIN_TIMEOUT),
+            "backlog": int(os.environ.get("SERVER_BACKLOG", "2048")),
+            "proxy_headers": True,
+            "forwarded_allow_ips": os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+            "access_log": os.environ.get("SERVER_ACCESS_LOG", "false").lower() in ("1", "true", "yes", "on"),
+        })
+        print(f"生产模式: {uvicorn_config['workers']} 个工作进程, "
+              f"loop={uvicorn_config['loop']}, http={uvicorn_config['http']}, "
+              f"排空超时 {uvicorn_config['timeout_graceful_shutdown']} 秒")
+
     # 启动服务器
     uvicorn.run(**uvicorn_config)
@@ -0,0 +1,291 @@
+import asyncio
+import bisect
+import contextlib
+import json
+import math
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from fastapi.responses import PlainTextResponse
+
+from base import app
+
+# 延迟类指标的默认分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 流式响应时长分桶（秒）
+DURATION_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+# 生成速度分桶（token/秒）
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+# 指标都在进程内，多个工作进程（SERVER_WORKERS>1）共享端口时每次抓取只落到其中一个进程。
+# 所有样本都带 pid 标签区分进程，查询时用 sum without (pid) 聚合；
+# 设置 METRICS_DIR 后各进程定期把指标快照写到该目录（各进程须能访问同一目录），
+# /metrics 合并所有存活进程的快照，抓取任意一个进程即可得到全部进程的指标
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+# 快照写入间隔（秒）；超过3个间隔未更新的快照视为进程已退出
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+_metrics: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], *extra: str) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(pair for pair in extra if pair)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        _metrics.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self, worker: str = "") -> Iterable[str]:
+        """worker 为附加到每个样本上的进程标签，如 pid="123"，为空时不附加"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """单调递增计数"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self, worker: str = "") -> Iterable[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, key, worker)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """可增可减的当前值；传入 collect 时在抓取时调用，返回 [(标签字典, 值)]"""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        collect: Callable[[], Iterable[Tuple[Dict[str, str], float]]] = None
+    ):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._collect = collect
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self, worker: str = "") -> Iterable[str]:
+        values = dict(self._values)
+        if self._collect is not None:
+            for labels, value in self._collect():
+                values[self._key(labels)] = value
+        for key, value in values.items():
+            yield f"{self.name}{_format_labels(self.label_names, key, worker)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """固定分桶的直方图，observe 只做一次二分查找和两次加法"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各桶计数..., 总和]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self, worker: str = "") -> Iterable[str]:
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.label_names, key, worker, le)} {cumulative}"
+            labels = _format_labels(self.label_names, key, worker)
+            yield f"{self.name}_sum{labels} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def _snapshot() -> List[list]:
+    """本进程的指标：[[名称, 说明, 类型, [样本行...]], ...]"""
+    worker = f'pid="{os.getpid()}"'
+    return [[metric.name, metric.help, metric.type, list(metric.samples(worker))] for metric in _metrics]
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{pid}.json")
+
+
+def _write_snapshot(families: List[list]):
+    # 先写临时文件再替换，其它进程不会读到写了一半的快照
+    path = _snapshot_path(os.getpid())
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(families, f)
+    os.replace(path + ".tmp", path)
+
+
+def _read_snapshots() -> List[List[list]]:
+    """读取其它存活进程的快照，顺带删除已退出进程留下的快照"""
+    snapshots = []
+    own = os.path.basename(_snapshot_path(os.getpid()))
+    expired = time.time() - 3 * METRICS_FLUSH_INTERVAL
+    for name in os.listdir(METRICS_DIR):
+        if name == own or not name.startswith("metrics-") or not name.endswith(".json"):
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+                continue
+            with open(path, encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge_snapshots(families: List[list]) -> List[list]:
+    """写出本进程的快照并合并其它进程的；同名指标只保留一份 HELP/TYPE，各进程的样本依次排在后面"""
+    _write_snapshot(families)
+    merged = {name: [help, kind, list(samples)] for name, help, kind, samples in families}
+    for snapshot in _read_snapshots():
+        for name, help, kind, samples in snapshot:
+            if name in merged:
+                merged[name][2].extend(samples)
+            else:
+                merged[name] = [help, kind, samples]
+    return [[name, *family] for name, family in merged.items()]
+
+
+def render_metrics(families: List[list] = None) -> str:
+    lines = []
+    for name, help, kind, samples in _snapshot() if families is None else families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+async def _flush_snapshots():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(_write_snapshot, _snapshot())
+        except OSError:
+            pass
+
+
+# 流式响应
+stream_ttft_seconds = Histogram(
+    "chat_stream_ttft_seconds", "Time from upstream request to first frame", ("model", "provider")
+)
+stream_tokens_per_second = Histogram(
+    "chat_stream_tokens_per_second", "Generation speed after the first frame", ("model", "provider"), RATE_BUCKETS
+)
+stream_duration_seconds = Histogram(
+    "chat_stream_duration_seconds", "Total upstream stream duration", ("model", "provider"), DURATION_BUCKETS
+)
+upstream_connect_seconds = Histogram(
+    "upstream_connect_seconds", "TCP and TLS connect time for new upstream connections", ("upstream",)
+)
+upstream_errors_total = Counter(
+    "upstream_errors_total", "Upstream stream errors by kind", ("provider", "kind")
+)
+active_streams = Gauge("chat_active_streams", "SSE responses currently being written")
+client_disconnects_total = Counter(
+    "chat_client_disconnects_total", "Clients that left before the stream finished", ("stage",)
+)
+
+# 数据库与认证
+db_acquire_seconds = Histogram("db_acquire_seconds", "Time to borrow a connection from the pool")
+db_connect_seconds = Histogram("db_connect_seconds", "Time to open a new MySQL connection")
+bcrypt_seconds = Histogram(
+    "bcrypt_seconds", "bcrypt run time on the worker pool", ("op",), (0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0)
+)
+bcrypt_wait_seconds = Histogram("bcrypt_wait_seconds", "Time a bcrypt job waited for a worker", ("op",))
+
+
+def upstream_error_kind(status_code: int) -> str:
+    if status_code == 429:
+        return "rate_limited"
+    if status_code in (408, 504):
+        return "timeout"
+    if status_code == 502:
+        return "connect"
+    if status_code >= 500:
+        return "server_error"
+    return "client_error"
+
+
+_flush_task = None
+
+
+@app.on_event("startup")
+async def start_metrics_snapshots():
+    global _flush_task
+    if METRICS_DIR:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _flush_task = asyncio.create_task(_flush_snapshots())
+
+
+@app.on_event("shutdown")
+async def stop_metrics_snapshots():
+    if _flush_task is not None:
+        _flush_task.cancel()
+        with contextlib.suppress(OSError):
+            os.remove(_snapshot_path(os.getpid()))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 文本格式的指标，每个样本带 pid 标签；设置 METRICS_DIR 时包含所有工作进程"""
+    # 采集在事件循环中进行，只有文件读写放到线程里
+    families = _snapshot()
+    if METRICS_DIR:
+        families = await asyncio.to_thread(_merge_snapshots, families)
+    return PlainTextResponse(render_metrics(families), media_type="text/plain; version=0.0.4; charset=utf-8")
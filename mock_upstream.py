@@ -0,0 +1,121 @@
+"""本地模拟的 DeepSeek / Azure OpenAI 流式上游，用于压测，不消耗真实token
+
+    python mock_upstream.py --port 9100 --ttft 0.5 --tps 40 --tokens 200 --error-rate 0.01
+
+DeepSeek 接口: POST /api/chat/completions
+Azure 接口:    POST /openai/deployments/{deployment}/chat/completions?api-version=...
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# 首token延迟（秒）、生成速度（token/秒）、每次回复的token数
+MOCK_TTFT = float(os.getenv("MOCK_TTFT", "0.5"))
+MOCK_TPS = float(os.getenv("MOCK_TPS", "40"))
+MOCK_TOKENS = int(os.getenv("MOCK_TOKENS", "200"))
+# 时间抖动比例，0.2 表示在 ±20% 内随机
+MOCK_JITTER = float(os.getenv("MOCK_JITTER", "0.2"))
+# 错误注入：直接返回错误状态码的比例，以及生成到一半断开连接的比例
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_ERROR_STATUS = int(os.getenv("MOCK_ERROR_STATUS", "500"))
+MOCK_DISCONNECT_RATE = float(os.getenv("MOCK_DISCONNECT_RATE", "0"))
+
+TOKENS = ["你好", "，", "这是", "一段", "模拟", "的", "回复", "。", " The", " quick", " brown", " fox", "\n"]
+
+mock_app = FastAPI()
+
+
+def _jitter(value: float) -> float:
+    if MOCK_JITTER <= 0:
+        return value
+    return max(0.0, value * random.uniform(1 - MOCK_JITTER, 1 + MOCK_JITTER))
+
+
+def _chunk(model: str, content: str, index: int, finish_reason=None) -> bytes:
+    data = {
+        "id": f"chatcmpl-mock-{index}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "delta": {"content": content} if content else {},
+            "finish_reason": finish_reason,
+        }],
+    }
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+async def _generate(model: str, max_tokens: int):
+    count = min(MOCK_TOKENS, max_tokens)
+    disconnect_at = random.randint(1, max(1, count - 1)) if random.random() < MOCK_DISCONNECT_RATE else None
+    await asyncio.sleep(_jitter(MOCK_TTFT))
+    # 与真实上游一样，先发一个只有角色的空帧
+    yield _chunk(model, "", 0)
+    interval = 1.0 / MOCK_TPS if MOCK_TPS > 0 else 0
+    for index in range(count):
+        if disconnect_at is not None and index == disconnect_at:
+            raise ConnectionResetError("mock upstream disconnect")
+        yield _chunk(model, TOKENS[index % len(TOKENS)], index + 1)
+        if interval:
+            await asyncio.sleep(_jitter(interval))
+    yield _chunk(model, "", count + 1, finish_reason="stop")
+    yield b"data: [DONE]\n\n"
+
+
+async def _stream(request: Request, model: str):
+    body = await request.json()
+    if random.random() < MOCK_ERROR_RATE:
+        return JSONResponse({"error": {"message": "mock upstream error"}}, status_code=MOCK_ERROR_STATUS)
+    if not body.get("stream"):
+        return JSONResponse({"error": {"message": "mock upstream only supports stream=true"}}, status_code=400)
+    return StreamingResponse(_generate(model or body.get("model", "mock"), body.get("max_tokens") or MOCK_TOKENS),
+                             media_type="text/event-stream")
+
+
+@mock_app.post("/api/chat/completions")
+async def deepseek_chat(request: Request):
+    return await _stream(request, "")
+
+
+@mock_app.post("/openai/deployments/{deployment}/chat/completions")
+async def azure_chat(deployment: str, request: Request):
+    return await _stream(request, deployment)
+
+
+@mock_app.api_route("/{path:path}", methods=["HEAD", "GET"])
+async def warmup(path: str):
+    # 连接预热请求
+    return Response(status_code=200)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="本地模拟的流式LLM上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft", type=float, default=MOCK_TTFT, help="首token延迟（秒）")
+    parser.add_argument("--tps", type=float, default=MOCK_TPS, help="每秒生成的token数")
+    parser.add_argument("--tokens", type=int, default=MOCK_TOKENS, help="每次回复的token数")
+    parser.add_argument("--jitter", type=float, default=MOCK_JITTER, help="时间抖动比例")
+    parser.add_argument("--error-rate", type=float, default=MOCK_ERROR_RATE, help="直接返回错误的比例")
+    parser.add_argument("--error-status", type=int, default=MOCK_ERROR_STATUS, help="注入错误的状态码")
+    parser.add_argument("--disconnect-rate", type=float, default=MOCK_DISCONNECT_RATE, help="生成中途断开的比例")
+    args = parser.parse_args()
+
+    MOCK_TTFT = args.ttft
+    MOCK_TPS = args.tps
+    MOCK_TOKENS = args.tokens
+    MOCK_JITTER = args.jitter
+    MOCK_ERROR_RATE = args.error_rate
+    MOCK_ERROR_STATUS = args.error_status
+    MOCK_DISCONNECT_RATE = args.disconnect_rate
+
+    uvicorn.run(mock_app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,101 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from fastapi import HTTPException
+
+from metrics import bcrypt_seconds, bcrypt_wait_seconds
+
+# bcrypt成本因子，每加1耗时翻倍
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# 专用线程数，bcrypt计算时会释放GIL，可以真正并行
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 允许排队（含执行中）的最大任务数，超过直接拒绝
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", "64"))
+
+
+def _hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+class PasswordHasher:
+    """在有界线程池中执行bcrypt，避免阻塞事件循环
+
+    排队任务超过 max_pending 时返回 503，而不是无限堆积。
+    """
+
+    def __init__(self, rounds: int = BCRYPT_ROUNDS, workers: int = BCRYPT_WORKERS, max_pending: int = BCRYPT_MAX_PENDING):
+        self.rounds = rounds
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        self._pending = 0
+        self._stats = {
+            "hash": 0,
+            "verify": 0,
+            "rejected": 0,
+        }
+        self._wait_total = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+    @staticmethod
+    def _timed(submitted_at: float, fn, *args):
+        """在工作线程中执行，返回 (结果, 排队耗时, 运行耗时)，统计回到事件循环后再记录"""
+        started = time.monotonic()
+        result = fn(*args)
+        return result, started - submitted_at, time.monotonic() - started
+
+    async def _submit(self, kind: str, fn, *args):
+        if self._pending >= self.max_pending:
+            self._stats["rejected"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Too many login requests, please retry later",
+                headers={"Retry-After": "1"},
+            )
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result, waited, elapsed = await loop.run_in_executor(
+                self._executor, functools.partial(self._timed, time.monotonic(), fn, *args)
+            )
+            self._stats[kind] += 1
+            self._wait_total += waited
+            self._run_total += elapsed
+            self._run_max = max(self._run_max, elapsed)
+            bcrypt_wait_seconds.observe(waited, op=kind)
+            bcrypt_seconds.observe(elapsed, op=kind)
+            return result
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._submit("hash", _hash, password, self.rounds)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._submit("verify", _verify, plain_password, hashed_password)
+
+    def close(self):
+        """关闭线程池，丢弃尚未开始的任务"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        done = self._stats["hash"] + self._stats["verify"]
+        return {
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "avg_wait_ms": round(self._wait_total / done * 1000, 3) if done else 0.0,
+            "avg_run_ms": round(self._run_total / done * 1000, 3) if done else 0.0,
+            "max_run_ms": round(self._run_max * 1000, 3),
+            **self._stats,
+        }
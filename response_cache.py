@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import Request
+
+from cache import MISS, TTLCache
+from logs import get_logger
+from stats import register_stats
+from streaming import DONE_FRAME, StreamChannel, encode_frame
+
+logger = get_logger(__name__)
+
+# 响应缓存默认关闭，设置 RESPONSE_CACHE_ENABLED=true 开启
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes", "on")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# 按模型覆盖TTL，例如 "DeepSeek-R1=600,gpt-4o-mini=7200"，0 表示该模型不缓存
+RESPONSE_CACHE_MODEL_TTLS = os.getenv("RESPONSE_CACHE_MODEL_TTLS", "")
+# 可选的磁盘缓存目录，为空时只使用内存
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+# 命中后回放时每帧之间的间隔（秒），0 表示一次性发出
+RESPONSE_CACHE_REPLAY_DELAY = float(os.getenv("RESPONSE_CACHE_REPLAY_DELAY", "0"))
+
+# 请求头带上其中之一时跳过缓存读取（仍会写入新的结果）
+BYPASS_HEADER = "x-cache-bypass"
+
+
+def _parse_model_ttls(value: str) -> Dict[str, float]:
+    ttls = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, ttl = item.split("=", 1)
+            ttls[model.strip()] = float(ttl)
+    return ttls
+
+
+class RecordingChannel(StreamChannel):
+    """在转发的同时记录生产者发出的帧，流完整结束时交给 on_done"""
+
+    def __init__(self, on_done: Callable[[List[str]], Awaitable]):
+        super().__init__()
+        self._on_done = on_done
+        self._frames: Optional[List[str]] = []
+
+    async def send(self, item):
+        await super().send(item)
+        if self._frames is None:
+            return
+        self._frames.append(item)
+        if item == DONE_FRAME:
+            frames, self._frames = self._frames, None
+            await self._on_done(frames)
+
+    def fail(self, detail: str, status_code: int = 500):
+        # 出错的响应不缓存
+        self._frames = None
+        super().fail(detail, status_code)
+
+
+class ResponseCache:
+    """/api/v1/tools/chat 的精确匹配响应缓存
+
+    以规范化后的 (model, prompt, temperature, max_tokens) 为键，缓存完整的SSE帧序列，
+    命中时按原样回放。内存层按字节预算做LRU淘汰，可选磁盘层在进程重启后继续命中。
+    """
+
+    def __init__(self):
+        self.enabled = RESPONSE_CACHE_ENABLED
+        self.default_ttl = RESPONSE_CACHE_TTL
+        self.model_ttls = _parse_model_ttls(RESPONSE_CACHE_MODEL_TTLS)
+        self.replay_delay = RESPONSE_CACHE_REPLAY_DELAY
+        self.disk_dir = RESPONSE_CACHE_DIR or None
+        self.memory = TTLCache(
+            maxsize=RESPONSE_CACHE_MAX_ENTRIES,
+            ttl=RESPONSE_CACHE_TTL,
+            max_bytes=RESPONSE_CACHE_MAX_BYTES
+        )
+        self._stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "stored": 0,
+        }
+
+    def ttl_for(self, model: str) -> float:
+        return self.model_ttls.get(model, self.default_ttl)
+
+    def is_cacheable(self, model: str) -> bool:
+        return self.enabled and self.ttl_for(model) > 0
+
+    @staticmethod
+    def make_key(model: str, prompt: str, temperature: float, max_tokens: int) -> str:
+        normalized = [
+            model.strip(),
+            prompt.replace("\r\n", "\n").strip(),
+            round(float(temperature), 2),
+            int(max_tokens),
+        ]
+        raw = json.dumps(normalized, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def is_bypass(self, request: Request) -> bool:
+        if request.headers.get(BYPASS_HEADER, "").lower() in ("1", "true", "yes"):
+            return True
+        return "no-cache" in request.headers.get("cache-control", "").lower()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[dict]:
+        path = self._disk_path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("expires_at", 0) <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry
+
+    def _write_disk(self, key: str, entry: dict):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        frames = self.memory.get(key)
+        if frames is not MISS:
+            self._stats["hits"] += 1
+            return frames
+
+        if self.disk_dir:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                frames = entry["frames"]
+                # 回填内存层，剩余TTL以磁盘记录为准
+                self.memory.set(key, frames, ttl=entry["expires_at"] - time.time(), size=entry["size"])
+                self._stats["hits"] += 1
+                self._stats["disk_hits"] += 1
+                return frames
+
+        self._stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, model: str, frames: List[str]):
+        ttl = self.ttl_for(model)
+        if ttl <= 0:
+            return
+        # 透传的原始字节解码后存储，磁盘层需要可JSON序列化的帧
+        frames = [frame.decode("utf-8") if isinstance(frame, bytes) else frame for frame in frames]
+        size = sum(len(frame.encode("utf-8")) for frame in frames)
+        self.memory.set(key, frames, ttl=ttl, size=size)
+        self._stats["stored"] += 1
+        if self.disk_dir:
+            entry = {"model": model, "expires_at": time.time() + ttl, "size": size, "frames": frames}
+            try:
+                await asyncio.to_thread(self._write_disk, key, entry)
+            except OSError as e:
+                logger.warning(f"写入响应缓存失败: {e}")
+
+    def store_callback(self, key: str, model: str) -> Callable[[List[str]], Awaitable]:
+        """返回在流完整结束时把帧写入缓存的回调"""
+        async def _store(frames: List[str]):
+            await self.put(key, model, frames)
+        return _store
+
+    def note_bypass(self):
+        self._stats["bypassed"] += 1
+
+    async def replay(self, frames: List[str]) -> AsyncIterator[bytes]:
+        """以与实时流相同的SSE帧回放缓存的响应"""
+        for index, frame in enumerate(frames):
+            if self.replay_delay > 0 and index:
+                await asyncio.sleep(self.replay_delay)
+            yield encode_frame(frame)
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "enabled": self.enabled,
+            "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            **self._stats,
+            "memory": self.memory.stats(),
+        }
+
+
+response_cache = ResponseCache()
+register_stats("response_cache", response_cache.stats)
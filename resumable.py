@@ -0,0 +1,370 @@
+import asyncio
+import collections
+import os
+import secrets
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from metrics import Counter, Gauge
+from stats import register_stats
+from streaming import EMPTY, STREAM_CHANNEL_SIZE, ChannelClosed, StreamError, encode_frame
+
+# 客户端断开后继续生成、等待重连的时间（秒）；流结束后同样保留这么久供客户端补取结尾
+RESUME_GRACE = float(os.getenv("RESUME_GRACE", "30"))
+# 每个流保留的已发送帧的字节上限，重连时只能补发这个范围内的帧
+RESUME_STREAM_BYTES = int(os.getenv("RESUME_STREAM_BYTES", str(256 * 1024)))
+# 所有流的重放缓冲合计上限，超出时先丢弃最早的流中已发送的帧
+RESUME_MEMORY_BUDGET = int(os.getenv("RESUME_MEMORY_BUDGET", str(64 * 1024 * 1024)))
+
+stream_resumes_total = Counter("stream_resumes_total", "Reconnects carrying Last-Event-ID", ("result",))
+
+
+def _split_events(frame: bytes) -> List[bytes]:
+    """把一帧拆成单个事件（去掉结尾的空行）；透传的上游字节一帧可能包含多个事件"""
+    if frame.count(b"\n\n") == 1:
+        return [frame[:-2]]
+    return [event for event in frame.split(b"\n\n") if event]
+
+
+def _with_event_id(event: bytes, event_id: str) -> bytes:
+    # id 行放在事件末尾，只按 data 行解析的客户端不受影响
+    return event + b"\nid: " + event_id.encode("ascii") + b"\n\n"
+
+
+class ResumableStream:
+    """一次可续传的生成：每个事件带递增的id，并在环形缓冲中保留最近发出的事件
+
+    写入端提供与 StreamChannel 相同的 send/close/fail 接口；同一时刻最多一个 ResumeCursor 在读，
+    新的重连会接替旧的连接（服务端可能还没发现旧连接已断）。
+    """
+
+    def __init__(self, registry: "ResumableStreams", stream_id: str, maxsize: int = STREAM_CHANNEL_SIZE):
+        self.id = stream_id
+        self.error: Optional[StreamError] = None
+        self._registry = registry
+        self._maxsize = max(1, maxsize)
+        self._frames: Deque[Tuple[int, bytes]] = collections.deque()
+        # 缓冲中第一帧的序号，以及最后一帧的序号（从1开始）
+        self._first_seq = 1
+        self._last_seq = 0
+        # 已经交给客户端连接的最大序号；之前的帧可以按需丢弃，之后的帧必须保留
+        self._delivered = 0
+        self.bytes = 0
+        self._closed = False
+        self._cursor: Optional["ResumeCursor"] = None
+        self._expiry: Optional[asyncio.TimerHandle] = None
+        self._update: Optional[asyncio.Future] = None
+        self._space: Optional[asyncio.Future] = None
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def detached(self) -> bool:
+        return self._cursor is None and not self._closed
+
+    def _notify(self):
+        if self._update is not None and not self._update.done():
+            self._update.set_result(None)
+        self._update = None
+
+    async def wait(self):
+        """等待新的帧、流结束或连接被接替"""
+        if self._update is None:
+            self._update = asyncio.get_running_loop().create_future()
+        await asyncio.shield(self._update)
+
+    async def send(self, item: Any):
+        """写入一帧；未发送的帧达到上限时等待，断线期间生成因此最多领先客户端这么多帧"""
+        while not self._closed and self._last_seq - self._delivered >= self._maxsize:
+            if self._space is None or self._space.done():
+                self._space = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self._space)
+        if self._closed:
+            raise ChannelClosed()
+        # 每个事件单独编号，客户端在一块中间断线时按事件续传，不会重复
+        for event in _split_events(encode_frame(item)):
+            self._last_seq += 1
+            frame = _with_event_id(event, f"{self.id}:{self._last_seq}")
+            self._frames.append((self._last_seq, frame))
+            self.bytes += len(frame)
+            self._registry.bytes += len(frame)
+        self._trim()
+        if self._registry.bytes > self._registry.budget:
+            self._registry._enforce_budget()
+        self._notify()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._cancel_expiry()
+        self._notify()
+        if self._space is not None and not self._space.done():
+            self._space.set_result(None)
+        for listener in self._listeners:
+            listener()
+        self._listeners.clear()
+        self._registry._closed(self)
+
+    def fail(self, detail: str, status_code: int = 500):
+        if self._closed:
+            return
+        self.error = StreamError(detail, status_code)
+        self.close()
+
+    def add_close_listener(self, listener: Callable[[], None]):
+        if self._closed:
+            listener()
+            return
+        self._listeners.append(listener)
+
+    def _trim(self, limit: Optional[int] = None) -> int:
+        """丢弃已发送的最早的帧，直到本流和全局都不超过上限；返回释放的字节数"""
+        limit = RESUME_STREAM_BYTES if limit is None else limit
+        registry = self._registry
+        released = 0
+        while self._frames and self._frames[0][0] <= self._delivered and (
+            self.bytes > limit or registry.bytes > registry.budget
+        ):
+            _, frame = self._frames.popleft()
+            self._first_seq += 1
+            self.bytes -= len(frame)
+            registry.bytes -= len(frame)
+            released += len(frame)
+        if released:
+            registry.note_evicted(released)
+        return released
+
+    def _frame(self, seq: int) -> bytes:
+        return self._frames[seq - self._first_seq][1]
+
+    def _mark_delivered(self, seq: int):
+        if seq <= self._delivered:
+            return
+        self._delivered = seq
+        if self._space is not None and not self._space.done():
+            self._space.set_result(None)
+        self._trim()
+
+    def can_resume_from(self, seq: int) -> bool:
+        # 需要的下一帧还在缓冲中，或者客户端已经收到了全部帧；已出错且没有剩余帧时重连没有意义
+        if self.error is not None and seq >= self._last_seq:
+            return False
+        return self._first_seq - 1 <= seq <= self._last_seq
+
+    def attach(self, after_seq: int = 0) -> "ResumeCursor":
+        """从 after_seq 之后开始读；已有连接时由新连接接替"""
+        previous, self._cursor = self._cursor, None
+        if previous is not None:
+            previous._superseded = True
+        self._cancel_expiry()
+        # 旧连接发出但客户端没收到的帧要重新发送，不能再被丢弃
+        self._delivered = after_seq
+        cursor = ResumeCursor(self, after_seq)
+        self._cursor = cursor
+        self._notify()
+        return cursor
+
+    def _detach(self, cursor: "ResumeCursor"):
+        if self._cursor is not cursor:
+            return
+        self._cursor = None
+        if not self._closed:
+            self._registry.note_detached()
+            self._expiry = asyncio.get_running_loop().call_later(RESUME_GRACE, self._expire)
+
+    def _expire(self):
+        self._expiry = None
+        if self._cursor is None and not self._closed:
+            # 宽限期内没有重连：关闭流，停止读取上游
+            self._registry.note_expired()
+            self.close()
+            self._registry._forget(self)
+
+    def _cancel_expiry(self):
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+
+
+class ResumeCursor:
+    """一个客户端连接的读取位置，接口与 StreamChannel 的消费端一致，可直接交给 stream_from_channel"""
+
+    def __init__(self, stream: ResumableStream, after_seq: int):
+        self._stream = stream
+        self._next = after_seq + 1
+        self._closed = False
+        self._superseded = False
+
+    @property
+    def stream_id(self) -> str:
+        return self._stream.id
+
+    def receive_nowait(self) -> Any:
+        stream = self._stream
+        if self._superseded or self._closed:
+            raise ChannelClosed()
+        if self._next <= stream._last_seq:
+            frame = stream._frame(self._next)
+            stream._mark_delivered(self._next)
+            self._next += 1
+            return frame
+        if stream.closed:
+            if stream.error is not None:
+                raise stream.error
+            raise ChannelClosed()
+        return EMPTY
+
+    async def wait_readable(self, timeout: float):
+        stream = self._stream
+        if self._next <= stream._last_seq or stream.closed or self._superseded or self._closed:
+            return
+        try:
+            await asyncio.wait_for(stream.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        while True:
+            try:
+                item = self.receive_nowait()
+            except ChannelClosed:
+                raise StopAsyncIteration
+            if item is not EMPTY:
+                return item
+            await self._stream.wait()
+
+    def close(self):
+        """客户端连接结束；生成未完成时进入宽限期等待重连"""
+        if self._closed:
+            return
+        self._closed = True
+        self._stream._detach(self)
+
+
+class ResumableStreams:
+    """进程内可续传流的登记表，按流id查找；id 随每个事件的 id 字段发给客户端"""
+
+    def __init__(self, budget: int = RESUME_MEMORY_BUDGET):
+        self.budget = budget
+        self.bytes = 0
+        self._streams: Dict[str, ResumableStream] = {}
+        self._stats = {
+            "created": 0,
+            "resumed": 0,
+            "resume_failed": 0,
+            "detached": 0,
+            "expired": 0,
+            "cancelled": 0,
+            "evicted_bytes": 0,
+        }
+
+    def create(self, source) -> ResumableStream:
+        """从 source（StreamChannel、合并请求的订阅等消费端）读取帧写入新的可续传流
+
+        生成因此不再绑定到某一个客户端连接：连接断开后继续读取，宽限期过后才关闭 source，
+        由托管方取消上游。
+        """
+        stream = ResumableStream(self, secrets.token_urlsafe(12))
+        self._streams[stream.id] = stream
+        self._stats["created"] += 1
+        if self.bytes > self.budget:
+            self._enforce_budget()
+        pump = asyncio.create_task(self._pump(source, stream))
+        stream.add_close_listener(lambda: pump.done() or pump.cancel())
+        return stream
+
+    @staticmethod
+    async def _pump(source, stream: ResumableStream):
+        try:
+            async for item in source:
+                await stream.send(item)
+            stream.close()
+        except StreamError as e:
+            stream.fail(e.detail, e.status_code)
+        except ChannelClosed:
+            # 宽限期内没有重连，流已关闭
+            pass
+        finally:
+            source.close()
+
+    def resume(self, last_event_id: str) -> Optional[ResumeCursor]:
+        """按客户端带来的 Last-Event-ID 重新接上流，补发之后的帧；无法续传时返回 None"""
+        stream_id, _, seq = last_event_id.strip().rpartition(":")
+        stream = self._streams.get(stream_id)
+        if stream is None or not seq.isdigit() or not stream.can_resume_from(int(seq)):
+            self._stats["resume_failed"] += 1
+            stream_resumes_total.inc(result="failed")
+            return None
+        self._stats["resumed"] += 1
+        stream_resumes_total.inc(result="resumed")
+        return stream.attach(int(seq))
+
+    def cancel(self, stream_id: str) -> bool:
+        """客户端主动停止生成：立即关闭流，不等待宽限期"""
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return False
+        self._stats["cancelled"] += 1
+        stream.close()
+        self._forget(stream)
+        return True
+
+    def _closed(self, stream: ResumableStream):
+        # 流结束后再保留一段时间，让在最后几帧断线的客户端补取结尾
+        asyncio.get_running_loop().call_later(RESUME_GRACE, self._forget, stream, False)
+
+    def _forget(self, stream: ResumableStream, force: bool = True):
+        if not force and stream._cursor is not None:
+            # 客户端还在读取结尾，稍后再释放
+            asyncio.get_running_loop().call_later(RESUME_GRACE, self._forget, stream, False)
+            return
+        if self._streams.get(stream.id) is stream:
+            del self._streams[stream.id]
+        self.bytes -= stream.bytes
+        stream.bytes = 0
+        stream._frames.clear()
+        stream._first_seq = stream._last_seq + 1
+        if stream._cursor is not None:
+            # 被取消的流：正在读取的连接随之结束
+            stream._cursor._superseded = True
+            stream._notify()
+
+    def _enforce_budget(self):
+        # 从最早的流开始丢弃已发送的帧
+        for stream in list(self._streams.values()):
+            if self.bytes <= self.budget:
+                break
+            stream._trim(limit=0)
+
+    def note_detached(self):
+        self._stats["detached"] += 1
+
+    def note_expired(self):
+        self._stats["expired"] += 1
+
+    def note_evicted(self, size: int):
+        self._stats["evicted_bytes"] += size
+
+    def waiting(self) -> int:
+        return sum(1 for stream in self._streams.values() if stream.detached)
+
+    def stats(self) -> dict:
+        return {
+            "grace_s": RESUME_GRACE,
+            "streams": len(self._streams),
+            "waiting_for_reconnect": self.waiting(),
+            "bytes": self.bytes,
+            "budget_bytes": self.budget,
+            **self._stats,
+        }
+
+
+resumable_streams = ResumableStreams()
+register_stats("resumable_streams", resumable_streams.stats)
+Gauge("resumable_stream_bytes", "Bytes held in SSE replay buffers", collect=lambda: [({}, resumable_streams.bytes)])
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import os
+import re
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from fastapi import Request
+
+from logs import get_logger
+from metrics import (
+    stream_duration_seconds, stream_tokens_per_second, stream_ttft_seconds, upstream_error_kind, upstream_errors_total
+)
+from stats import register_stats
+from streaming import DONE_FRAME, StreamError
+from upstream import HttpUpstream, register_upstream
+
+logger = get_logger(__name__)
+
+# EWMA平滑系数，越大越看重最近的请求
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.3"))
+# 还没有测量数据的部署使用的首token延迟估计（秒）
+ROUTER_DEFAULT_TTFT = float(os.getenv("ROUTER_DEFAULT_TTFT", "1.0"))
+# 错误率对评分的放大系数
+ROUTER_ERROR_PENALTY = float(os.getenv("ROUTER_ERROR_PENALTY", "4.0"))
+# 每个进行中的请求对评分的放大系数，用于在部署之间分摊负载
+ROUTER_INFLIGHT_WEIGHT = float(os.getenv("ROUTER_INFLIGHT_WEIGHT", "0.05"))
+# 连续失败多少次后熔断，以及熔断后多久放行一个探测请求（秒）
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+# 额外的部署配置，JSON字符串或JSON文件路径，格式见 load_routes
+MODEL_ROUTES = os.getenv("MODEL_ROUTES", "")
+MODEL_ROUTES_FILE = os.getenv("MODEL_ROUTES_FILE", "")
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断，冷却期后放行一个探测请求（半开）"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            return True
+        return False
+
+    def on_attempt(self):
+        if self.state == self.HALF_OPEN:
+            self._probing = True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def release_probe(self):
+        """探测请求没有结果（被取消或客户端离开）时让出半开名额"""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class Endpoint:
+    """一个可互换的上游部署"""
+
+    def __init__(
+        self,
+        name: str,
+        provider: str,
+        base_url: str,
+        api_key: str,
+        models: Dict[str, str],
+        api_version: Optional[str] = None,
+        upstream: Optional[HttpUpstream] = None,
+    ):
+        self.name = name
+        self.provider = provider
+        self.base_url = base_url
+        self.api_key = api_key
+        self.api_version = api_version
+        # 对外的模型名 -> 该部署上的模型/部署名
+        self.models = models
+        self.upstream = upstream or register_upstream(name, base_url, env_prefix=provider.upper())
+        self.breaker = CircuitBreaker()
+        self.ewma_ttft: Optional[float] = None
+        self.ewma_error = 0.0
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+
+    def upstream_model(self, model: str) -> str:
+        return self.models.get(model, model)
+
+    def score(self) -> float:
+        ttft = self.ewma_ttft if self.ewma_ttft is not None else ROUTER_DEFAULT_TTFT
+        return ttft * (1 + ROUTER_ERROR_PENALTY * self.ewma_error) * (1 + ROUTER_INFLIGHT_WEIGHT * self.inflight)
+
+    def record_success(self, ttft: Optional[float]):
+        if ttft is not None:
+            if self.ewma_ttft is None:
+                self.ewma_ttft = ttft
+            else:
+                self.ewma_ttft += ROUTER_EWMA_ALPHA * (ttft - self.ewma_ttft)
+        self.ewma_error -= ROUTER_EWMA_ALPHA * self.ewma_error
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.failures += 1
+        self.ewma_error += ROUTER_EWMA_ALPHA * (1 - self.ewma_error)
+        self.breaker.record_failure()
+
+    def stats(self) -> dict:
+        return {
+            "provider": self.provider,
+            "models": sorted(self.models),
+            "state": self.breaker.state,
+            "ewma_ttft_ms": round(self.ewma_ttft * 1000, 1) if self.ewma_ttft is not None else None,
+            "ewma_error": round(self.ewma_error, 4),
+            "inflight": self.inflight,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+# 带非空内容的增量（也匹配 R1 的 reasoning_content）；只有角色、空内容或用量的事件不算token
+_CONTENT_DELTA = re.compile(rb'"content":\s*"(?!")')
+
+
+def _content_events(item) -> int:
+    """一帧中带内容的SSE事件数；透传的原始字节可能包含多个事件"""
+    if isinstance(item, bytes):
+        if item == DONE_FRAME:
+            return 0
+        return len(_CONTENT_DELTA.findall(item))
+    if isinstance(item, str) and item.strip() == "data: [DONE]":
+        return 0
+    return 1
+
+
+def _is_retryable(error: StreamError) -> bool:
+    return error.status_code >= 500 or error.status_code in (408, 429)
+
+
+class _AttemptChannel:
+    """包装下游通道，记录一次尝试是否已发出首帧，首帧之前的错误先不上报以便切换部署"""
+
+    def __init__(self, target):
+        self._target = target
+        self.first_frame_at: Optional[float] = None
+        # 第一个带内容的帧，首token延迟以此计算；角色帧和 [DONE] 不算
+        self.first_token_at: Optional[float] = None
+        self.error: Optional[StreamError] = None
+        # 带内容的SSE事件数，每个内容事件约对应一个token
+        self.events = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._target.closed
+
+    @property
+    def sent(self) -> bool:
+        return self.first_frame_at is not None
+
+    async def send(self, item):
+        now = time.monotonic()
+        if self.first_frame_at is None:
+            self.first_frame_at = now
+        events = _content_events(item)
+        if events and self.first_token_at is None:
+            self.first_token_at = now
+        self.events += events
+        await self._target.send(item)
+
+    def close(self):
+        self._target.close()
+
+    def fail(self, detail: str, status_code: int = 500):
+        self.error = StreamError(detail, status_code)
+        if self.sent:
+            self._target.fail(detail, status_code)
+
+
+# 提供方流式函数，签名与 fetch_deepseek_response 相同，另加 endpoint 关键字参数
+Provider = Callable[..., Awaitable]
+
+
+class ModelRouter:
+    """模型名到多个部署的路由表
+
+    按 EWMA 首token延迟、错误率和进行中请求数给部署打分，选分数最低且未熔断的部署；
+    在发出首帧之前出现的可重试错误会自动切换到下一个部署。
+    """
+
+    def __init__(self):
+        self._providers: Dict[str, Provider] = {}
+        self._endpoints: Dict[str, Endpoint] = {}
+        self._routes: Dict[str, List[Endpoint]] = {}
+        self._stats = {
+            "failovers": 0,
+            "unavailable": 0,
+        }
+
+    def register_provider(self, name: str, provider: Provider):
+        self._providers[name] = provider
+
+    def register_endpoint(self, endpoint: Endpoint) -> Endpoint:
+        self._endpoints[endpoint.name] = endpoint
+        for model in endpoint.models:
+            routes = self._routes.setdefault(model, [])
+            if endpoint not in routes:
+                routes.append(endpoint)
+        return endpoint
+
+    def models(self) -> List[str]:
+        return list(self._routes)
+
+    def has_model(self, model: str) -> bool:
+        return bool(self._routes.get(model))
+
+    def endpoints(self, model: str) -> List[Endpoint]:
+        return list(self._routes.get(model, []))
+
+    def pick(self, model: str, exclude: Iterable[str] = ()) -> Optional[Endpoint]:
+        candidates = [
+            e for e in self._routes.get(model, [])
+            if e.name not in exclude and e.provider in self._providers and e.breaker.allow()
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda e: e.score())
+
+    async def stream(
+        self,
+        model: str,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        response_channel,
+        request: Optional[Request] = None,
+        exclude: Iterable[str] = (),
+        on_attempt: Optional[Callable[[Endpoint], None]] = None,
+        history: Optional[List[dict]] = None,
+    ):
+        """与 fetch_*_response 相同的流式接口，按路由选择部署并在首帧之前故障切换
+
+        exclude 为不参与选择的部署名；每次选中部署时调用 on_attempt(endpoint)；
+        history 为会话中之前的消息，原样交给提供方。
+        """
+        tried = set(exclude)
+        last_error: Optional[StreamError] = None
+        while not response_channel.closed:
+            endpoint = self.pick(model, exclude=tried)
+            if endpoint is None:
+                break
+            tried.add(endpoint.name)
+            if on_attempt is not None:
+                on_attempt(endpoint)
+
+            attempt = _AttemptChannel(response_channel)
+            provider = self._providers[endpoint.provider]
+            endpoint.breaker.on_attempt()
+            endpoint.inflight += 1
+            endpoint.requests += 1
+            started = time.monotonic()
+            try:
+                await provider(
+                    model, prompt, max_tokens, temperature, attempt, request,
+                    endpoint=endpoint, history=history
+                )
+            except asyncio.CancelledError:
+                endpoint.breaker.release_probe()
+                raise
+            finally:
+                endpoint.inflight -= 1
+
+            if attempt.error is None:
+                if attempt.sent:
+                    ttft = attempt.first_token_at - started if attempt.first_token_at is not None else None
+                    endpoint.record_success(ttft)
+                    self._observe(model, endpoint, attempt, started)
+                else:
+                    endpoint.breaker.release_probe()
+                return
+
+            upstream_errors_total.inc(provider=endpoint.provider, kind=upstream_error_kind(attempt.error.status_code))
+
+            if not _is_retryable(attempt.error):
+                # 请求本身有问题（如参数错误），不计入部署的健康状况
+                if not attempt.sent:
+                    response_channel.fail(attempt.error.detail, attempt.error.status_code)
+                return
+            endpoint.record_failure()
+            if attempt.sent:
+                # 已经有内容发给客户端，不能再切换
+                return
+            last_error = attempt.error
+            self._stats["failovers"] += 1
+            logger.warning(f"部署 {endpoint.name} 失败，尝试切换: {attempt.error.detail}")
+
+        if response_channel.closed:
+            return
+        self._stats["unavailable"] += 1
+        if last_error is not None:
+            response_channel.fail(last_error.detail, last_error.status_code)
+        else:
+            response_channel.fail(f"No available endpoint for model: {model}", 503)
+
+    @staticmethod
+    def _observe(model: str, endpoint: Endpoint, attempt: _AttemptChannel, started: float):
+        finished = time.monotonic()
+        labels = {"model": model, "provider": endpoint.provider}
+        stream_duration_seconds.observe(finished - started, **labels)
+        if attempt.first_token_at is None:
+            # 空回复没有首token，也没有生成速度
+            return
+        stream_ttft_seconds.observe(attempt.first_token_at - started, **labels)
+        generating = finished - attempt.first_token_at
+        if generating > 0 and attempt.events > 1:
+            stream_tokens_per_second.observe(attempt.events / generating, **labels)
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "endpoints": {name: e.stats() for name, e in self._endpoints.items()},
+        }
+
+
+def load_routes(router: ModelRouter, config: str):
+    """从JSON加载额外的部署，config 可以是JSON字符串或文件路径
+
+    [{"name": "deepseek-b", "provider": "deepseek", "url": "https://...",
+      "api_key_env": "DEEPSEEK_B_API_KEY", "models": {"DeepSeek-V3": "DeepSeek-V3"}}]
+    """
+    if os.path.exists(config):
+        with open(config, encoding="utf-8") as f:
+            entries = json.load(f)
+    else:
+        entries = json.loads(config)
+    for entry in entries:
+        models = entry["models"]
+        if isinstance(models, list):
+            models = {m: m for m in models}
+        api_key = entry.get("api_key") or os.getenv(entry.get("api_key_env", ""), "")
+        router.register_endpoint(Endpoint(
+            name=entry["name"],
+            provider=entry["provider"],
+            base_url=entry["url"],
+            api_key=api_key,
+            models=models,
+            api_version=entry.get("api_version"),
+        ))
+
+
+def load_routes_from_env(router: ModelRouter):
+    for config in (MODEL_ROUTES, MODEL_ROUTES_FILE):
+        if config:
+            load_routes(router, config)
+
+
+model_router = ModelRouter()
+register_stats("router", model_router.stats)
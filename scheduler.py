@@ -0,0 +1,292 @@
+import asyncio
+import collections
+import hashlib
+import math
+import os
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+from fastapi import HTTPException, Request
+
+from metrics import Gauge
+from stats import register_stats
+
+# 每个模型同时进行的上游请求上限，例如 "DeepSeek-R1=20,gpt-4o-mini=50"
+SCHEDULER_MODEL_LIMITS = os.getenv("SCHEDULER_MODEL_LIMITS", "")
+SCHEDULER_DEFAULT_LIMIT = int(os.getenv("SCHEDULER_DEFAULT_LIMIT", "32"))
+# 每个模型最多排队的请求数，超过直接返回429
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "200"))
+
+# 优先级类别：(轮询权重, 最长排队时间秒)
+PRIORITY_CLASSES = {
+    "interactive": (
+        float(os.getenv("SCHEDULER_INTERACTIVE_WEIGHT", "4")),
+        float(os.getenv("SCHEDULER_INTERACTIVE_MAX_WAIT", "10")),
+    ),
+    "tool": (
+        float(os.getenv("SCHEDULER_TOOL_WEIGHT", "2")),
+        float(os.getenv("SCHEDULER_TOOL_MAX_WAIT", "20")),
+    ),
+    "batch": (
+        float(os.getenv("SCHEDULER_BATCH_WEIGHT", "1")),
+        float(os.getenv("SCHEDULER_BATCH_MAX_WAIT", "60")),
+    ),
+}
+
+# 客户端可以用该请求头把自己的请求降级为批量任务
+PRIORITY_HEADER = "x-priority"
+
+
+def _parse_limits(value: str) -> Dict[str, int]:
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, limit = item.split("=", 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+def client_key(request: Request) -> str:
+    """识别请求方：优先使用登录令牌，其次使用nginx传来的真实IP"""
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        return "token:" + hashlib.sha1(authorization[7:].encode("utf-8")).hexdigest()[:16]
+    ip = request.headers.get("x-real-ip") or (request.client.host if request.client else "unknown")
+    return f"ip:{ip}"
+
+
+def request_priority(request: Request, feature: str = "chat") -> str:
+    requested = request.headers.get(PRIORITY_HEADER, "").lower()
+    if requested == "batch":
+        return "batch"
+    return "interactive" if feature == "chat" else "tool"
+
+
+class _DRRQueue:
+    """赤字轮询（Deficit Round Robin）队列：按键轮转出队，每个键每轮获得 quantum(key) 的额度"""
+
+    def __init__(self, quantum: Callable[[Hashable], float]):
+        self._quantum = quantum
+        self._queues: "collections.OrderedDict[Hashable, Deque[Any]]" = collections.OrderedDict()
+        self._deficit: Dict[Hashable, float] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, key: Hashable, item: Any):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+            self._deficit[key] = 0.0
+        queue.append(item)
+        self._size += 1
+
+    def pop(self) -> Any:
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            if self._deficit[key] < 1:
+                self._deficit[key] += self._quantum(key)
+                self._queues.move_to_end(key)
+                continue
+            item = queue.popleft()
+            self._deficit[key] -= 1
+            self._size -= 1
+            if not queue:
+                # 队列空了就清零额度，避免空闲的键攒下突发额度
+                del self._queues[key]
+                del self._deficit[key]
+            return item
+        return None
+
+    def remove(self, key: Hashable, item: Any) -> bool:
+        queue = self._queues.get(key)
+        if queue is None or item not in queue:
+            return False
+        queue.remove(item)
+        self._size -= 1
+        if not queue:
+            del self._queues[key]
+            del self._deficit[key]
+        return True
+
+    def count(self, key: Hashable) -> int:
+        queue = self._queues.get(key)
+        return len(queue) if queue else 0
+
+
+class _Waiter:
+    __slots__ = ("future", "user", "priority", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future, user: str, priority: str):
+        self.future = future
+        self.user = user
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+
+class _ModelQueue:
+    """单个模型的并发槽位与等待队列：类别之间按权重轮询，类别内按用户轮询"""
+
+    def __init__(self, model: str, limit: int):
+        self.model = model
+        self.limit = max(1, limit)
+        self.active = 0
+        self.classes = _DRRQueue(lambda cls: PRIORITY_CLASSES[cls][0])
+        self.users = {cls: _DRRQueue(lambda user: 1.0) for cls in PRIORITY_CLASSES}
+        self.ewma_hold = 1.0
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected": 0,
+            "timeouts": 0,
+        }
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return len(self.classes)
+
+    def push(self, waiter: _Waiter):
+        self.classes.push(waiter.priority, waiter.priority)
+        self.users[waiter.priority].push(waiter.user, waiter)
+
+    def pop(self) -> Optional[_Waiter]:
+        priority = self.classes.pop()
+        if priority is None:
+            return None
+        return self.users[priority].pop()
+
+    def remove(self, waiter: _Waiter) -> bool:
+        if self.users[waiter.priority].remove(waiter.user, waiter):
+            self.classes.remove(waiter.priority, waiter.priority)
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        """按平均占用时长估算排到的时间"""
+        estimate = self.ewma_hold * (self.waiting + 1) / self.limit
+        return max(1, min(60, math.ceil(estimate)))
+
+
+class Slot:
+    """已获得的并发槽位，上游结束后必须 release"""
+
+    def __init__(self, scheduler: "UpstreamScheduler", model_queue: _ModelQueue):
+        self._scheduler = scheduler
+        self._queue = model_queue
+        self._acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._scheduler._release(self._queue, time.monotonic() - self._acquired_at)
+
+    async def hold(self, awaitable: Awaitable):
+        """执行上游协程，结束（包括取消）时释放槽位"""
+        try:
+            return await awaitable
+        finally:
+            self.release()
+
+
+class UpstreamScheduler:
+    """上游LLM并发的准入控制与加权公平调度"""
+
+    def __init__(self):
+        self.limits = _parse_limits(SCHEDULER_MODEL_LIMITS)
+        self._queues: Dict[str, _ModelQueue] = {}
+
+    def _queue(self, model: str) -> _ModelQueue:
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = _ModelQueue(model, self.limits.get(model, SCHEDULER_DEFAULT_LIMIT))
+        return queue
+
+    def _reject(self, queue: _ModelQueue, detail: str):
+        raise HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(queue.retry_after())},
+        )
+
+    async def acquire(self, model: str, user: str, priority: str = "interactive") -> Slot:
+        if priority not in PRIORITY_CLASSES:
+            priority = "interactive"
+        queue = self._queue(model)
+
+        if queue.active < queue.limit and queue.waiting == 0:
+            queue.active += 1
+            queue.stats["admitted"] += 1
+            return Slot(self, queue)
+
+        if queue.waiting >= SCHEDULER_MAX_QUEUE:
+            queue.stats["rejected"] += 1
+            self._reject(queue, f"Too many requests for {model}, please retry later")
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), user, priority)
+        queue.push(waiter)
+        queue.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), PRIORITY_CLASSES[priority][1])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if not queue.remove(waiter):
+                # 刚好在超时的同时被分配到了槽位，交还给下一个等待者
+                self._release(queue, 0.0, count_hold=False)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            queue.stats["timeouts"] += 1
+            self._reject(queue, f"Request for {model} waited too long in queue, please retry later")
+
+        waited = time.monotonic() - waiter.enqueued_at
+        queue.wait_total += waited
+        queue.wait_max = max(queue.wait_max, waited)
+        queue.stats["admitted"] += 1
+        return Slot(self, queue)
+
+    def _release(self, queue: _ModelQueue, held: float, count_hold: bool = True):
+        if count_hold:
+            queue.ewma_hold += 0.2 * (held - queue.ewma_hold)
+        queue.active -= 1
+        while queue.active < queue.limit:
+            waiter = queue.pop()
+            if waiter is None:
+                break
+            if waiter.future.done():
+                continue
+            queue.active += 1
+            waiter.future.set_result(None)
+
+    def stats(self) -> dict:
+        result = {}
+        for model, queue in self._queues.items():
+            queued = queue.stats["queued"]
+            result[model] = {
+                "limit": queue.limit,
+                "active": queue.active,
+                "waiting": queue.waiting,
+                "waiting_by_class": {cls: queue.classes.count(cls) for cls in PRIORITY_CLASSES},
+                "avg_wait_ms": round(queue.wait_total / queued * 1000, 1) if queued else 0.0,
+                "max_wait_ms": round(queue.wait_max * 1000, 1),
+                **queue.stats,
+            }
+        return result
+
+    def queue_depths(self):
+        for model, queue in self._queues.items():
+            for cls in PRIORITY_CLASSES:
+                yield {"model": model, "priority": cls}, queue.classes.count(cls)
+
+    def active_slots(self):
+        for model, queue in self._queues.items():
+            yield {"model": model}, queue.active
+
+
+upstream_scheduler = UpstreamScheduler()
+register_stats("scheduler", upstream_scheduler.stats)
+Gauge("scheduler_queue_depth", "Requests waiting for an upstream slot", ("model", "priority"),
+      collect=upstream_scheduler.queue_depths)
+Gauge("scheduler_active_slots", "Upstream slots in use", ("model",), collect=upstream_scheduler.active_slots)
@@ -14,4 +14,30 @@ CREATE TABLE IF NOT EXISTS users (
 
 -- 创建索引
 CREATE INDEX idx_username ON users(username);
-CREATE INDEX idx_email ON users(email);
\ No newline at end of file
+CREATE INDEX idx_email ON users(email);
+
+-- 创建会话表
+CREATE TABLE IF NOT EXISTS conversations (
+    id CHAR(32) PRIMARY KEY,
+    user_id INT NOT NULL,
+    title VARCHAR(100) NOT NULL DEFAULT '',
+    message_count INT NOT NULL DEFAULT 0,
+    created_at DATETIME(3) NOT NULL,
+    updated_at DATETIME(3) NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- 会话列表按 (updated_at, id) 键集分页
+CREATE INDEX idx_user_updated ON conversations(user_id, updated_at, id);
+
+-- 创建会话消息表
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    conversation_id CHAR(32) NOT NULL,
+    seq INT NOT NULL,
+    role VARCHAR(20) NOT NULL,
+    content MEDIUMTEXT NOT NULL,
+    created_at DATETIME(3) NOT NULL,
+    UNIQUE KEY uk_conversation_seq (conversation_id, seq),
+    FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+);
@@ -0,0 +1,200 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from stats import register_stats
+from streaming import DONE_FRAME, EMPTY, ChannelClosed, StreamError
+from supervisor import upstream_supervisor
+
+# 相同请求合并为一次上游生成，设置 SINGLE_FLIGHT_ENABLED=false 关闭
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+
+
+class BroadcastChannel:
+    """一个上游生成，广播给多个订阅者
+
+    对生产者提供与 StreamChannel 相同的 send/close/fail 接口。已产生的帧全部保留，
+    后加入的订阅者先收到已有的帧，再跟随实时流。
+    """
+
+    def __init__(self, on_done: Optional[Callable[[List[Any]], Awaitable]] = None):
+        self.frames: List[Any] = []
+        self.error: Optional[StreamError] = None
+        self.task: Optional[asyncio.Task] = None
+        self._on_done = on_done
+        self._closed = False
+        self._subscribers = 0
+        self._update: Optional[asyncio.Future] = None
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def subscribers(self) -> int:
+        return self._subscribers
+
+    def _notify(self):
+        if self._update is not None and not self._update.done():
+            self._update.set_result(None)
+        self._update = None
+
+    async def wait(self):
+        """等待新的帧或流结束"""
+        if self._update is None:
+            self._update = asyncio.get_running_loop().create_future()
+        # 共享同一个future，单个订阅者被取消时不能影响其他订阅者
+        await asyncio.shield(self._update)
+
+    async def send(self, item: Any):
+        if self._closed:
+            raise ChannelClosed()
+        self.frames.append(item)
+        self._notify()
+        if item == DONE_FRAME and self._on_done is not None:
+            on_done, self._on_done = self._on_done, None
+            await on_done(list(self.frames))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._notify()
+        for listener in self._listeners:
+            listener()
+        self._listeners.clear()
+
+    def fail(self, detail: str, status_code: int = 500):
+        if self._closed:
+            return
+        self.error = StreamError(detail, status_code)
+        self._on_done = None
+        self.close()
+
+    def add_close_listener(self, listener: Callable[[], None]):
+        self._listeners.append(listener)
+
+    def subscribe(self) -> "Subscription":
+        self._subscribers += 1
+        return Subscription(self)
+
+    def _unsubscribe(self) -> bool:
+        """返回 True 表示最后一个订阅者离开后取消了上游"""
+        self._subscribers -= 1
+        if self._subscribers > 0 or self._closed:
+            return False
+        self._on_done = None
+        self.close()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        return True
+
+
+class Subscription:
+    """订阅者视图，接口与 StreamChannel 的消费端一致，可直接交给 stream_from_channel"""
+
+    def __init__(self, broadcast: BroadcastChannel):
+        self._broadcast = broadcast
+        self._index = 0
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        broadcast = self._broadcast
+        while self._index >= len(broadcast.frames):
+            if broadcast.closed or self._closed:
+                if broadcast.error is not None:
+                    raise broadcast.error
+                raise StopAsyncIteration
+            await broadcast.wait()
+        item = broadcast.frames[self._index]
+        self._index += 1
+        return item
+
+    def receive_nowait(self) -> Any:
+        broadcast = self._broadcast
+        if self._index >= len(broadcast.frames):
+            if broadcast.closed or self._closed:
+                if broadcast.error is not None:
+                    raise broadcast.error
+                raise ChannelClosed()
+            return EMPTY
+        item = broadcast.frames[self._index]
+        self._index += 1
+        return item
+
+    async def wait_readable(self, timeout: float):
+        broadcast = self._broadcast
+        if self._index < len(broadcast.frames) or broadcast.closed or self._closed:
+            return
+        try:
+            await asyncio.wait_for(broadcast.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._broadcast._unsubscribe():
+            single_flight.note_cancelled()
+
+
+class SingleFlight:
+    """按请求键合并并发中的相同请求"""
+
+    def __init__(self):
+        self.enabled = SINGLE_FLIGHT_ENABLED
+        self._inflight: Dict[str, BroadcastChannel] = {}
+        self._stats = {
+            "started": 0,
+            "joined": 0,
+            "cancelled": 0,
+        }
+
+    def is_inflight(self, key: str) -> bool:
+        broadcast = self._inflight.get(key)
+        return broadcast is not None and not broadcast.closed
+
+    def join(
+        self,
+        key: str,
+        start: Callable[[BroadcastChannel], Awaitable],
+        on_done: Optional[Callable[[List[Any]], Awaitable]] = None
+    ) -> Subscription:
+        """加入 key 对应的进行中生成；没有时调用 start(channel) 启动新的上游任务"""
+        broadcast = self._inflight.get(key)
+        if broadcast is not None and not broadcast.closed:
+            self._stats["joined"] += 1
+            return broadcast.subscribe()
+
+        broadcast = BroadcastChannel(on_done=on_done)
+        self._inflight[key] = broadcast
+        broadcast.add_close_listener(lambda: self._forget(key, broadcast))
+        subscription = broadcast.subscribe()
+        # 生产者异常退出或超时由托管方结束通道；最后一个订阅者离开时在 _unsubscribe 中取消
+        broadcast.task = upstream_supervisor.spawn(broadcast, start, label=f"single_flight:{key[:12]}")
+        self._stats["started"] += 1
+        return subscription
+
+    def _forget(self, key: str, broadcast: BroadcastChannel):
+        if self._inflight.get(key) is broadcast:
+            del self._inflight[key]
+
+    def note_cancelled(self):
+        self._stats["cancelled"] += 1
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "inflight": len(self._inflight),
+            "subscribers": sum(b.subscribers for b in self._inflight.values()),
+            **self._stats,
+        }
+
+
+single_flight = SingleFlight()
+register_stats("single_flight", single_flight.stats)
@@ -0,0 +1,257 @@
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+
+from base import app
+from logs import get_logger
+from stats import register_stats
+
+try:
+    import brotli
+except ImportError:  # 未安装时只提供gzip（pip install brotli）
+    brotli = None
+
+logger = get_logger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 前端构建输出目录（chat_vue 下 npm run build 的结果）
+STATIC_DIR = os.getenv("STATIC_DIR", os.path.join(BASE_DIR, "chat_vue", "dist"))
+# 小于该字节数的文件不压缩
+STATIC_COMPRESS_MIN_BYTES = int(os.getenv("STATIC_COMPRESS_MIN_BYTES", "1024"))
+# 检查构建目录是否变化的间隔（秒），0 表示只在启动时加载
+STATIC_RELOAD_INTERVAL = float(os.getenv("STATIC_RELOAD_INTERVAL", "2"))
+
+# vite 的 assetsDir（默认 assets），其中的文件名都带内容哈希，如 assets/index-B3x_9aZk.js，内容变化时文件名随之变化；
+# public/ 中原样复制的文件（favicon.ico、robots.txt 等）文件名固定，不能长期缓存
+STATIC_HASHED_DIR = os.getenv("STATIC_HASHED_DIR", "assets").strip("/")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# index.html 等固定文件名每次都向服务端验证，依赖ETag返回304
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/manifest+json")
+# 这些前缀属于后端接口，不回退到前端页面
+API_PREFIXES = ("api/", "v1/", "ws")
+
+mimetypes.add_type("application/javascript", ".js")
+mimetypes.add_type("application/javascript", ".mjs")
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+
+class _Asset:
+    """一个静态文件及其预压缩版本，编码 -> (内容, ETag)"""
+
+    __slots__ = ("content_type", "cache_control", "variants")
+
+    def __init__(self, path: str, data: bytes):
+        # path 为构建目录中的相对路径，使用 / 分隔
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        self.content_type = content_type
+        hashed = bool(STATIC_HASHED_DIR) and path.startswith(STATIC_HASHED_DIR + "/")
+        self.cache_control = IMMUTABLE_CACHE_CONTROL if hashed else REVALIDATE_CACHE_CONTROL
+        digest = hashlib.blake2b(data, digest_size=12).hexdigest()
+        self.variants: Dict[str, Tuple[bytes, str]] = {"identity": (data, f'"{digest}"')}
+        if len(data) < STATIC_COMPRESS_MIN_BYTES or not content_type.startswith(COMPRESSIBLE_TYPES):
+            return
+        # 不同内容编码是不同的表示，强ETag各不相同
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) < len(data):
+            self.variants["gzip"] = (compressed, f'"{digest}-gz"')
+        if brotli is not None:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data):
+                self.variants["br"] = (compressed, f'"{digest}-br"')
+
+
+def _accepted_encodings(header: str) -> Dict[str, float]:
+    accepted = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    return accepted
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # If-None-Match 使用弱比较
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+class StaticAssetCache:
+    """把前端构建输出整体加载到内存，按 Accept-Encoding 返回预压缩版本
+
+    文件名带哈希的资源长期缓存，其余（index.html）每次验证ETag；构建目录变化时后台重新加载。
+    """
+
+    def __init__(self, directory: str = STATIC_DIR):
+        self.directory = directory
+        self._assets: Dict[str, _Asset] = {}
+        self._signature: Optional[tuple] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._loaded_at = 0.0
+        self._stats = {
+            "reloads": 0,
+            "hits": 0,
+            "not_modified": 0,
+            "misses": 0,
+            "served_identity": 0,
+            "served_gzip": 0,
+            "served_br": 0,
+        }
+
+    def _scan(self) -> tuple:
+        """构建目录的签名：所有文件的 (相对路径, 大小, 修改时间)"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((os.path.relpath(path, self.directory), st.st_size, st.st_mtime_ns))
+        return tuple(sorted(entries))
+
+    def _load(self, signature: tuple) -> Dict[str, _Asset]:
+        assets = {}
+        for rel_path, _, _ in signature:
+            try:
+                with open(os.path.join(self.directory, rel_path), "rb") as f:
+                    data = f.read()
+            except OSError:
+                continue
+            path = rel_path.replace(os.sep, "/")
+            assets[path] = _Asset(path, data)
+        return assets
+
+    def reload(self) -> bool:
+        """目录有变化时重新加载，返回是否重新加载（在线程中执行，压缩比较耗CPU）"""
+        signature = self._scan()
+        if signature == self._signature:
+            return False
+        assets = self._load(signature)
+        # 整体替换，读取方不会看到加载到一半的索引
+        self._assets = assets
+        self._signature = signature
+        self._loaded_at = time.time()
+        self._stats["reloads"] += 1
+        logger.info(f"从 {self.directory} 加载了 {len(assets)} 个文件")
+        return True
+
+    async def start(self):
+        if not os.path.isdir(self.directory):
+            logger.warning(f"构建目录不存在: {self.directory}（cd chat_vue && npm run build）")
+        else:
+            await asyncio.to_thread(self.reload)
+        if STATIC_RELOAD_INTERVAL > 0 and (self._watcher is None or self._watcher.done()):
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(STATIC_RELOAD_INTERVAL)
+            try:
+                await asyncio.to_thread(self.reload)
+            except Exception as e:
+                logger.error(f"重新加载失败: {e}")
+
+    def get(self, path: str) -> Optional[_Asset]:
+        return self._assets.get(path)
+
+    def response(self, request: Request, path: str) -> Response:
+        asset = self._assets.get(path)
+        if asset is None:
+            self._stats["misses"] += 1
+            raise HTTPException(status_code=404, detail="Not Found")
+        self._stats["hits"] += 1
+
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and accepted.get(candidate, 0) > 0:
+                encoding = candidate
+                break
+        body, etag = asset.variants[encoding]
+        headers = {
+            "ETag": etag,
+            "Cache-Control": asset.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            self._stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        self._stats[f"served_{encoding}"] += 1
+        # HEAD 请求由服务器丢弃响应体，保留正确的 Content-Length
+        return Response(body, headers=headers, media_type=asset.content_type)
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "files": len(self._assets),
+            "bytes": sum(len(a.variants["identity"][0]) for a in self._assets.values()),
+            "compressed_bytes": sum(
+                len(v[0]) for a in self._assets.values() for k, v in a.variants.items() if k != "identity"
+            ),
+            "brotli": brotli is not None,
+            "loaded_at": self._loaded_at,
+            **self._stats,
+        }
+
+
+static_assets = StaticAssetCache()
+register_stats("static", static_assets.stats)
+
+
+@app.on_event("startup")
+async def start_static_assets():
+    await static_assets.start()
+
+
+@app.on_event("shutdown")
+async def stop_static_assets():
+    await static_assets.stop()
+
+
+@app.api_route("/", methods=["GET", "HEAD"])
+@app.api_route("/index", methods=["GET", "HEAD"])
+@app.api_route("/index.html", methods=["GET", "HEAD"])
+async def read_index(request: Request):
+    """前端入口页面"""
+    return static_assets.response(request, "index.html")
+
+
+# 需要最后注册：前面的接口路由优先匹配
+@app.api_route("/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def read_static(request: Request, path: str):
+    """构建目录中的文件；前端路由（如 /chat、/login）回退到 index.html"""
+    if static_assets.get(path) is not None:
+        return static_assets.response(request, path)
+    if path.startswith(API_PREFIXES) or "." in path.rsplit("/", 1)[-1]:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return static_assets.response(request, "index.html")
@@ -0,0 +1,27 @@
+from typing import Callable, Dict
+
+from base import app
+
+# 各子系统注册的运行时统计，名称 -> 返回字典的函数
+_providers: Dict[str, Callable[[], dict]] = {}
+
+
+def register_stats(name: str, provider: Callable[[], dict]):
+    """注册一个统计来源，在 /api/v1/stats 中以 name 为键输出"""
+    _providers[name] = provider
+
+
+def collect_stats() -> Dict[str, dict]:
+    result = {}
+    for name, provider in _providers.items():
+        try:
+            result[name] = provider()
+        except Exception as e:
+            result[name] = {"error": str(e)}
+    return result
+
+
+@app.get("/api/v1/stats")
+async def get_stats():
+    """返回连接池、缓存等子系统的运行时统计"""
+    return collect_stats()
@@ -0,0 +1,288 @@
+import asyncio
+import collections
+import json
+import os
+from typing import Any, AsyncIterator, Callable, Deque, List, Optional
+
+from fastapi import HTTPException
+
+from metrics import active_streams, client_disconnects_total
+
+# 每个流的缓冲上限（帧数），写满后生产者挂起，从而把背压传递到上游读取
+STREAM_CHANNEL_SIZE = int(os.getenv("STREAM_CHANNEL_SIZE", "256"))
+
+# 合并写出：首帧立即发出，之后每隔 STREAM_COALESCE_INTERVAL 秒把通道中积攒的帧合并为一次写出，
+# 积攒超过 STREAM_COALESCE_BYTES 字节时提前写出；间隔为 0 时有多少写多少，不等待
+STREAM_COALESCE_INTERVAL = float(os.getenv("STREAM_COALESCE_INTERVAL", "0.02"))
+STREAM_COALESCE_BYTES = int(os.getenv("STREAM_COALESCE_BYTES", "4096"))
+
+# 上游已经是标准SSE时按原始字节透传，不逐行解码和解析JSON；设置为 false 时逐行过滤空内容帧
+STREAM_RELAY_RAW = os.getenv("STREAM_RELAY_RAW", "true").lower() in ("1", "true", "yes", "on")
+
+# 生产者在流正常结束时发送的最后一帧，预先编码
+DONE_FRAME = b"data: [DONE]\n\n"
+
+# receive_nowait 在通道暂时没有数据时的返回值
+EMPTY = object()
+
+
+class ChannelClosed(Exception):
+    """通道已关闭：消费者已离开，或流已结束"""
+
+
+class StreamError(Exception):
+    """生产者通过带外方式上报的流错误"""
+
+    def __init__(self, detail: str, status_code: int = 500):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+class StreamChannel:
+    """fetch_*_response 生产者与 SSE 消费者之间的有界异步通道
+
+    - send() 在缓冲区满时挂起，直到消费者取走数据（背压）
+    - 消费者在无数据时挂起等待唤醒，不做轮询
+    - 结束与错误通过 close()/fail() 带外通知，不占用数据槽位
+    """
+
+    def __init__(self, maxsize: int = STREAM_CHANNEL_SIZE):
+        self._maxsize = max(1, maxsize)
+        self._buffer: Deque[Any] = collections.deque()
+        self._getters: Deque[asyncio.Future] = collections.deque()
+        self._putters: Deque[asyncio.Future] = collections.deque()
+        self._closed = False
+        self._listeners: List[Callable[[], None]] = []
+        self.error: Optional[StreamError] = None
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def qsize(self) -> int:
+        return len(self._buffer)
+
+    def full(self) -> bool:
+        return len(self._buffer) >= self._maxsize
+
+    @staticmethod
+    def _wake_one(waiters: Deque[asyncio.Future]):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    @staticmethod
+    def _wake_all(waiters: Deque[asyncio.Future]):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def send(self, item: Any):
+        """写入一帧；缓冲区满时等待，通道关闭时抛出 ChannelClosed"""
+        while self.full() and not self._closed:
+            waiter = asyncio.get_running_loop().create_future()
+            self._putters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                waiter.cancel()
+                # 被唤醒后又被取消时，把空出的槽位让给下一个生产者
+                if not self.full():
+                    self._wake_one(self._putters)
+                raise
+
+        if self._closed:
+            raise ChannelClosed()
+
+        self._buffer.append(item)
+        self._wake_one(self._getters)
+
+    async def receive(self) -> Any:
+        """读取一帧；先取完缓冲区，再上报错误或结束"""
+        while not self._buffer:
+            if self._closed:
+                if self.error is not None:
+                    raise self.error
+                raise ChannelClosed()
+
+            waiter = asyncio.get_running_loop().create_future()
+            self._getters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                waiter.cancel()
+                if self._buffer:
+                    self._wake_one(self._getters)
+                raise
+
+        item = self._buffer.popleft()
+        self._wake_one(self._putters)
+        return item
+
+    def receive_nowait(self) -> Any:
+        """有数据时立即返回一帧，否则返回 EMPTY；流结束或出错时与 receive 相同"""
+        if not self._buffer:
+            if self._closed:
+                if self.error is not None:
+                    raise self.error
+                raise ChannelClosed()
+            return EMPTY
+        item = self._buffer.popleft()
+        self._wake_one(self._putters)
+        return item
+
+    async def wait_readable(self, timeout: float):
+        """等待到有数据、通道关闭或超时"""
+        if self._buffer or self._closed:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._getters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def close(self):
+        """标记流结束，唤醒所有等待中的生产者和消费者"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake_all(self._getters)
+        self._wake_all(self._putters)
+        for listener in self._listeners:
+            listener()
+        self._listeners.clear()
+
+    def fail(self, detail: str, status_code: int = 500):
+        """上报错误并关闭通道"""
+        if self._closed:
+            return
+        self.error = StreamError(detail, status_code)
+        self.close()
+
+    def add_close_listener(self, listener: Callable[[], None]):
+        """通道关闭（生产者结束或消费者离开）时调用 listener"""
+        if self._closed:
+            listener()
+            return
+        self._listeners.append(listener)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return await self.receive()
+        except ChannelClosed:
+            raise StopAsyncIteration
+
+
+def sse_frame(item: Any) -> str:
+    """把通道中的条目格式化为 SSE 帧"""
+    # 直接发送item，不额外添加data:前缀（如果是DeepSeek原始响应，已经包含data:前缀）
+    if isinstance(item, str) and item.startswith("data: "):
+        return item if item.endswith("\n\n") else item + "\n\n"
+    return f"data: {item}\n\n"
+
+
+def encode_frame(item: Any) -> bytes:
+    """通道中的条目转为要写出的字节；生产者已编码好的字节原样透传"""
+    if isinstance(item, bytes):
+        return item
+    return sse_frame(item).encode("utf-8")
+
+
+async def relay_sse_events(source: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """把上游原始字节切成完整的SSE事件块转发，不解码不解析
+
+    只在事件边界（空行）处切分，保证每块都由完整事件组成；上游自带的 [DONE] 去掉，
+    由生产者在结束时统一发送 DONE_FRAME。
+    """
+    pending = b""
+    done = DONE_FRAME.strip()
+    async for data in source:
+        pending += data
+        if b"\r" in pending:
+            # 统一为 \n；\r\n 可能被拆在两个块之间，末尾的 \r 留到下一块再处理
+            tail = b"\r" if pending.endswith(b"\r") else b""
+            pending = pending[:len(pending) - len(tail)].replace(b"\r\n", b"\n").replace(b"\r", b"\n") + tail
+        cut = pending.rfind(b"\n\n")
+        if cut < 0:
+            continue
+        events, pending = pending[:cut + 2], pending[cut + 2:]
+        if done in events:
+            # [DONE] 可能与其它事件在同一块中，按事件边界逐个去掉
+            events = b"".join(event + b"\n\n" for event in events.split(b"\n\n") if event and event != done)
+        if events:
+            yield events
+    pending = pending.strip()
+    if pending and pending != done:
+        yield pending + b"\n\n"
+
+
+def frames_text(frames: List[Any]) -> str:
+    """从SSE帧中拼出完整回复"""
+    raw = "".join(f.decode("utf-8", "replace") if isinstance(f, bytes) else sse_frame(f) for f in frames)
+    parts = []
+    for line in raw.split("\n"):
+        if not line.startswith("data: ") or line == "data: [DONE]":
+            continue
+        try:
+            data = json.loads(line[6:])
+        except json.JSONDecodeError:
+            continue
+        choices = data.get("choices") if isinstance(data, dict) else None
+        if choices:
+            content = choices[0].get("delta", {}).get("content")
+            if content:
+                parts.append(content)
+    return "".join(parts)
+
+
+async def stream_from_channel(
+    channel: StreamChannel,
+    coalesce_interval: float = STREAM_COALESCE_INTERVAL,
+    coalesce_bytes: int = STREAM_COALESCE_BYTES
+) -> AsyncIterator[bytes]:
+    """从通道中流式输出 SSE 帧，把积攒的多帧合并为一次写出以减少系统调用"""
+    loop = asyncio.get_running_loop()
+    first = True
+    finished = False
+    active_streams.inc()
+    try:
+        async for item in channel:
+            chunk = [encode_frame(item)]
+            size = len(chunk[0])
+            # 首帧不等待，保证首token延迟
+            deadline = loop.time() + (0 if first else coalesce_interval)
+            first = False
+            while size < coalesce_bytes:
+                try:
+                    item = channel.receive_nowait()
+                except (ChannelClosed, StreamError):
+                    # 先把已取出的帧写出，结束/错误在下一轮 receive 时处理
+                    break
+                if item is EMPTY:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    await channel.wait_readable(remaining)
+                    continue
+                frame = encode_frame(item)
+                chunk.append(frame)
+                size += len(frame)
+            yield chunk[0] if len(chunk) == 1 else b"".join(chunk)
+        finished = True
+    except StreamError as e:
+        finished = True
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    finally:
+        active_streams.dec()
+        if not finished:
+            client_disconnects_total.inc(stage="before_first_frame" if first else "mid_stream")
+        # 消费者离开（客户端断开或流结束）时关闭通道，让生产者立即停止读取上游
+        channel.close()
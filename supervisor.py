@@ -0,0 +1,241 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from base import app
+from logs import get_logger
+from metrics import Counter, Gauge
+from stats import register_stats
+
+logger = get_logger(__name__)
+
+# 单次生成从开始到结束的总时限（秒），0 表示不限制
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", "600"))
+# 上游两帧之间（包括首帧之前）允许的最长空闲（秒），0 表示不限制；等待慢客户端读取的时间不计入
+UPSTREAM_IDLE_TIMEOUT = float(os.getenv("UPSTREAM_IDLE_TIMEOUT", "90"))
+# 取消后超过该时间（秒）仍未退出的任务记为孤儿任务
+UPSTREAM_ORPHAN_GRACE = float(os.getenv("UPSTREAM_ORPHAN_GRACE", "5"))
+# 检查时限的间隔（秒）
+UPSTREAM_SWEEP_INTERVAL = float(os.getenv("UPSTREAM_SWEEP_INTERVAL", "1"))
+
+upstream_cancellations_total = Counter(
+    "upstream_cancellations_total", "Upstream generations stopped before they finished", ("reason",)
+)
+
+
+class _Job:
+    __slots__ = (
+        "label", "channel", "task", "started", "last_activity", "sending",
+        "running", "finished", "deadline", "idle_timeout", "cancel_reason", "cancelled_at", "orphan_reported",
+    )
+
+    def __init__(self, label: str, channel, deadline: float, idle_timeout: float):
+        self.label = label
+        self.channel = channel
+        self.task: Optional[asyncio.Task] = None
+        self.started = self.last_activity = time.monotonic()
+        self.sending = False
+        # 任务已开始执行；在此之前取消会丢弃未启动的协程，其中的 finally 都不会执行
+        self.running = False
+        # 生产者自己调用了 close/fail
+        self.finished = False
+        self.deadline = deadline
+        self.idle_timeout = idle_timeout
+        self.cancel_reason: Optional[str] = None
+        self.cancelled_at = 0.0
+        self.orphan_reported = False
+
+
+class _SupervisedChannel:
+    """交给生产者的通道视图：记录上游活动时间，并区分生产者结束和外部关闭"""
+
+    def __init__(self, channel, job: _Job):
+        self._channel = channel
+        self._job = job
+
+    @property
+    def closed(self) -> bool:
+        return self._channel.closed
+
+    async def send(self, item):
+        job = self._job
+        job.last_activity = time.monotonic()
+        # 通道写满时等待的是客户端，不算上游空闲
+        job.sending = True
+        try:
+            await self._channel.send(item)
+        finally:
+            job.sending = False
+            job.last_activity = time.monotonic()
+
+    def close(self):
+        self._job.finished = True
+        self._channel.close()
+
+    def fail(self, detail: str, status_code: int = 500):
+        self._job.finished = True
+        self._channel.fail(detail, status_code)
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+
+class UpstreamSupervisor:
+    """托管每个请求的上游生成任务
+
+    - 消费者离开（通道被外部关闭）时立即取消任务，httpx 连接随之释放，调度槽位在 slot.hold 中归还
+    - 超过总时限或空闲超时时向客户端报告504并取消任务
+    - 生产者异常退出而没有关闭通道时替它结束通道，避免客户端一直等待
+    - 取消后迟迟不退出的任务记为孤儿任务，在统计和指标中报告
+    """
+
+    def __init__(self, deadline: float = UPSTREAM_DEADLINE, idle_timeout: float = UPSTREAM_IDLE_TIMEOUT):
+        self.deadline = deadline
+        self.idle_timeout = idle_timeout
+        self._jobs: Dict[asyncio.Task, _Job] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self._stats = {
+            "started": 0,
+            "completed": 0,
+            "crashed": 0,
+            "disconnected": 0,
+            "deadline_exceeded": 0,
+            "idle_timeout": 0,
+            "shutdown": 0,
+        }
+
+    def spawn(
+        self,
+        channel,
+        start: Callable[[object], Awaitable],
+        label: str = "",
+        deadline: Optional[float] = None,
+        idle_timeout: Optional[float] = None
+    ) -> asyncio.Task:
+        """启动 start(channel) 并托管；channel 需提供 add_close_listener"""
+        job = _Job(
+            label,
+            channel,
+            self.deadline if deadline is None else deadline,
+            self.idle_timeout if idle_timeout is None else idle_timeout,
+        )
+        job.task = asyncio.create_task(self._run(job, start))
+        self._jobs[job.task] = job
+        self._stats["started"] += 1
+        job.task.add_done_callback(lambda _: self._on_done(job))
+        channel.add_close_listener(lambda: self._on_channel_closed(job))
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep())
+        return job.task
+
+    @staticmethod
+    async def _run(job: _Job, start: Callable[[object], Awaitable]):
+        job.running = True
+        if job.cancel_reason is not None:
+            # 启动前就被取消：仍先进入生产者协程，让 slot.hold、会话锁等的 finally 在第一次挂起时执行
+            job.task.cancel()
+        return await start(_SupervisedChannel(job.channel, job))
+
+    def _on_channel_closed(self, job: _Job):
+        if job.finished or job.task.done():
+            return
+        # 不是生产者关闭的通道：消费者已离开
+        self._cancel(job, "disconnected")
+
+    def _cancel(self, job: _Job, reason: str, detail: Optional[str] = None):
+        if job.cancel_reason is not None:
+            return
+        job.cancel_reason = reason
+        job.cancelled_at = time.monotonic()
+        self._stats[reason] += 1
+        upstream_cancellations_total.inc(reason=reason)
+        if detail is not None:
+            job.channel.fail(detail, 504)
+        # 尚未开始执行的任务推迟到 _run 中取消
+        if job.running:
+            job.task.cancel()
+
+    def _on_done(self, job: _Job):
+        self._jobs.pop(job.task, None)
+        if job.orphan_reported:
+            logger.warning(f"孤儿任务 {job.label} 在取消 {time.monotonic() - job.cancelled_at:.1f} 秒后退出")
+        if job.task.cancelled():
+            if not job.channel.closed:
+                job.channel.close()
+            return
+        error = job.task.exception()
+        if error is not None:
+            self._stats["crashed"] += 1
+            logger.error(f"上游任务 {job.label} 异常退出: {error!r}", exc_info=error)
+            job.channel.fail(f"Upstream task failed: {error}", 500)
+        else:
+            self._stats["completed"] += 1
+            if not job.finished:
+                job.channel.close()
+
+    async def _sweep(self):
+        while self._jobs:
+            await asyncio.sleep(UPSTREAM_SWEEP_INTERVAL)
+            now = time.monotonic()
+            for job in list(self._jobs.values()):
+                if job.cancel_reason is not None:
+                    if not job.orphan_reported and now - job.cancelled_at > UPSTREAM_ORPHAN_GRACE:
+                        job.orphan_reported = True
+                        logger.warning(f"任务 {job.label} 因 {job.cancel_reason} 取消后 "
+                                       f"{now - job.cancelled_at:.1f} 秒仍未退出")
+                    continue
+                if job.deadline > 0 and now - job.started > job.deadline:
+                    self._cancel(job, "deadline_exceeded", f"Upstream deadline of {job.deadline:g}s exceeded")
+                elif job.idle_timeout > 0 and not job.sending and now - job.last_activity > job.idle_timeout:
+                    self._cancel(job, "idle_timeout", f"Upstream idle for more than {job.idle_timeout:g}s")
+
+    def orphans(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "label": job.label,
+                "reason": job.cancel_reason,
+                "cancelled_for_s": round(now - job.cancelled_at, 1),
+                "age_s": round(now - job.started, 1),
+            }
+            for job in self._jobs.values()
+            if job.cancel_reason is not None and now - job.cancelled_at > UPSTREAM_ORPHAN_GRACE
+        ]
+
+    async def close(self):
+        """取消所有仍在运行的任务"""
+        for job in list(self._jobs.values()):
+            self._cancel(job, "shutdown")
+        if self._jobs:
+            await asyncio.wait(list(self._jobs), timeout=UPSTREAM_ORPHAN_GRACE)
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+
+    def running(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.cancel_reason is None)
+
+    def stats(self) -> dict:
+        orphans = self.orphans()
+        return {
+            "deadline_s": self.deadline,
+            "idle_timeout_s": self.idle_timeout,
+            "running": self.running(),
+            "cancelling": len(self._jobs) - self.running(),
+            "orphaned": len(orphans),
+            "orphans": orphans[:20],
+            **self._stats,
+        }
+
+
+upstream_supervisor = UpstreamSupervisor()
+register_stats("upstream_tasks", upstream_supervisor.stats)
+Gauge("upstream_tasks", "Supervised upstream generations", ("state",), collect=lambda: [
+    ({"state": "running"}, upstream_supervisor.running()),
+    ({"state": "orphaned"}, len(upstream_supervisor.orphans())),
+])
+
+
+@app.on_event("shutdown")
+async def close_upstream_supervisor():
+    await upstream_supervisor.close()
@@ -0,0 +1,128 @@
+import asyncio
+import importlib.util
+import os
+from typing import Dict, Optional
+
+import httpx
+
+from base import app
+from logs import get_logger
+from metrics import upstream_connect_seconds
+
+logger = get_logger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
+class HttpUpstream:
+    """一个上游服务对应的长连接 httpx 客户端
+
+    连接池、keep-alive、HTTP/2 与超时均可通过 `<PREFIX>_*` 环境变量配置，
+    客户端在应用启动时创建并预热，关闭时统一释放。
+    """
+
+    def __init__(self, name: str, base_url: str, env_prefix: str):
+        self.name = name
+        self.base_url = base_url
+        self.max_connections = _env_int(f"{env_prefix}_MAX_CONNECTIONS", 200)
+        self.max_keepalive_connections = _env_int(f"{env_prefix}_MAX_KEEPALIVE", 50)
+        self.keepalive_expiry = _env_float(f"{env_prefix}_KEEPALIVE_EXPIRY", 60.0)
+        self.connect_timeout = _env_float(f"{env_prefix}_CONNECT_TIMEOUT", 10.0)
+        # 流式响应两个数据块之间允许的最长间隔
+        self.read_timeout = _env_float(f"{env_prefix}_READ_TIMEOUT", 300.0)
+        self.write_timeout = _env_float(f"{env_prefix}_WRITE_TIMEOUT", 30.0)
+        self.pool_timeout = _env_float(f"{env_prefix}_POOL_TIMEOUT", 10.0)
+        self.warmup_connections = _env_int(f"{env_prefix}_WARMUP_CONNECTIONS", 2)
+        self.http2 = _env_bool(f"{env_prefix}_HTTP2", False)
+        if self.http2 and importlib.util.find_spec("h2") is None:
+            logger.warning(f"[{name}] 未安装h2，HTTP/2已禁用（pip install 'httpx[http2]'）")
+            self.http2 = False
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(
+            connect=self.connect_timeout,
+            read=self.read_timeout,
+            write=self.write_timeout,
+            pool=self.pool_timeout,
+        )
+
+    def get_client(self) -> httpx.AsyncClient:
+        """返回共享客户端；未经过启动钩子（如脚本直接调用）时按需创建"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                event_hooks={"request": [self._trace_request]},
+            )
+        return self._client
+
+    async def _trace_request(self, request: httpx.Request):
+        """通过 httpcore 的 trace 扩展记录新建连接的 TCP+TLS 握手耗时，复用连接时不触发"""
+        started: Dict[str, float] = {}
+        loop = asyncio.get_running_loop()
+
+        async def trace(event: str, info: dict):
+            if event.endswith((".connect_tcp.started", ".start_tls.started")):
+                started.setdefault("connect", loop.time())
+            elif event.endswith(".start_tls.complete") or (
+                event.endswith(".connect_tcp.complete") and request.url.scheme != "https"
+            ):
+                upstream_connect_seconds.observe(loop.time() - started.pop("connect", loop.time()), upstream=self.name)
+
+        request.extensions["trace"] = trace
+
+    async def warmup(self):
+        """预先完成 DNS 解析和 TCP+TLS 握手，让连接留在池中"""
+        client = self.get_client()
+        # HTTP/2 下一条连接即可多路复用
+        count = 1 if self.http2 else max(0, self.warmup_connections)
+
+        async def _touch():
+            await client.head(self.base_url, timeout=self.connect_timeout)
+
+        results = await asyncio.gather(*[_touch() for _ in range(count)], return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            logger.warning(f"[{self.name}] 连接预热失败: {errors[0]}")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+_upstreams: Dict[str, HttpUpstream] = {}
+
+
+def register_upstream(name: str, base_url: str, env_prefix: str) -> HttpUpstream:
+    """注册一个上游，同名重复注册返回已有实例"""
+    if name not in _upstreams:
+        _upstreams[name] = HttpUpstream(name, base_url, env_prefix)
+    return _upstreams[name]
+
+
+@app.on_event("startup")
+async def start_upstreams():
+    await asyncio.gather(*[u.warmup() for u in _upstreams.values()])
+
+
+@app.on_event("shutdown")
+async def close_upstreams():
+    await asyncio.gather(*[u.aclose() for u in _upstreams.values()])
@@ -0,0 +1,271 @@
+"""多路复用的 WebSocket 聊天通道：一个连接认证一次，承载多个并发的聊天流
+
+消息均为 JSON 文本帧。客户端发送：
+    {"type": "auth", "token": "<JWT>"}                      连接后的第一条消息
+    {"type": "chat", "id": "s1", "model": ..., "prompt": ...}  与 /api/v1/tools/chat 的请求体字段相同
+    {"type": "cancel", "id": "s1"}                           立即停止一个流，上游随之取消
+    {"type": "ping"} / {"type": "pong"}
+服务端发送：
+    {"type": "ready", "user": ..., "max_streams": n}
+    {"type": "chunk", "id": "s1", "data": "<与SSE响应相同的帧文本>"}
+    {"type": "done" | "cancelled", "id": "s1"}
+    {"type": "error", "id": "s1", "status": 429, "detail": ...}   id 为空表示连接级错误
+    {"type": "ping"} / {"type": "pong"}
+"""
+import asyncio
+import contextlib
+import json
+import os
+import time
+from typing import Dict, Optional, Set
+
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+
+from auth import authenticate_token
+from backend import ChatRequest, open_chat_stream
+from base import app
+from lifecycle import lifecycle
+from logs import get_logger
+from metrics import Counter, Gauge
+from response_cache import response_cache
+from scheduler import request_priority
+from stats import register_stats
+from streaming import stream_from_channel
+
+logger = get_logger(__name__)
+
+# 连接建立后发送认证消息的时限（秒）
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))
+# 每个连接同时进行的流数上限
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "8"))
+# 每个连接待写出的消息上限；写满时各个流暂停读取通道，背压经通道传到上游
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "64"))
+# 空闲时发送 ping 的间隔，以及多久收不到客户端任何消息就断开（秒）
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))
+
+# 应用自定义的关闭码（4000-4999），与HTTP状态码对应
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_IDLE = 4408
+# 服务重启（排空）
+CLOSE_SERVICE_RESTART = 1012
+
+ws_messages_total = Counter("ws_chat_messages_total", "WebSocket chat messages", ("direction", "type"))
+
+
+class _Connection:
+    """一个已认证的 WebSocket 连接：读循环分发消息，每个流一个任务，单个写任务按顺序写出"""
+
+    def __init__(self, hub: "WebSocketChatHub", websocket: WebSocket, user: dict):
+        self.hub = hub
+        self.websocket = websocket
+        self.user = user
+        self.client = f"user:{user.get('username')}"
+        self.streams: Dict[str, asyncio.Task] = {}
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=max(1, WS_SEND_QUEUE))
+        self.last_seen = time.monotonic()
+        self.close_code: Optional[int] = None
+
+    async def send(self, message: dict):
+        """排队写出；队列满时等待，发送方因此按客户端的读取速度推进"""
+        await self.outbox.put(message)
+
+    def post(self, message: dict):
+        """控制消息不等待；队列已满说明客户端早已跟不上，直接丢弃"""
+        try:
+            self.outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            pass
+
+    async def _write(self):
+        while True:
+            message = await self.outbox.get()
+            ws_messages_total.inc(direction="out", type=message["type"])
+            await self.websocket.send_text(json.dumps(message, ensure_ascii=False))
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(WS_PING_INTERVAL)
+            if time.monotonic() - self.last_seen > WS_IDLE_TIMEOUT:
+                logger.info("WebSocket 连接空闲超时", extra={"client": self.client})
+                self.close_code = CLOSE_IDLE
+                return
+            if lifecycle.draining and not self.streams:
+                # 进程排空：流都结束后通知客户端重连到其它进程
+                self.close_code = CLOSE_SERVICE_RESTART
+                return
+            self.post({"type": "ping"})
+
+    async def _read(self):
+        while True:
+            text = await self.websocket.receive_text()
+            self.last_seen = time.monotonic()
+            try:
+                message = json.loads(text)
+                kind = message.get("type")
+            except (json.JSONDecodeError, AttributeError):
+                self.post({"type": "error", "id": None, "status": 400, "detail": "Invalid message"})
+                continue
+            ws_messages_total.inc(direction="in", type=str(kind)[:16])
+            if kind == "chat":
+                self._start(message)
+            elif kind == "cancel":
+                self._cancel(str(message.get("id")))
+            elif kind == "ping":
+                self.post({"type": "pong"})
+            elif kind == "pong":
+                pass
+            else:
+                self.post({"type": "error", "id": message.get("id"), "status": 400,
+                           "detail": f"Unknown message type: {kind}"})
+
+    def _start(self, message: dict):
+        stream_id = message.get("id")
+        if not isinstance(stream_id, str) or not stream_id:
+            self.post({"type": "error", "id": None, "status": 400, "detail": "Missing stream id"})
+            return
+        if stream_id in self.streams:
+            self.post({"type": "error", "id": stream_id, "status": 409, "detail": "Stream id already in use"})
+            return
+        if len(self.streams) >= WS_MAX_STREAMS:
+            self.post({"type": "error", "id": stream_id, "status": 429,
+                       "detail": f"At most {WS_MAX_STREAMS} concurrent streams per connection"})
+            return
+        if lifecycle.draining:
+            self.post({"type": "error", "id": stream_id, "status": 503, "detail": "Server is restarting, please retry"})
+            return
+        try:
+            chat_request = ChatRequest(**{k: v for k, v in message.items() if k not in ("type", "id")})
+        except ValidationError as e:
+            self.post({"type": "error", "id": stream_id, "status": 422, "detail": e.errors(include_url=False)})
+            return
+        task = asyncio.create_task(self._run(stream_id, chat_request))
+        self.streams[stream_id] = task
+        task.add_done_callback(lambda _: self.streams.get(stream_id) is task and self.streams.pop(stream_id))
+        self.hub.note_stream_started()
+
+    def _cancel(self, stream_id: str):
+        task = self.streams.pop(stream_id, None)
+        if task is None:
+            return
+        self.hub.note_stream_cancelled()
+        task.cancel()
+        self.post({"type": "cancelled", "id": stream_id})
+
+    async def _run(self, stream_id: str, chat_request: ChatRequest):
+        try:
+            frames, channel, _ = await open_chat_stream(
+                chat_request,
+                self.client,
+                request_priority(self.websocket, chat_request.feature)
+            )
+            source = response_cache.replay(frames) if frames is not None else stream_from_channel(channel)
+            # 取消时立即关闭生成器，stream_from_channel 随之关闭通道，由托管方取消上游
+            async with contextlib.aclosing(source):
+                async for chunk in source:
+                    await self.send({"type": "chunk", "id": stream_id, "data": chunk.decode("utf-8")})
+            await self.send({"type": "done", "id": stream_id})
+        except HTTPException as e:
+            await self.send({"type": "error", "id": stream_id, "status": e.status_code, "detail": e.detail})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"WebSocket 聊天流出错: {e}", extra={"client": self.client})
+            await self.send({"type": "error", "id": stream_id, "status": 500, "detail": "Internal server error"})
+
+    async def serve(self):
+        writer = asyncio.create_task(self._write())
+        reader = asyncio.create_task(self._read())
+        keepalive = asyncio.create_task(self._keepalive())
+        try:
+            await asyncio.wait((writer, reader, keepalive), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in list(self.streams.values()):
+                task.cancel()
+            if self.streams:
+                await asyncio.wait(list(self.streams.values()))
+            for task in (reader, keepalive, writer):
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # 客户端断开时读写任务以 WebSocketDisconnect 结束，其余异常记录下来
+                    error = task.exception()
+                    if error is not None and not isinstance(error, WebSocketDisconnect):
+                        logger.warning(f"WebSocket 连接异常: {error!r}", extra={"client": self.client})
+            if self.close_code is not None:
+                with contextlib.suppress(Exception):
+                    await self.websocket.close(self.close_code)
+
+
+class WebSocketChatHub:
+    """所有 WebSocket 聊天连接的统计"""
+
+    def __init__(self):
+        self._connections: Set[_Connection] = set()
+        self._stats = {
+            "accepted": 0,
+            "auth_failed": 0,
+            "streams_started": 0,
+            "streams_cancelled": 0,
+        }
+
+    async def _authenticate(self, websocket: WebSocket) -> Optional[dict]:
+        try:
+            message = json.loads(await asyncio.wait_for(websocket.receive_text(), WS_AUTH_TIMEOUT))
+            token = message.get("token") if message.get("type") == "auth" else None
+        except (asyncio.TimeoutError, json.JSONDecodeError, AttributeError):
+            token = None
+        return await authenticate_token(token) if isinstance(token, str) and token else None
+
+    async def handle(self, websocket: WebSocket):
+        await websocket.accept()
+        try:
+            user = await self._authenticate(websocket)
+        except WebSocketDisconnect:
+            return
+        if user is None:
+            self._stats["auth_failed"] += 1
+            await websocket.close(CLOSE_UNAUTHORIZED, "Could not validate credentials")
+            return
+
+        connection = _Connection(self, websocket, user)
+        self._stats["accepted"] += 1
+        self._connections.add(connection)
+        try:
+            connection.post({"type": "ready", "user": user.get("username"), "max_streams": WS_MAX_STREAMS})
+            await connection.serve()
+        finally:
+            self._connections.discard(connection)
+
+    @property
+    def connections(self) -> int:
+        return len(self._connections)
+
+    def active_streams(self) -> int:
+        return sum(len(connection.streams) for connection in self._connections)
+
+    def note_stream_started(self):
+        self._stats["streams_started"] += 1
+
+    def note_stream_cancelled(self):
+        self._stats["streams_cancelled"] += 1
+
+    def stats(self) -> dict:
+        return {
+            "connections": self.connections,
+            "active_streams": self.active_streams(),
+            "max_streams_per_connection": WS_MAX_STREAMS,
+            **self._stats,
+        }
+
+
+ws_chat_hub = WebSocketChatHub()
+register_stats("websocket_chat", ws_chat_hub.stats)
+Gauge("ws_chat_connections", "Open WebSocket chat connections", collect=lambda: [({}, ws_chat_hub.connections)])
+
+
+@app.websocket("/ws/chat")
+async def websocket_chat(websocket: WebSocket):
+    """WebSocket 聊天入口，协议见模块说明"""
+    await ws_chat_hub.handle(websocket)